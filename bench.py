@@ -0,0 +1,252 @@
+"""Script used to benchmark an engine's perft speed on a fixed set of positions."""
+
+import argparse
+import datetime
+import itertools
+import json
+import math
+import random
+import shutil
+import statistics
+import sys
+import time
+
+import constants as cs
+import engine_wrapper as ewr
+import perft_cache as pc
+
+
+def time_perft(e_wrapper, fen, depth):
+    """Runs perft once, returning the number of nodes and the time taken."""
+    start = time.perf_counter()
+    nodes = e_wrapper.get_perft_totals([depth], fen)[depth]
+    return nodes, time.perf_counter() - start
+
+
+def run_bench(e_wrapper, positions, reps):
+    """Runs perft on each position several times and prints the results.
+
+    Returns a list with the nodes, times and statistics for each position."""
+    print(
+        cs.BENCH_FSTRING.format(
+            "Position", "Depth", "Nodes", "Median (s)", "Spread", "NPS"
+        )
+    )
+
+    results = []
+
+    for name, fen, depth in positions:
+        nodes = None
+        times = []
+
+        for _ in range(reps):
+            n, t = time_perft(e_wrapper, fen, depth)
+
+            if nodes is not None and n != nodes:
+                print(f"Warning: {name} returned {n} nodes after {nodes}")
+
+            nodes = n
+            times.append(t)
+
+        result = summarise(name, fen, depth, nodes, times)
+        results.append(result)
+
+        print(
+            cs.BENCH_FSTRING.format(
+                name,
+                depth,
+                nodes,
+                f"{result["median"]:.3f}",
+                f"{result["spread"]:.1%}",
+                result["nps"],
+            ),
+            flush=True,
+        )
+
+    total_nodes = sum(r["nodes"] for r in results)
+    total_time = sum(r["median"] for r in results)
+    print(f"\nTotal nodes: {total_nodes}, NPS: {int(total_nodes / total_time)}")
+
+    return results
+
+
+def summarise(name, fen, depth, nodes, times):
+    """Returns the statistics for a position's perft timings."""
+    median = statistics.median(times)
+    stdev = statistics.stdev(times) if len(times) > 1 else 0
+
+    return {
+        "name": name,
+        "fen": fen,
+        "depth": depth,
+        "nodes": nodes,
+        "times": times,
+        "median": median,
+        "stdev": stdev,
+        "spread": (max(times) - min(times)) / median,
+        "nps": int(nodes / median),
+    }
+
+
+def slowdown_p_value(base_times, new_times, n_samples=10000):
+    """Returns the p-value of a one-sided permutation test for the new times
+    being slower than the baseline times."""
+    observed = statistics.mean(new_times) - statistics.mean(base_times)
+    pooled = base_times + new_times
+    n_new = len(new_times)
+
+    def mean_difference(new_indices):
+        new = [pooled[i] for i in new_indices]
+        base = [pooled[i] for i in range(len(pooled)) if i not in new_indices]
+        return statistics.mean(new) - statistics.mean(base)
+
+    # exact test for small samples, otherwise random permutations
+    if math.comb(len(pooled), n_new) <= n_samples:
+        splits = list(itertools.combinations(range(len(pooled)), n_new))
+    else:
+        rng = random.Random(0)
+        splits = [rng.sample(range(len(pooled)), n_new) for _ in range(n_samples)]
+
+    n_extreme = sum(mean_difference(set(s)) >= observed for s in splits)
+    return n_extreme / len(splits)
+
+
+def compare_results(baseline, results, threshold, alpha=0.05):
+    """Prints a comparison of the results with a baseline, returning the names
+    of positions with significant slowdowns or different node counts."""
+    if baseline.get("version") != cs.BENCH_VERSION:
+        print(
+            f"Warning: baseline uses bench version {baseline.get("version")}, "
+            f"not {cs.BENCH_VERSION}"
+        )
+
+    base_results = {(r["fen"], r["depth"]): r for r in baseline["positions"]}
+    failures = []
+
+    print(
+        "\n"
+        + cs.BENCH_COMPARE_FSTRING.format(
+            "Position", "Depth", "Base (s)", "New (s)", "Change", "p", "Result"
+        )
+    )
+
+    for r in results:
+        base = base_results.get((r["fen"], r["depth"]))
+
+        if base is None:
+            print(
+                cs.BENCH_COMPARE_FSTRING.format(
+                    r["name"], r["depth"], "-", "-", "-", "-", "NEW"
+                )
+            )
+            continue
+
+        change = r["median"] / base["median"] - 1
+        p = slowdown_p_value(base["times"], r["times"])
+
+        if r["nodes"] != base["nodes"]:
+            res_str = "NODES"
+        elif p < alpha and change > threshold:
+            res_str = "SLOWER"
+        else:
+            res_str = "OK"
+
+        if res_str != "OK":
+            failures.append(r["name"])
+
+        print(
+            cs.BENCH_COMPARE_FSTRING.format(
+                r["name"],
+                r["depth"],
+                f"{base["median"]:.3f}",
+                f"{r["median"]:.3f}",
+                f"{change:+.1%}",
+                f"{p:.3f}",
+                res_str,
+            )
+        )
+
+    return failures
+
+
+def main():
+    """Runs the benchmark and optionally compares it with a baseline."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("engine", help="path to the engine executable")
+    parser.add_argument(
+        "-d", "--depth", type=int, help="perft depth to use for every position"
+    )
+    parser.add_argument(
+        "-n", "--reps", type=int, default=5, help="number of runs for each position"
+    )
+    parser.add_argument("-o", "--output", help="file to write the results to as JSON")
+    parser.add_argument(
+        "-c", "--compare", help="JSON results file to compare the results with"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=1,
+        help="smallest slowdown in percent reported by --compare",
+    )
+    args = parser.parse_args()
+
+    if shutil.which(args.engine) is None:
+        print("Error: Engine executable not found.")
+        sys.exit(1)
+
+    baseline = None
+    if args.compare:
+        try:
+            with open(args.compare, "r", encoding="UTF-8") as f:
+                baseline = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Error: could not read {args.compare}: {e}")
+            return 1
+
+        if not isinstance(baseline, dict) or "positions" not in baseline:
+            print(f"Error: {args.compare} is not a bench results file")
+            return 1
+
+    positions = [
+        (name, fen, args.depth or depth) for name, fen, depth in cs.BENCH_POSITIONS
+    ]
+    reps = max(args.reps, 1)
+
+    try:
+        with ewr.EngineWrapper(args.engine, persistent=True) as e_wrapper:
+            results = run_bench(e_wrapper, positions, reps)
+
+            if args.output:
+                with open(args.output, "w", encoding="UTF-8") as f:
+                    json.dump(
+                        {
+                            "version": cs.BENCH_VERSION,
+                            "engine": e_wrapper.name,
+                            "engine_id": pc.engine_id(e_wrapper.name, args.engine),
+                            "date": datetime.datetime.now().isoformat(),
+                            "reps": reps,
+                            "positions": results,
+                        },
+                        f,
+                        indent=2,
+                    )
+    except (ewr.EngineError, OSError) as e:
+        print(f"Error: {e}")
+        return 1
+
+    if baseline is not None:
+        failures = compare_results(baseline, results, args.threshold / 100)
+
+        if failures:
+            print(f"\nSlower or incorrect: {", ".join(failures)}")
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    try:
+        sys.exit(main())
+    except KeyboardInterrupt:
+        pass
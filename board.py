@@ -4,12 +4,26 @@ import re
 import constants as cs
 
 
+# translation expanding the digits of a fen string into empty squares
+EXPAND_EMPTY = str.maketrans({str(n): "-" * n for n in range(1, 9)})
+EMPTY_RUN_PATTERN = re.compile("-+")
+EMPTY = ord("-")
+
+
 class Board:
-    """A class that stores some aspects of a chess position."""
+    """A class that stores some aspects of a chess position.
+
+    The board is a bytearray holding the ASCII code of the piece on each
+    square, or "-" for an empty square."""
 
     def __init__(self):
-        self.board = ["-" for _ in range(64)]
+        self.board = bytearray(b"-" * 64)
         self.side = cs.WHITE
+        self.castling = 0
+        self.ep_square = None
+        self.halfmove_clock = 0
+        self.fullmove_number = 1
+        self.hash = 0
         self.update_board(cs.START_POS)
 
     @staticmethod
@@ -17,105 +31,261 @@ class Board:
         """Vertically flips a board coordinate."""
         return pos ^ 56
 
+    def piece_at(self, sq):
+        """Returns the piece on a square, or "-" if it is empty."""
+        return chr(self.board[sq])
+
     def update_board(self, board_string):
         """Fills a board array by parsing a fen string."""
-        for i in range(64):
-            self.board[i] = "-"
+        fields = board_string.split()
+        ranks = fields[0].split("/")
+        placement = "".join(r.translate(EXPAND_EMPTY) for r in reversed(ranks))
+
+        if len(ranks) != 8 or len(placement) != 64:
+            raise ValueError(f"Invalid piece placement: {fields[0]}")
+
+        self.board[:] = placement.encode("ascii")
+
+        fields = fields[1:]
+        self.side = cs.WHITE if fields[0] == "w" else cs.BLACK
+
+        self.castling = 0
+        if len(fields) > 1:
+            for j, right in enumerate(cs.CASTLING_RIGHTS):
+                if right in fields[1]:
+                    self.castling |= 1 << j
+
+        # drop castling rights which can't be used
+        for right, king_sq, rook_sq, king, rook in cs.CASTLING_SQUARES:
+            if self.piece_at(king_sq) != king or self.piece_at(rook_sq) != rook:
+                self.castling &= ~right
+
+        self.ep_square = None
+        if len(fields) > 2 and fields[2] in cs.SQUARE_INDEX:
+            ep_square = cs.SQUARE_INDEX[fields[2]]
+            if self.ep_capturable(ep_square):
+                self.ep_square = ep_square
+
+        self.halfmove_clock = int(fields[3]) if len(fields) > 3 else 0
+        self.fullmove_number = int(fields[4]) if len(fields) > 4 else 1
+        self.hash = self.compute_hash()
+
+    def ep_capturable(self, ep_square):
+        """Returns whether a pawn of the side to move can capture en passant."""
+        if cs.SQUARES[ep_square][1] != cs.EP_RANK[self.side]:
+            return False
+
+        pawn = "P" if self.side == cs.WHITE else "p"
+
+        for ray in cs.PAWN_ATTACKER_RAYS[self.side][ep_square]:
+            if self.piece_at(ray[0]) == pawn:
+                return True
+
+        return False
+
+    def compute_hash(self):
+        """Calculates the Zobrist hash of the position from scratch."""
+        h = cs.ZOBRIST_CASTLING[self.castling]
+
+        for sq, piece in enumerate(self.board.decode("ascii")):
+            if piece != "-":
+                h ^= cs.ZOBRIST_PIECES[piece][sq]
+
+        if self.ep_square is not None:
+            h ^= cs.ZOBRIST_EP[self.ep_square % 8]
+
+        if self.side == cs.BLACK:
+            h ^= cs.ZOBRIST_SIDE
 
-        i = 0
-        b_index = 0
-        char = board_string[i]
+        return h
 
-        while char != " ":
-            if char.isdigit():
-                for j in range(int(char)):
-                    self.board[Board.flip(b_index + j)] = "-"
-                b_index += int(char)
-            elif char != "/":
-                self.board[Board.flip(b_index)] = char
-                b_index += 1
+    def set_square(self, sq, piece):
+        """Places a piece on a square, updating the hash."""
+        old_piece = self.piece_at(sq)
 
-            i += 1
-            char = board_string[i]
+        if old_piece != "-":
+            self.hash ^= cs.ZOBRIST_PIECES[old_piece][sq]
 
-        self.side = cs.WHITE if board_string[i + 1] == "w" else cs.BLACK
+        if piece != "-":
+            self.hash ^= cs.ZOBRIST_PIECES[piece][sq]
+
+        self.board[sq] = ord(piece)
 
     def make_move(self, mstr):
         """Updates the board representation with a move."""
-        start = cs.SQUARES.index(mstr[:2])
-        dest = cs.SQUARES.index(mstr[2:4])
-        piece = self.board[start]
+        start = cs.SQUARE_INDEX[mstr[:2]]
+        dest = cs.SQUARE_INDEX[mstr[2:4]]
+        piece = self.piece_at(start)
+        captured = self.piece_at(dest)
+
+        self.hash ^= cs.ZOBRIST_CASTLING[self.castling]
+        if self.ep_square is not None:
+            self.hash ^= cs.ZOBRIST_EP[self.ep_square % 8]
 
-        self.board[start] = "-"
-        self.board[dest] = piece
+        self.set_square(start, "-")
+        self.set_square(dest, piece)
 
         if piece.lower() == "p":
             vec = dest - start
 
             # en passant
-            if vec != cs.PAWN_STEP[self.side] and self.board[dest] == "-":
-                self.board[dest - cs.PAWN_STEP[self.side]] = "-"
+            if vec % 8 != 0 and captured == "-":
+                self.set_square(dest - cs.PAWN_STEP[self.side], "-")
 
             # promotion
             if mstr[3] == cs.FINAL_RANK[self.side]:
                 assert (len(mstr)) == 5
-                self.board[dest] = mstr[-1]
 
                 if self.side == cs.WHITE:
-                    self.board[dest] = mstr[-1].upper()
+                    self.set_square(dest, mstr[-1].upper())
+                else:
+                    self.set_square(dest, mstr[-1].lower())
+
+        if piece.lower() == "k" and (start, dest) in cs.CASTLING_ROOK_MOVES:
+            rook_start, rook_dest = cs.CASTLING_ROOK_MOVES[(start, dest)]
+            self.set_square(rook_dest, self.piece_at(rook_start))
+            self.set_square(rook_start, "-")
+
+        self.castling &= ~cs.CASTLING_MASKS.get(start, 0)
+        self.castling &= ~cs.CASTLING_MASKS.get(dest, 0)
+        self.hash ^= cs.ZOBRIST_CASTLING[self.castling]
+
+        if piece.lower() == "p" or captured != "-":
+            self.halfmove_clock = 0
+        else:
+            self.halfmove_clock += 1
+
+        if self.side == cs.BLACK:
+            self.fullmove_number += 1
+
+        self.side ^= 1
+        self.hash ^= cs.ZOBRIST_SIDE
+
+        self.ep_square = None
+        if piece.lower() == "p" and abs(dest - start) == 16:
+            ep_square = (start + dest) // 2
+            if self.ep_capturable(ep_square):
+                self.ep_square = ep_square
+                self.hash ^= cs.ZOBRIST_EP[ep_square % 8]
+
+    def get_fen(self, clocks=True):
+        """Returns the fen string of the position.
+
+        The castling rights and en passant square are only included if they
+        can be used, so transposed positions give the same string."""
+        ranks = []
+
+        for rank in range(7, -1, -1):
+            rank_str = self.board[rank * 8 : rank * 8 + 8].decode("ascii")
+            ranks.append(
+                EMPTY_RUN_PATTERN.sub(lambda m: str(len(m.group(0))), rank_str)
+            )
+
+        castling = "".join(
+            right
+            for i, right in enumerate(cs.CASTLING_RIGHTS)
+            if self.castling & (1 << i)
+        )
+        ep_square = "-" if self.ep_square is None else cs.SQUARES[self.ep_square]
+
+        fen = f"{"/".join(ranks)} {"wb"[self.side]} {castling or "-"} {ep_square}"
+
+        if clocks:
+            fen += f" {self.halfmove_clock} {self.fullmove_number}"
+
+        return fen
+
+    def attacked(self, sq, side):
+        """Returns whether a square is attacked by any piece of a side."""
+        board = self.board
+
+        def piece(p_type):
+            return ord(p_type if side == cs.WHITE else p_type.lower())
 
-        if piece.lower() == "k" and mstr[0] == "e":
-            rook = "R" if self.side == cs.WHITE else "r"
+        for ray in cs.PAWN_ATTACKER_RAYS[side][sq]:
+            if board[ray[0]] == piece("P"):
+                return True
 
-            if mstr[2] == "c":  # queenside castle
-                self.board[cs.SQUARES.index("a" + cs.FIRST_RANK[self.side])] = "-"
-                self.board[cs.SQUARES.index("d" + cs.FIRST_RANK[self.side])] = rook
-            elif mstr[2] == "g":  # kingside castle
-                self.board[cs.SQUARES.index("h" + cs.FIRST_RANK[self.side])] = "-"
-                self.board[cs.SQUARES.index("f" + cs.FIRST_RANK[self.side])] = rook
+        for p_type in ("N", "K"):
+            for ray in cs.PIECE_RAYS[p_type][sq]:
+                if board[ray[0]] == piece(p_type):
+                    return True
+
+        for p_type in ("R", "B"):
+            attackers = (piece(p_type), piece("Q"))
+
+            for ray in cs.PIECE_RAYS[p_type][sq]:
+                for i in ray:
+                    if board[i] != EMPTY:
+                        if board[i] in attackers:
+                            return True
+                        break
+
+        return False
+
+    def leaves_king_in_check(self, start, dest):
+        """Returns whether moving the piece on start to dest would leave the
+        side to move in check. En passant and castling are not handled."""
+        board = self.board
+        piece, captured = board[start], board[dest]
+        board[start], board[dest] = EMPTY, piece
+
+        king = board.find(b"K" if self.side == cs.WHITE else b"k")
+        in_check = king != -1 and self.attacked(king, self.side ^ 1)
+
+        board[start], board[dest] = piece, captured
+        return in_check
 
     def get_possible_squares(self, p_type, dest, squares):
         """Populates an array with all possible start squares of a move."""
         if self.side == cs.BLACK:
             p_type = p_type.lower()
 
-        if p_type.lower() not in ("b", "r", "q"):
-            for v in cs.VECS[p_type]:
-                try:
-                    sq = cs.SQUARES[dest + v]
-                    if self.board[dest + v] == p_type:
-                        squares.append(sq)
-                except IndexError:
-                    continue
-            return
-
-        for v in cs.VECS[p_type]:
-            i = dest + v
-            while 0 <= i <= 63:
-                sq = cs.SQUARES[i]
-
-                if self.board[i] == p_type:
-                    squares.append(sq)
-                    break
+        piece = ord(p_type)
 
-                if self.board[i] != "-":
+        for ray in cs.PIECE_RAYS[p_type.upper()][dest]:
+            for i in ray:
+                if self.board[i] == piece:
+                    squares.append(cs.SQUARES[i])
                     break
 
-                i += v
+                if self.board[i] != EMPTY:
+                    break
 
     def san_to_lan(self, mstr):
-        """Returns a move string in LAN."""
+        """Returns a move string in LAN, raising ValueError if the move can't be
+        made in the position."""
+        san = mstr
+        pr_type = ""
+
+        if mstr[-1:] in ("+", "#"):
+            mstr = mstr[:-1]
+
+        # every move other than castling ends with its destination square
+        if len(mstr) < 2:
+            raise ValueError(f"Invalid move: {san}")
+
         if re.match(cs.CASTLE_MOVE_REGEX, mstr):
             c_type = cs.KINGSIDE if len(mstr) == 3 else cs.QUEENSIDE
+            right, king_sq, rook_sq, _, _ = cs.CASTLING_SQUARES[
+                2 * self.side + c_type
+            ]
+            step = 1 if rook_sq > king_sq else -1
+            between = range(king_sq + step, rook_sq, step)
+            king_path = range(king_sq, king_sq + 3 * step, step)
+
+            # the king can't castle out of, through or into check
+            if (
+                not self.castling & right
+                or any(self.board[sq] != EMPTY for sq in between)
+                or any(self.attacked(sq, self.side ^ 1) for sq in king_path)
+            ):
+                raise ValueError(f"Illegal move: {san}")
+
             start_str = "e" + cs.FIRST_RANK[self.side]
             dest_str = cs.CASTLE_FILES[c_type] + cs.FIRST_RANK[self.side]
             return start_str + dest_str
 
-        pr_type = ""
-
-        if mstr[-1] in ("+", "#"):
-            mstr = mstr[:-1]
-
         if mstr[-1].lower() in ("n", "b", "r", "q"):
             pr_type = mstr[-1].lower()
             mstr = mstr[:-1]
@@ -123,35 +293,96 @@ class Board:
                 mstr = mstr[:-1]
 
         dest_str = mstr[-2:]
-        dest = cs.SQUARES.index(dest_str)
-        pawn_step = cs.PAWN_STEP[self.side]
+        if dest_str not in cs.SQUARE_INDEX:
+            raise ValueError(f"Invalid move: {san}")
 
-        if len(mstr) == 2:
-            if self.board[dest - pawn_step] != "-":
-                start_str = cs.SQUARES[dest - pawn_step]
-            else:
-                start_str = cs.SQUARES[dest - (2 * pawn_step)]
+        dest = cs.SQUARE_INDEX[dest_str]
 
-            return start_str + dest_str + pr_type
+        captured = self.piece_at(dest)
+        if captured != "-" and captured.isupper() == (self.side == cs.WHITE):
+            raise ValueError(f"Illegal move: {san}")
 
-        if mstr[0] in cs.FILES and mstr[1] == "x":
-            return mstr[0] + cs.SQUARES[dest - pawn_step][1] + dest_str + pr_type
+        if len(mstr) == 2 or (mstr[0] in cs.FILES and mstr[1] == "x"):
+            return self.pawn_move_to_lan(san, mstr, dest, pr_type)
+
+        if pr_type:
+            raise ValueError(f"Invalid move: {san}")
 
         p_type = mstr[0]
+        if p_type not in cs.PIECE_RAYS:
+            raise ValueError(f"Invalid move: {san}")
+
         start_squares = []
         self.get_possible_squares(p_type, dest, start_squares)
 
-        if len(start_squares) == 1:
-            return start_squares[0] + dest_str
+        # the file, rank or square given to tell apart pieces which can move to dest
+        hint = mstr[1:-2].replace("x", "")
+        start_squares = [x for x in start_squares if all(c in x for c in hint)]
+
+        start_squares = [
+            x
+            for x in start_squares
+            if not self.leaves_king_in_check(cs.SQUARE_INDEX[x], dest)
+        ]
+
+        if not start_squares:
+            raise ValueError(f"Illegal move: {san}")
+
+        if len(start_squares) > 1:
+            raise ValueError(f"Ambiguous move: {san}")
 
-        if mstr[1:3] in cs.SQUARES:
-            return mstr[1:3] + dest_str
+        return start_squares[0] + dest_str
+
+    def pawn_move_to_lan(self, san, mstr, dest, pr_type):
+        """Returns a pawn move in LAN, given the SAN move without its check and
+        promotion suffixes, raising ValueError if it can't be made."""
+        pawn_step = cs.PAWN_STEP[self.side]
+        start = dest - pawn_step
+
+        if not 0 <= start < 64:
+            raise ValueError(f"Invalid move: {san}")
+
+        if len(mstr) == 2:
+            if self.board[start] == EMPTY:
+                # a double step, which can only be made from the pawns' first rank
+                start -= pawn_step
 
-        if mstr[1] in cs.FILES:
-            start_str = [x for x in start_squares if x[0] == mstr[1]][0]
-        elif mstr[1] in cs.RANKS:
-            start_str = [x for x in start_squares if x[1] == mstr[1]][0]
+                if not 0 <= start < 64 or (
+                    cs.SQUARES[start][1] != cs.PAWN_RANK[self.side]
+                ):
+                    raise ValueError(f"Illegal move: {san}")
+
+            if self.board[dest] != EMPTY:
+                raise ValueError(f"Illegal move: {san}")
         else:
-            raise ValueError
+            start_str = mstr[0] + cs.SQUARES[start][1]
+            start = cs.SQUARE_INDEX[start_str]
+
+            if abs(start % 8 - dest % 8) != 1:
+                raise ValueError(f"Invalid move: {san}")
+
+            if self.board[dest] == EMPTY and dest != self.ep_square:
+                raise ValueError(f"Illegal move: {san}")
+
+        if self.board[start] != ord("P" if self.side == cs.WHITE else "p"):
+            raise ValueError(f"Illegal move: {san}")
+
+        if (cs.SQUARES[dest][1] == cs.FINAL_RANK[self.side]) != bool(pr_type):
+            raise ValueError(f"Illegal move: {san}")
+
+        # an en passant capture also removes the pawn behind dest, which can
+        # expose the king along its rank
+        ep_pawn = None
+        if dest == self.ep_square:
+            ep_pawn = self.board[dest - pawn_step]
+            self.board[dest - pawn_step] = EMPTY
+
+        in_check = self.leaves_king_in_check(start, dest)
+
+        if ep_pawn is not None:
+            self.board[dest - pawn_step] = ep_pawn
+
+        if in_check:
+            raise ValueError(f"Illegal move: {san}")
 
-        return start_str + dest_str
+        return cs.SQUARES[start] + cs.SQUARES[dest] + pr_type
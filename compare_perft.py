@@ -1,97 +1,588 @@
-"""Script used to compare an engine's perft results to Stockfish."""
-
+"""Script used to compare an engine's perft results to a reference engine."""
+
+import argparse
+import asyncio
+import concurrent.futures
+import contextlib
+import math
+import queue
 import re
 import shutil
+import statistics
 import sys
+import threading
+import time
 
 
+import board as bd
 import engine_wrapper as ewr
 import constants as cs
+import divide_tree as dt
+import epd as ep
+import movegen as mg
+import perft_cache as pc
+import profiler as pf
+
+
+class PerftTask:
+    """Class tracking a command which runs in the background.
+
+    The command's output is kept until it finishes, so that the output of
+    commands running at the same time isn't mixed together. Rows of a diff
+    table are the exception, and are printed as soon as they are known,
+    tagged with the command's number."""
+
+    def __init__(self, n, command, fen, moves, names):
+        self.n = n
+        self.command = command
+        self.fen = fen
+        self.moves = moves
+        self.names = names
+        self.stop = ewr.StopToken()
+        self.output = []
+        self.node = ""
+        self.depth = 0
+        self.n_moves = 0
+        self.n_done = [0, 0]
+        self.nodes = [0, 0]
+        self.start = time.monotonic()
+        self.last = [self.start, self.start]
+        self.rows = None
+        self.future = None
+
+    def print(self, *args):
+        """Adds a line to the output printed when the command finishes."""
+        self.output.append(" ".join(str(a) for a in args))
+
+    def print_now(self, line):
+        """Prints a line straight away, tagged with the command's number."""
+        print(f"[{self.n}] {line}", flush=True)
+
+    def stream_rows(self, header):
+        """Prints the header of a diff table, and then each row as soon as both
+        engines have reported its move."""
+        self.rows = ({}, {})
+        self.print_now(header)
+
+    def begin(self, fen, moves, depth):
+        """Resets the progress at the start of a perft run."""
+        self.node = " ".join(moves) or "root"
+        self.depth = depth
+        self.n_moves = mg.divide(fen, moves, 1)[1]
+        self.n_done = [0, 0]
+        self.nodes = [0, 0]
+        self.start = time.monotonic()
+        self.last = [self.start, self.start]
+
+        if self.rows is not None:
+            self.rows = ({}, {})
+
+    def on_result(self, i, mstr, res):
+        """Records a root move finished by one of the engines, printing its row
+        of the diff table if the other engine has already reported it."""
+        self.n_done[i] += 1
+        self.nodes[i] += res
+        self.last[i] = time.monotonic()
+
+        if self.rows is not None:
+            self.rows[i][mstr] = res
+
+            if mstr in self.rows[1 - i]:
+                e1_res, e2_res = self.rows[0][mstr], self.rows[1][mstr]
+                self.print_now(
+                    cs.DIFF_FSTRING.format(mstr, e1_res, e2_res, e2_res - e1_res)
+                )
+
+    def progress(self):
+        """Returns a line describing the progress of the current perft run."""
+        if not self.depth:
+            return f"[{self.n}] {self.command}: starting"
+
+        engines = ", ".join(
+            f"{name} {n_done}/{self.n_moves} moves "
+            f"{nodes / max(last - self.start, 1e-6):.0f} nodes/s"
+            for name, n_done, nodes, last in zip(
+                self.names, self.n_done, self.nodes, self.last
+            )
+        )
+        node = f"{self.node} (depth {self.depth})"
+        return f"[{self.n}] {self.command} at {node}: {engines}"
 
 
 class ComparePerft:
     """Class providing methods to compare the perft output of two engines."""
 
-    def __init__(self, engine_exec):
-        self.engine = ewr.EngineWrapper(engine_exec)
-        self.stockfish = ewr.EngineWrapper("stockfish")
+    def __init__(
+        self,
+        engine_exec,
+        jobs=1,
+        timeout=None,
+        cache=None,
+        reference="stockfish",
+        table_size=None,
+        profiler=None,
+    ):
+        # only the reference is cached, since a cached result for the engine
+        # would hide bugs which depend on the moves made to reach a position
+        if jobs > 1:
+            self.engine = ewr.EnginePool(engine_exec, jobs, profiler=profiler)
+        else:
+            self.engine = ewr.EngineWrapper(
+                engine_exec, persistent=True, profiler=profiler
+            )
+
+        if reference == "builtin":
+            self.reference = mg.ReferenceEngine(table_size)
+        elif jobs > 1:
+            self.reference = ewr.EnginePool(
+                reference, jobs, cache=cache, profiler=profiler
+            )
+        else:
+            self.reference = ewr.EngineWrapper(
+                reference, persistent=True, cache=cache, profiler=profiler
+            )
+
+        # a pool can run several commands at once, but a single engine can't
+        self.locks = [
+            contextlib.nullcontext()
+            if isinstance(e_wrapper, ewr.EnginePool)
+            else threading.Lock()
+            for e_wrapper in (self.engine, self.reference)
+        ]
+
+        self.timeout = timeout
+        self.speed = None
         self.fen = cs.START_POS
-        self.ply = 0
         self.moves_made = []
-        self.legal_moves = []
+        self.tree = dt.DivideTree()
+        self.tasks = {}
+        self.n_tasks = 0
 
     def update_position(self, fen, moves=None):
-        """Updates the current position."""
+        """Updates the current position, keeping the old one and printing an
+        error if any of the moves is illegal."""
         if fen == "startpos":
             fen = cs.START_POS
 
-        if moves:
-            self.moves_made = moves
+        moves = list(moves or [])
+
+        try:
+            mg.divide(fen, moves, 1)
+        except ValueError as e:
+            print(f"Error: {e}")
+            return
 
+        self.moves_made = moves
         self.fen = fen
-        self.legal_moves = []
 
     def step_back(self):
         """Steps back up the game tree."""
-        if not self.ply:
+        if not self.moves_made:
             return
 
         self.moves_made.pop()
 
     def step_forward(self, move):
         """Steps forward in the game tree."""
-        if not self.legal_moves:
-            print("Run diff before trying to step forward")
-            return
+        legal_moves = mg.divide(self.fen, self.moves_made, 1)[0]
 
-        if move not in self.legal_moves:
+        if move not in legal_moves:
             print("Not a legal move")
             return
 
         self.moves_made.append(move)
-        self.ply += 1
 
-    def compare_perft(self, depth):
-        """Prints the difference between the engines' perft results at a given depth."""
-        print(
+    def run_engine(self, i, depth, fen, moves, on_result, stop):
+        """Runs perft on the engine (i = 0) or the reference (i = 1)."""
+        e_wrapper = (self.engine, self.reference)[i]
+
+        with self.locks[i]:
+            return e_wrapper.perft(depth, fen, moves, self.timeout, on_result, stop)
+
+    def run_perfts(self, depth, fen, moves, task=None):
+        """Runs perft on both engines at the same time.
+
+        Returns the outcome of each run, which is either the result or the
+        error that stopped it. Results from earlier runs are taken from the
+        divide tree, where the reference's results are shared between move
+        orders reaching the same position, and only the engines without a
+        result are run. The progress
+        of the runs is recorded in task, and they stop when it is stopped."""
+        outcomes = self.tree.get(fen, moves, depth)
+        on_result = stop = None
+
+        if task is not None:
+            task.begin(fen, moves, depth)
+            on_result, stop = task.on_result, task.stop
+
+            for i, outcome in enumerate(outcomes):
+                if outcome is not None:
+                    for mstr, res in outcome[0].items():
+                        on_result(i, mstr, res)
+
+        missing = [i for i, outcome in enumerate(outcomes) if outcome is None]
+        if not missing:
+            return outcomes
+
+        reported = queue.SimpleQueue()
+
+        with concurrent.futures.ThreadPoolExecutor(len(missing)) as executor:
+            jobs = []
+
+            for i in missing:
+                job = executor.submit(
+                    self.run_engine,
+                    i,
+                    depth,
+                    fen,
+                    moves,
+                    lambda mstr, res, i=i: reported.put((i, mstr, res)),
+                    stop,
+                )
+                job.add_done_callback(lambda _: reported.put(None))
+                jobs.append(job)
+
+            running = len(jobs)
+
+            while running:
+                item = reported.get()
+                if item is None:
+                    running -= 1
+                elif on_result is not None:
+                    on_result(*item)
+
+        for i, job in zip(missing, jobs):
+            try:
+                outcomes[i] = job.result()
+            except ewr.EngineError as e:
+                outcomes[i] = e
+            else:
+                self.tree.put(fen, moves, depth, i, outcomes[i])
+
+        return outcomes
+
+    def compare_perft(self, depth, fen, moves, task):
+        """Prints the difference between the engines' perft results at a given depth.
+
+        Rows for moves reported by both engines are printed as they arrive,
+        and the rest of the table when both runs have finished."""
+        task.stream_rows(
             cs.DIFF_FSTRING.format(
-                "Move", self.engine.name, self.stockfish.name, "Difference"
+                "Move", self.engine.name, self.reference.name, "Difference"
             )
         )
+        e_outcome, ref_outcome = self.run_perfts(depth, fen, moves, task)
 
-        sf_results, sf_total = self.stockfish.perft(depth, self.fen, self.moves_made)
-        e_results, e_total = self.engine.perft(depth, self.fen, self.moves_made)
+        for outcome in (e_outcome, ref_outcome):
+            if isinstance(outcome, Exception):
+                task.print(f"Error: {outcome}")
 
-        self.legal_moves = list(sf_results.keys())
+        e_results = {} if isinstance(e_outcome, Exception) else e_outcome[0]
+        ref_results = {} if isinstance(ref_outcome, Exception) else ref_outcome[0]
 
         for mstr, e1_res in e_results.items():
-            if mstr in sf_results:
-                e2_res = sf_results.pop(mstr)
-                print(cs.DIFF_FSTRING.format(mstr, e1_res, e2_res, e2_res - e1_res))
+            if mstr not in ref_results:
+                task.print(cs.DIFF_FSTRING.format(mstr, e1_res, "-", -e1_res))
+
+        for mstr, e2_res in ref_results.items():
+            if mstr not in e_results:
+                task.print(cs.DIFF_FSTRING.format(mstr, "-", e2_res, e2_res))
+
+        if isinstance(e_outcome, Exception) or isinstance(ref_outcome, Exception):
+            e_total = "-" if isinstance(e_outcome, Exception) else e_outcome[1]
+            ref_total = "-" if isinstance(ref_outcome, Exception) else ref_outcome[1]
+            task.print(cs.DIFF_FSTRING.format("Total", e_total, ref_total, "-"))
+            return
+
+        e_total, ref_total = e_outcome[1], ref_outcome[1]
+        task.print(
+            cs.DIFF_FSTRING.format("Total", e_total, ref_total, ref_total - e_total)
+        )
+        self.check_totals(depth, fen, moves, (e_total, ref_total), task)
+
+    def check_totals(self, depth, fen, moves, totals, task):
+        """Compares the totals at a position with the results for the last move
+        in the divide at the previous position, if it has been run at depth + 1,
+        and prints any which differ."""
+        parent_totals = self.tree.child_totals(fen, moves, depth)
+        if parent_totals == [None, None]:
+            return
+
+        e_parent, ref_parent = ("-" if t is None else t for t in parent_totals)
+        task.print(cs.DIFF_FSTRING.format("Previous", e_parent, ref_parent, "-"))
+
+        for e_wrapper, total, parent_total in zip(
+            (self.engine, self.reference), totals, parent_totals
+        ):
+            if parent_total is not None and parent_total != total:
+                task.print(
+                    f"Warning: {e_wrapper.name} gives {total} here but "
+                    f"{parent_total} for {moves[-1]} at depth {depth + 1}"
+                )
+
+    def auto_diff(self, depth, fen, moves, task):
+        """Walks down the game tree from a position to the first node where the
+        engines' legal moves differ, and prints the moves which differ.
+
+        At each node, perft is run at increasing depths until the results
+        differ, and the search continues from the first move with a different
+        result, so most of the perft runs are shallow. Returns the moves made
+        to reach the node, or None if no difference was found."""
+        moves = list(moves)
+
+        while True:
+            for d in range(1, depth + 1):
+                outcomes = self.run_perfts(d, fen, moves, task)
+
+                errors = [o for o in outcomes if isinstance(o, Exception)]
+                if errors:
+                    for e in errors:
+                        task.print(f"Error: {e}")
+                    return None
+
+                (e_results, e_total), (ref_results, ref_total) = outcomes
+
+                if e_results.keys() != ref_results.keys() or e_total != ref_total:
+                    break
             else:
-                print(cs.DIFF_FSTRING.format(mstr, e1_res, "-", -e1_res))
+                task.print(f"No difference found at depth {depth}")
+                return None
+
+            if e_results.keys() != ref_results.keys():
+                break
+
+            diff_moves = [m for m in ref_results if ref_results[m] != e_results[m]]
+
+            if not diff_moves:
+                task.print(
+                    f"Total at depth {d} differs ({self.engine.name}: {e_total}, "
+                    f"{self.reference.name}: {ref_total}) but every move matches"
+                )
+                break
+
+            # every move has one leaf at depth 1, so there is nothing to descend to
+            if d == 1:
+                for mstr in diff_moves:
+                    task.print(
+                        f"{mstr} at depth 1: {self.engine.name} {e_results[mstr]}, "
+                        f"{self.reference.name} {ref_results[mstr]}"
+                    )
+                break
+
+            mstr = diff_moves[0]
+            task.print(
+                f"{" ".join(moves + [mstr])} (depth {d - 1}): "
+                f"{self.engine.name} {e_results[mstr]}, "
+                f"{self.reference.name} {ref_results[mstr]}"
+            )
+
+            moves.append(mstr)
+            depth = d - 1
+
+        position = ewr.position_command(fen, moves)
+
+        board = bd.Board()
+        board.update_board(fen)
+        for mstr in moves:
+            board.make_move(mstr)
+
+        task.print(f"\nDifference found at: {position}")
+        task.print(f"FEN: {board.get_fen()}")
+        missing = [m for m in ref_results if m not in e_results]
+        extra = [m for m in e_results if m not in ref_results]
+        task.print(f"Missing moves: {" ".join(missing)}")
+        task.print(f"Extra moves: {" ".join(extra)}")
+
+        return moves
+
+    def move_to_difference(self, task, moves):
+        """Moves to the node found by autodiff, if the position hasn't been
+        changed while it was running."""
+        if moves is None or (self.fen, self.moves_made) != (task.fen, task.moves):
+            return
+
+        self.moves_made = moves
+
+    def start_task(self, command, fn, *args, on_done=None, exclusive=False):
+        """Runs fn(fen, moves, task) in the background for the current position.
+
+        When it finishes, its output is printed and on_done is called with
+        the task and the value fn returned. If exclusive is True, fn isn't
+        run until the commands already running have finished."""
+        after = [t.future for t in self.tasks.values()] if exclusive else []
+        self.n_tasks += 1
+        task = PerftTask(
+            self.n_tasks,
+            command,
+            self.fen,
+            list(self.moves_made),
+            (self.engine.name, self.reference.name),
+        )
+        self.tasks[task.n] = task
+        task.future = asyncio.create_task(
+            self.run_task(task, fn, args, on_done, after)
+        )
+        print(f"[{task.n}] {command} started", flush=True)
+
+    async def run_task(self, task, fn, args, on_done, after=()):
+        """Runs a background command once the commands in after have finished,
+        printing its progress every PROGRESS_INTERVAL seconds until it does."""
+        result = None
+
+        try:
+            if after:
+                await asyncio.wait(after)
+
+            if task.stop.stopped:
+                raise ewr.PerftStopped("the run was stopped")
+
+            job = asyncio.create_task(
+                asyncio.to_thread(fn, *args, task.fen, task.moves, task)
+            )
+
+            while not job.done():
+                await asyncio.wait({job}, timeout=cs.PROGRESS_INTERVAL)
+                if not job.done():
+                    print(task.progress(), flush=True)
+
+            result = job.result()
+        except (ewr.EngineError, ValueError) as e:
+            task.print(f"Error: {e}")
+        finally:
+            del self.tasks[task.n]
+
+        status = "stopped" if task.stop.stopped else "finished"
+        print("\n".join([f"[{task.n}] {task.command} {status}"] + task.output))
+
+        if on_done is not None:
+            on_done(task, result)
+
+    def stop_tasks(self, n=None):
+        """Stops the background command with a given number, or every command if
+        n is None. The engines are restarted, and results which were already
+        found are kept."""
+        tasks = list(self.tasks.values()) if n is None else [self.tasks.get(n)]
+
+        if tasks == [None]:
+            print(f"No command [{n}] is running")
+            return
+
+        for task in tasks:
+            task.stop.stop()
+            print(f"[{task.n}] {task.command} stopping", flush=True)
+
+    async def wait_for_tasks(self):
+        """Waits for the background commands to finish."""
+        waiting = [t.future for t in self.tasks.values()]
+
+        if waiting:
+            await asyncio.wait(waiting)
+
+    def run_speed(self, depth, fen, moves, task):
+        """Compares the speed of the engines at a position."""
+        self.speed.run([("current", fen, moves, depth, None)])
+
+    def save(self, file_path):
+        """Writes the divide tree and the current position to a JSON file."""
+        try:
+            self.tree.save(
+                file_path,
+                self.fen,
+                self.moves_made,
+                (self.engine.name, self.reference.name),
+            )
+        except OSError as e:
+            print(f"Error: {e}")
+
+    def load(self, file_path):
+        """Reads the reference's results from a JSON file written by save, and
+        moves to the position which was current when it was saved."""
+        try:
+            fen, moves = self.tree.load(file_path)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Error: {e}")
+            return
+
+        self.update_position(fen, moves)
+
+        print(ewr.position_command(self.fen, self.moves_made))
+
+    async def run(self):
+        """Reads and runs commands until quit is entered or the input ends.
+
+        At the end of the input, the commands running in the background are
+        left to finish, so that piped commands print their results. After
+        quit, they are stopped first."""
+        loop = asyncio.get_running_loop()
+        commands = asyncio.Queue()
 
-        for mstr, e2_res in sf_results.items():
-            print(cs.DIFF_FSTRING.format(mstr, "-", e2_res, e2_res))
+        def read_commands():
+            """Forwards each line of input to the queue, then None at the end."""
+            try:
+                for line in sys.stdin:
+                    loop.call_soon_threadsafe(commands.put_nowait, line.strip())
+                loop.call_soon_threadsafe(commands.put_nowait, None)
+            except RuntimeError:
+                # the event loop has already been closed
+                pass
 
-        print(cs.DIFF_FSTRING.format("Total", e_total, sf_total, sf_total - e_total))
+        threading.Thread(target=read_commands, daemon=True).start()
+
+        try:
+            while (cmd := await commands.get()) not in (None, "quit"):
+                self.parse_command(cmd)
+
+            if cmd == "quit":
+                self.stop_tasks()
+            await self.wait_for_tasks()
+        finally:
+            self.stop_tasks()
 
     def parse_command(self, cmd):
         """Parses a user input."""
         args = cmd.split(" ")
 
-        if cmd == "quit":
-            sys.exit()
-
         if cmd in ("b", "back"):
             self.step_back()
 
         elif re.match(r"diff [0-9]+", cmd):
-            self.compare_perft(int(args[1]))
+            self.start_task(cmd, self.compare_perft, int(args[1]))
+
+        elif re.match(r"autodiff [0-9]+", cmd):
+            self.start_task(
+                cmd, self.auto_diff, int(args[1]), on_done=self.move_to_difference
+            )
+
+        elif re.match(r"(stop|cancel)( [0-9]+)?$", cmd):
+            self.stop_tasks(int(args[1]) if len(args) > 1 else None)
+
+        elif cmd in ("status", "jobs"):
+            for task in self.tasks.values():
+                print(task.progress())
+
+            if not self.tasks:
+                print("No commands are running")
+
+        elif re.match(r"speed [0-9]+", cmd):
+            if self.speed is None:
+                print("Pass --speed to compare the speed of engines")
+                return
+
+            # other runs would slow the engines down
+            self.start_task(cmd, self.run_speed, int(args[1]), exclusive=True)
+
+        elif re.match(r"timeout [0-9]+", cmd):
+            self.timeout = int(args[1]) or None
 
         elif re.match(r"move (.)+", cmd):
             self.step_forward(args[1])
 
+        elif re.match(r"save (.)+", cmd):
+            self.save(cmd[5:])
+
+        elif re.match(r"load (.)+", cmd):
+            self.load(cmd[5:])
+
         elif re.match(r"position", cmd):
             if len(args) < 8:
                 if len(args) == 2 and args[1] == "startpos":
@@ -110,20 +601,342 @@ class ComparePerft:
                 self.update_position(fen, moves)
 
 
+class SpeedComparison:
+    """Class timing the perft runs of several engines on the same positions.
+
+    The first engine is the baseline, and the time taken by each other engine
+    is given as a ratio of its time."""
+
+    def __init__(self, engine_execs, reps=3, timeout=None, profiler=None):
+        self.engines = [
+            ewr.EngineWrapper(
+                engine_exec, persistent=True, timeout=timeout, profiler=profiler
+            )
+            for engine_exec in engine_execs
+        ]
+        self.labels = [chr(ord("A") + i) for i in range(len(self.engines))]
+        self.reps = reps
+        self.timeout = timeout
+
+    def close(self):
+        """Closes the engines."""
+        for e_wrapper in self.engines:
+            e_wrapper.close()
+
+    def time_perft(self, e_wrapper, fen, moves, depth):
+        """Runs perft on an engine, returning the results and the time taken."""
+        start = time.perf_counter()
+        outcome = e_wrapper.perft(depth, fen, moves, self.timeout)
+        return outcome, time.perf_counter() - start
+
+    def run_position(self, fen, moves, depth):
+        """Runs perft on each engine several times, returning the outcome and
+        the times for each engine.
+
+        The order in which the engines are run is rotated after each repetition,
+        so that changes in machine load and CPU clock speed affect each engine
+        equally."""
+        n_engines = len(self.engines)
+        outcomes = [None] * n_engines
+        times = [[] for _ in range(n_engines)]
+
+        for rep in range(self.reps):
+            for j in range(n_engines):
+                i = (rep + j) % n_engines
+                if isinstance(outcomes[i], Exception):
+                    continue
+
+                try:
+                    outcomes[i], elapsed = self.time_perft(
+                        self.engines[i], fen, moves, depth
+                    )
+                    times[i].append(elapsed)
+                except ewr.EngineError as e:
+                    outcomes[i] = e
+
+        return outcomes, times
+
+    def print_header(self):
+        """Prints the engines being compared and the table header."""
+        for label, e_wrapper in zip(self.labels, self.engines):
+            print(f"{label}: {e_wrapper.name} ({e_wrapper.exec_name})")
+
+        print(
+            "\n" + cs.SPEED_FSTRING.format("Position", "Depth", "Nodes"), end=""
+        )
+        for label in self.labels:
+            print(cs.SPEED_ENGINE_FSTRING.format(f"{label} (s)", "Ratio"), end="")
+        print(cs.SPEED_RESULT_FSTRING.format("Result"))
+
+    def run(self, positions):
+        """Compares the engines' perft speed and results on a list of
+        (name, fen, moves, depth, expected_total) positions.
+
+        Returns True if every engine agreed on every result, and the ratio of
+        each engine's total time to the baseline's total time."""
+        self.print_header()
+
+        correct = True
+        medians = []
+
+        for name, fen, moves, depth, expected in positions:
+            outcomes, times = self.run_position(fen, moves, depth)
+            errors = [o for o in outcomes if isinstance(o, Exception)]
+
+            if errors:
+                res_str = "ERROR"
+            elif any(o != outcomes[0] for o in outcomes) or expected not in (
+                None,
+                outcomes[0][1],
+            ):
+                res_str = "MISMATCH"
+            else:
+                res_str = "OK"
+                medians.append([statistics.median(t) for t in times])
+
+            correct = correct and res_str == "OK"
+            nodes = "-" if isinstance(outcomes[0], Exception) else outcomes[0][1]
+
+            print(cs.SPEED_FSTRING.format(name, depth, nodes), end="")
+
+            for t in times:
+                if len(t) < self.reps:
+                    print(cs.SPEED_ENGINE_FSTRING.format("-", "-"), end="")
+                    continue
+
+                # the baseline has no time if it failed on this position
+                median = statistics.median(t)
+                ratio = "-"
+                if len(times[0]) == self.reps:
+                    ratio = f"{median / statistics.median(times[0]):.2f}"
+
+                print(
+                    cs.SPEED_ENGINE_FSTRING.format(f"{median:.3f}", ratio), end=""
+                )
+
+            print(cs.SPEED_RESULT_FSTRING.format(res_str), flush=True)
+
+            for e in errors:
+                print(f"Error: {e}")
+
+        if not medians:
+            return correct, []
+
+        ratios = []
+        print()
+
+        for i, label in enumerate(self.labels[1:], 1):
+            ratio = sum(m[i] for m in medians) / sum(m[0] for m in medians)
+            mean_ratio = math.exp(
+                statistics.fmean(math.log(m[i] / m[0]) for m in medians)
+            )
+            ratios.append(ratio)
+            print(
+                f"{label}/A: total time ratio {ratio:.3f}, "
+                f"geometric mean ratio {mean_ratio:.3f}"
+            )
+
+        return correct, ratios
+
+
+def run_speed_comparison(
+    engine_execs, epd_file, depth, reps, timeout, threshold, profiler=None
+):
+    """Compares the engines' speed on the positions in an EPD file, returning 1
+    if any result is wrong or any engine is slower than the first by more than
+    threshold percent, and 0 otherwise."""
+    records = list(ep.read_perft_records(epd_file))
+
+    positions = []
+    for n, record in enumerate(records, 1):
+        depths = [d for d in record.depths() if depth is None or d <= depth]
+        if depths:
+            d = depths[-1]
+            positions.append((f"({n}/{len(records)})", record.fen, [], d, record[d]))
+
+    speed = SpeedComparison(engine_execs, reps, timeout, profiler)
+
+    try:
+        correct, ratios = speed.run(positions)
+    finally:
+        speed.close()
+
+    slower = [
+        label
+        for label, ratio in zip(speed.labels[1:], ratios)
+        if ratio > 1 + threshold / 100
+    ]
+
+    if not correct:
+        print("Engines disagree with each other or with the stored results")
+    if slower:
+        print(f"Slower than A by more than {threshold}%: {", ".join(slower)}")
+
+    return 1 if slower or not correct else 0
+
+
 def main():
     """Runs the engines and prints the difference in perft results."""
-    if len(sys.argv) < 2:
-        print("Engine executable not provided")
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("engine", help="path to the engine executable")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="number of instances of each engine to split perft runs between",
+    )
+    parser.add_argument(
+        "-t",
+        "--timeout",
+        type=float,
+        help="number of seconds after which a perft run is abandoned",
+    )
+    parser.add_argument(
+        "-r",
+        "--reference",
+        help="path to the reference engine, or 'builtin' to use the built-in "
+        "move generator (defaults to Stockfish if it is installed)",
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true", help="don't use stored perft results"
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=256,
+        help="maximum size of the perft result cache in MB",
+    )
+    parser.add_argument(
+        "--hash",
+        type=int,
+        default=64,
+        help="size in MB of the built-in reference's perft table (0 to disable it)",
+    )
+    parser.add_argument(
+        "--speed",
+        nargs="+",
+        metavar="ENGINE",
+        help="other engines to compare the speed of the engine with",
+    )
+    parser.add_argument(
+        "--epd",
+        help="EPD file of perft results to run the speed comparison on, "
+        "instead of reading commands",
+    )
+    parser.add_argument(
+        "-d",
+        "--depth",
+        type=int,
+        help="maximum perft depth for positions in the EPD file",
+    )
+    parser.add_argument(
+        "--reps",
+        type=int,
+        default=3,
+        help="number of times each engine runs each position in a speed comparison",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=2,
+        help="slowdown in percent over the EPD file above which the exit status is 1",
+    )
+    parser.add_argument(
+        "--load",
+        metavar="FILE",
+        help="divide tree saved by the save command to replay the reference from",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="print where the time of the engine runs went when finished",
+    )
+    parser.add_argument(
+        "--profile-json", metavar="FILE", help="also write the profile to a JSON file"
+    )
+    parser.add_argument(
+        "--profile-trace",
+        metavar="FILE",
+        help="also write the engine calls to a Chrome trace file",
+    )
+    args = parser.parse_args()
+
+    if not shutil.which(args.engine):
+        print("Engine executable not found")
         sys.exit()
 
-    if not shutil.which(sys.argv[1]):
-        print("Engine executable not found")
+    reference = args.reference
+    if reference is None:
+        reference = "stockfish" if shutil.which("stockfish") else "builtin"
+
+    if reference != "builtin" and not shutil.which(reference):
+        print("Reference engine executable not found")
         sys.exit()
 
-    client = ComparePerft(sys.argv[1])
+    engine_execs = [args.engine] + (args.speed or [])
+    for engine_exec in engine_execs[1:]:
+        if not shutil.which(engine_exec):
+            print(f"Engine executable {engine_exec} not found")
+            sys.exit()
+
+    profiler = None
+    if args.profile or args.profile_json or args.profile_trace:
+        profiler = pf.Profiler()
+
+    if args.speed and args.epd:
+        try:
+            sys.exit(
+                run_speed_comparison(
+                    engine_execs,
+                    args.epd,
+                    args.depth,
+                    max(args.reps, 1),
+                    args.timeout,
+                    args.threshold,
+                    profiler,
+                )
+            )
+        finally:
+            if profiler is not None:
+                pf.report(profiler, args.profile_json, args.profile_trace)
+
+    cache = None if args.no_cache else pc.PerftCache(max_size=args.cache_size)
+    client = ComparePerft(
+        args.engine,
+        jobs=args.jobs,
+        timeout=args.timeout,
+        cache=cache,
+        reference=reference,
+        table_size=args.hash,
+        profiler=profiler,
+    )
+
+    if args.speed:
+        client.speed = SpeedComparison(
+            engine_execs, max(args.reps, 1), args.timeout, profiler
+        )
+
+    if args.load:
+        client.load(args.load)
+
+    try:
+        asyncio.run(client.run())
+    finally:
+        client.engine.close()
+        client.reference.close()
+
+        if isinstance(client.reference, mg.ReferenceEngine) and client.reference.table:
+            print(client.reference.table.summary())
+
+        if client.speed is not None:
+            client.speed.close()
+
+        if cache is not None:
+            cache.close()
 
-    while True:
-        client.parse_command(input())
+        if profiler is not None:
+            pf.report(profiler, args.profile_json, args.profile_trace)
 
 
 if __name__ == "__main__":
@@ -1,10 +1,14 @@
 """Module storing project constants."""
 
+import random
+
 # fmt: off
 
 MOVE_REGEX_LAN = r'[a-h][1-8][a-h][1-8]([nbrq]?)'
 MOVE_REGEX_SAN = r'([RNBQKR])?([a-h])?([1-8])?(x)?[a-h][1-8]((=)?[RNBQKR])?(\+|#)?'
 CASTLE_MOVE_REGEX = r'(O|0)-(O|0)(-(O|0))?'
+PERFT_LINE_REGEX = r'([a-h][1-8][a-h][1-8][nbrq]?):?\s+([0-9]+)\s*$'
+PERFT_TOTAL_REGEX = r'(?:[^:]*:)?\s*([0-9]+)\s*'
 
 FEN_REGEX = (
     r'([pnbrqkPNBRQK1-8]+\/){7}[pnbrqkPNBRQK1-8]+\s[bw]\s(([K]?[Q]?[k]?[q]?)|-)'
@@ -13,10 +17,72 @@ FEN_REGEX = (
 
 DIFF_FSTRING = "{:8}{:>16}{:>16}{:>16}"
 
-BESTMOVE_FSTRING = "{:<36}{:<72}{:<22}{:<22}{:<6}"
+# speed comparison table: position columns, then a time and ratio for each engine
+SPEED_FSTRING = "{:<10}{:>6}{:>14}"
+SPEED_ENGINE_FSTRING = "{:>12}{:>8}"
+SPEED_RESULT_FSTRING = "{:>10}"
+
+BESTMOVE_FSTRING = "{:<36}{:<72}{:<22}{:<22}{:<8}{:<12}{:<6}"
+
+# seconds to wait for a best move after the search time has run out
+BESTMOVE_GRACE_PERIOD = 1
+
+# seconds to wait for an engine to reply to uci and isready when it starts
+ENGINE_START_TIMEOUT = 10
+
+# test_perft gives each run PERFT_TIMEOUT seconds plus the time taken to search
+# the expected number of nodes at PERFT_MIN_NPS
+PERFT_TIMEOUT = 10
+PERFT_MIN_NPS = 100000
+
+# number of positions test_perft reads from the EPD file and runs depth by depth
+PERFT_BATCH_SIZE = 10000
+
+# seconds between the progress reports of a command running in compare_perft
+PROGRESS_INTERVAL = 10
+
+# number of perft jobs sent to an engine in one write by perft_batch, and the
+# largest expected total of a position which test_perft sends in a batch
+PERFT_PIPELINE_SIZE = 64
+PERFT_PIPELINE_NODES = 100000
+
+# address a distributed_perft coordinator listens on unless one is given
+DISTRIBUTED_ADDRESS = "localhost:7270"
+
+# seconds between the messages a distributed_perft worker sends while running a
+# job, and seconds without one after which the coordinator gives the job to
+# another worker
+DISTRIBUTED_HEARTBEAT = 5
+DISTRIBUTED_LEASE = 30
+
+# number of times a distributed_perft job is tried before the run is abandoned
+DISTRIBUTED_MAX_ATTEMPTS = 3
+
+# seconds a distributed_perft worker keeps trying to reach the coordinator
+DISTRIBUTED_CONNECT_TIMEOUT = 30
 
 START_POS = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
 
+# positions used by the bench script, with the default depth for each.
+# BENCH_VERSION must be increased whenever this list changes.
+BENCH_VERSION = 1
+
+BENCH_POSITIONS = (
+    ("startpos", START_POS, 6),
+    ("kiwipete", "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1", 5),
+    ("position3", "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1", 7),
+    ("position4", "r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1", 5),
+    ("position5", "rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8", 5),
+    ("position6", "r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10", 5),
+)
+
+PROFILE_FSTRING = "{:<18}{:>8}{:>14}{:>12}{:>12}{:>12}{:>12}{:>12}"
+PROFILE_HISTOGRAM_FSTRING = "    {:<16}{:>8}  {}"
+PROFILE_BAR_WIDTH = 40
+
+BENCH_FSTRING = "{:<12}{:>6}{:>14}{:>12}{:>10}{:>14}"
+BENCH_COMPARE_FSTRING = "{:<12}{:>6}{:>12}{:>12}{:>10}{:>10}{:>8}"
+
 SQUARES = [
     "a1", "b1", "c1", "d1", "e1", "f1", "g1", "h1",
     "a2", "b2", "c2", "d2", "e2", "f2", "g2", "h2",
@@ -42,25 +108,81 @@ N, E, S, W = 8, 1, -8, -1
 PAWN_STEP = (N, S)
 CASTLE_FILES = ("g", "c")
 FIRST_RANK = ("1", "8")
+PAWN_RANK = ("2", "7")
 FINAL_RANK = ("8", "1")
+EP_RANK = ("6", "3")
+
+SQUARE_INDEX = {sq: i for i, sq in enumerate(SQUARES)}
+
+KNIGHT_STEPS = ((1, 2), (-1, 2), (1, -2), (-1, -2), (2, 1), (-2, 1), (2, -1), (-2, -1))
+ROOK_STEPS = ((0, 1), (1, 0), (0, -1), (-1, 0))
+BISHOP_STEPS = ((1, 1), (-1, 1), (1, -1), (-1, -1))
+QUEEN_STEPS = ROOK_STEPS + BISHOP_STEPS
 
-KNIGHT_VECS = (
-    N + N + E, N + N + W, S + S + E, S + S + W,
-    N + E + E, N + W + W, S + E + E, S + W + W
+
+def _rays(steps, limit):
+    """Returns, for each square, the squares reached by repeating each (file, rank)
+    step up to limit times, stopping at the edge of the board."""
+    rays = []
+
+    for sq in range(64):
+        sq_rays = []
+
+        for file_step, rank_step in steps:
+            f, r = sq % 8 + file_step, sq // 8 + rank_step
+            ray = []
+
+            while 0 <= f < 8 and 0 <= r < 8 and len(ray) < limit:
+                ray.append(r * 8 + f)
+                f, r = f + file_step, r + rank_step
+
+            if ray:
+                sq_rays.append(tuple(ray))
+
+        rays.append(tuple(sq_rays))
+
+    return tuple(rays)
+
+
+# rays leaving each square for each piece type, in order of distance
+PIECE_RAYS = {
+    "N": _rays(KNIGHT_STEPS, 1),
+    "B": _rays(BISHOP_STEPS, 7),
+    "R": _rays(ROOK_STEPS, 7),
+    "Q": _rays(QUEEN_STEPS, 7),
+    "K": _rays(QUEEN_STEPS, 1),
+}
+
+# squares a pawn of each side would have to be on to attack each square
+PAWN_ATTACKER_RAYS = (_rays(((-1, -1), (1, -1)), 1), _rays(((-1, 1), (1, 1)), 1))
+
+CASTLING_RIGHTS = "KQkq"
+WHITE_KINGSIDE, WHITE_QUEENSIDE, BLACK_KINGSIDE, BLACK_QUEENSIDE = 1, 2, 4, 8
+
+# squares of the king and rook each castling right depends on
+CASTLING_SQUARES = (
+    (WHITE_KINGSIDE, 4, 7, "K", "R"),
+    (WHITE_QUEENSIDE, 4, 0, "K", "R"),
+    (BLACK_KINGSIDE, 60, 63, "k", "r"),
+    (BLACK_QUEENSIDE, 60, 56, "k", "r"),
 )
-ROOK_VECS = (N, E, S, W)
-BISHOP_VECS = (N + E, N + W, S + E, S + W)
-QUEEN_VECS = (N, E, S, W, N + E, N + W, S + E, S + W)
-
-VECS = {
-    "N": KNIGHT_VECS,
-    "n": KNIGHT_VECS,
-    "B": BISHOP_VECS,
-    "b": BISHOP_VECS,
-    "R": ROOK_VECS,
-    "r": ROOK_VECS,
-    "Q": QUEEN_VECS,
-    "q": QUEEN_VECS,
-    "K": QUEEN_VECS,
-    "k": QUEEN_VECS
+
+# rook moves made when the king castles, keyed by the king's move
+CASTLING_ROOK_MOVES = {
+    (4, 6): (7, 5), (4, 2): (0, 3), (60, 62): (63, 61), (60, 58): (56, 59),
+}
+
+# castling rights lost when a piece moves to or from a square
+CASTLING_MASKS = {
+    0: WHITE_QUEENSIDE, 4: WHITE_KINGSIDE | WHITE_QUEENSIDE, 7: WHITE_KINGSIDE,
+    56: BLACK_QUEENSIDE, 60: BLACK_KINGSIDE | BLACK_QUEENSIDE, 63: BLACK_KINGSIDE,
+}
+
+_zobrist_rng = random.Random(0x5EED)
+
+ZOBRIST_PIECES = {
+    p: [_zobrist_rng.getrandbits(64) for _ in range(64)] for p in "PNBRQKpnbrqk"
 }
+ZOBRIST_CASTLING = [_zobrist_rng.getrandbits(64) for _ in range(16)]
+ZOBRIST_EP = [_zobrist_rng.getrandbits(64) for _ in range(8)]
+ZOBRIST_SIDE = _zobrist_rng.getrandbits(64)
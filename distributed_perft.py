@@ -0,0 +1,617 @@
+"""Script used to share a deep perft run between workers on several machines.
+
+A coordinator splits the game tree below a position into subtrees and serves
+them as jobs over a TCP or Unix socket. Workers run each job on an engine and
+send back its total, which the coordinator adds up. The jobs of workers which
+disconnect or stop responding are given to other workers."""
+
+import argparse
+import collections
+import concurrent.futures
+import json
+import os
+import shutil
+import socket
+import socketserver
+import stat
+import subprocess
+import sys
+import threading
+import time
+
+import constants as cs
+import engine_wrapper as ewr
+import movegen as mg
+import perft_cache as pc
+
+
+def parse_address(address):
+    """Returns the socket family and address of a coordinator given as
+    "HOST:PORT" or as "unix:PATH", raising ValueError if it is invalid."""
+    if address.startswith("unix:"):
+        if not hasattr(socket, "AF_UNIX"):
+            raise ValueError("Unix sockets are not supported on this platform")
+        return socket.AF_UNIX, address[5:]
+
+    host, sep, port = address.rpartition(":")
+    if not sep or not port.isdigit():
+        raise ValueError(f"invalid address {address!r}, expected HOST:PORT")
+
+    return socket.AF_INET, (host or "localhost", int(port))
+
+
+def format_address(family, address):
+    """Returns an address in the form accepted by parse_address."""
+    if family == socket.AF_INET:
+        return f"{address[0]}:{address[1]}"
+    return f"unix:{address}"
+
+
+def send_message(sock, lock, message):
+    """Writes a message to a socket as a line of JSON."""
+    data = (json.dumps(message, separators=(",", ":")) + "\n").encode("UTF-8")
+    with lock:
+        sock.sendall(data)
+
+
+def read_message(reader):
+    """Reads a message written by send_message, raising EOFError if the
+    connection has been closed."""
+    line = reader.readline()
+    if not line:
+        raise EOFError("connection closed")
+    return json.loads(line)
+
+
+def split_paths(fen, moves, plies):
+    """Returns the paths of moves leading from a position to every position
+    a given number of plies below it."""
+    pos = mg.Position(fen)
+    for mstr in moves:
+        pos = pos.make_move(pos.parse_move(mstr))
+
+    paths = [([], pos)]
+
+    for _ in range(plies):
+        paths = [
+            (path + [mg.move_to_str(m)], p.make_move(m))
+            for path, p in paths
+            for m in p.legal_moves()
+        ]
+
+    return [path for path, _ in paths]
+
+
+class Coordinator:
+    """Class handing out the subtrees of a perft run to workers and adding up
+    their totals.
+
+    Each job is the subtree below one path of split plies from the root. A
+    job is leased to one worker at a time, and is put back in the queue if
+    the worker fails it or is released before finishing it."""
+
+    def __init__(self, fen, moves, depth, split=1, max_attempts=None):
+        self.fen = fen
+        self.moves = list(moves)
+        self.depth = depth
+        self.max_attempts = max_attempts or cs.DISTRIBUTED_MAX_ATTEMPTS
+
+        split = min(split, depth)
+        self.paths = split_paths(fen, self.moves, split)
+        self.job_depth = depth - split
+
+        self.cond = threading.Condition()
+        self.pending = collections.deque(range(len(self.paths)))
+        self.leases = {}
+        self.results = {}
+        self.attempts = collections.Counter()
+        self.workers = set()
+        self.error = None
+        self.start = time.monotonic()
+
+        # a subtree at depth 0 is a single leaf, so doesn't need a worker
+        if self.job_depth == 0:
+            self.results = dict.fromkeys(self.pending, 1)
+            self.pending.clear()
+
+    @property
+    def finished(self):
+        """Whether every job has a result."""
+        return len(self.results) == len(self.paths)
+
+    def job(self, job_id):
+        """Returns the message describing a job."""
+        return {
+            "type": "job",
+            "id": job_id,
+            "fen": self.fen,
+            "moves": self.moves + self.paths[job_id],
+            "depth": self.job_depth,
+        }
+
+    def connect(self, worker):
+        """Records that a worker has connected."""
+        with self.cond:
+            self.workers.add(worker)
+
+    def next_job(self, worker):
+        """Waits for a job and leases it to a worker, returning its ID, or None
+        if the run is over."""
+        with self.cond:
+            while not self.pending and not self.finished and self.error is None:
+                self.cond.wait()
+
+            if self.finished or self.error is not None:
+                return None
+
+            job_id = self.pending.popleft()
+            self.leases[job_id] = worker
+            self.attempts[job_id] += 1
+            return job_id
+
+    def finish(self, job_id, total):
+        """Stores the total of a job."""
+        with self.cond:
+            self.leases.pop(job_id, None)
+            self.results.setdefault(job_id, total)
+            self.cond.notify_all()
+
+    def fail(self, job_id, message):
+        """Puts a job which a worker couldn't run back in the queue, or ends the
+        run if it has been tried too many times."""
+        with self.cond:
+            self.leases.pop(job_id, None)
+            self.retry(job_id, message)
+
+    def release(self, worker, message):
+        """Puts the jobs leased to a worker back in the queue, so that other
+        workers run them."""
+        with self.cond:
+            self.workers.discard(worker)
+
+            for job_id in [j for j, w in self.leases.items() if w == worker]:
+                del self.leases[job_id]
+                self.retry(job_id, message)
+
+    def retry(self, job_id, message):
+        """Queues a job again, first in line. Must be called with cond held."""
+        if job_id in self.results:
+            return
+
+        if self.attempts[job_id] >= self.max_attempts:
+            self.error = (
+                f"{" ".join(self.paths[job_id]) or "root"} failed "
+                f"{self.attempts[job_id]} times: {message}"
+            )
+        else:
+            self.pending.appendleft(job_id)
+
+        self.cond.notify_all()
+
+    def stop(self, message):
+        """Ends the run, so that waiting workers are sent home."""
+        with self.cond:
+            if self.error is None:
+                self.error = message
+            self.cond.notify_all()
+
+    def progress(self):
+        """Returns a line describing how far the run has got."""
+        with self.cond:
+            nodes = sum(self.results.values())
+            elapsed = max(time.monotonic() - self.start, 1e-9)
+            return (
+                f"{len(self.results)}/{len(self.paths)} jobs, "
+                f"{len(self.leases)} running, {len(self.workers)} workers, "
+                f"{nodes} nodes, {nodes / elapsed:.0f} nodes/s"
+            )
+
+    def divide(self):
+        """Returns the total below each root move, and the overall total, in the
+        same form as EngineWrapper.perft."""
+        perft_results = {}
+
+        for job_id, path in enumerate(self.paths):
+            if path:
+                perft_results[path[0]] = (
+                    perft_results.get(path[0], 0) + self.results[job_id]
+                )
+
+        return perft_results, sum(self.results.values())
+
+
+class WorkerHandler(socketserver.StreamRequestHandler):
+    """Class serving jobs to a worker over one connection.
+
+    While a job is leased, the worker must send a message at least every
+    lease seconds, or the connection is dropped and the job queued again."""
+
+    def handle(self):
+        coordinator = self.server.coordinator
+        lock = threading.Lock()
+        name = "worker"
+        reason = None
+
+        try:
+            name = read_message(self.rfile).get("name", name)
+            coordinator.connect(self)
+            print(f"{name} connected", flush=True)
+
+            while True:
+                job_id = coordinator.next_job(self)
+
+                if job_id is None:
+                    send_message(self.connection, lock, {"type": "done"})
+                    break
+
+                send_message(self.connection, lock, coordinator.job(job_id))
+                self.connection.settimeout(self.server.lease)
+
+                while True:
+                    message = read_message(self.rfile)
+
+                    if message["type"] == "result" and message["id"] == job_id:
+                        coordinator.finish(job_id, message["total"])
+                        break
+
+                    if message["type"] == "error" and message["id"] == job_id:
+                        print(f"{name}: {message["message"]}", flush=True)
+                        coordinator.fail(job_id, message["message"])
+                        break
+
+                self.connection.settimeout(None)
+        except TimeoutError:
+            reason = f"{name} stopped responding"
+        except (OSError, EOFError, ValueError, KeyError) as e:
+            reason = f"{name} disconnected: {e}"
+        finally:
+            if reason is not None:
+                print(reason, flush=True)
+            coordinator.release(self, reason)
+
+
+class TCPServer(socketserver.ThreadingTCPServer):
+    """Server accepting workers over TCP."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+if hasattr(socketserver, "ThreadingUnixStreamServer"):
+
+    class UnixServer(socketserver.ThreadingUnixStreamServer):
+        """Server accepting workers over a Unix socket."""
+
+        daemon_threads = True
+
+
+def make_server(address, coordinator, lease):
+    """Starts listening for workers at an address, returning the server."""
+    family, addr = parse_address(address)
+
+    if family == socket.AF_INET:
+        server = TCPServer(addr, WorkerHandler)
+    else:
+        # only replace a socket left behind by an earlier run
+        if os.path.exists(addr):
+            if not stat.S_ISSOCK(os.stat(addr).st_mode):
+                raise FileExistsError(f"{addr} exists and is not a socket")
+            os.remove(addr)
+        server = UnixServer(addr, WorkerHandler)
+
+    server.coordinator = coordinator
+    server.lease = lease
+    return server
+
+
+def start_local_workers(engine_exec, address, n, timeout=None):
+    """Starts worker processes on this machine, returning them."""
+    command = [sys.executable, os.path.abspath(__file__), "work", engine_exec, address]
+    if timeout is not None:
+        command += ["--timeout", str(timeout)]
+
+    return [subprocess.Popen(command) for _ in range(n)]
+
+
+def run_coordinator(coordinator, server, local_workers=()):
+    """Serves jobs until the run is over, printing its progress, and returns
+    the result. Raises EngineError if the run couldn't be finished."""
+    family = server.address_family
+    print(
+        f"Serving {len(coordinator.paths)} jobs at depth {coordinator.job_depth} "
+        f"on {format_address(family, server.server_address)}",
+        flush=True,
+    )
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    last = time.monotonic()
+
+    def over():
+        return coordinator.finished or coordinator.error is not None
+
+    try:
+        while True:
+            with coordinator.cond:
+                if coordinator.cond.wait_for(over, 1):
+                    break
+
+                n_workers = len(coordinator.workers)
+
+            if not n_workers and any(p.poll() is not None for p in local_workers):
+                if all(p.poll() is not None for p in local_workers):
+                    coordinator.stop("all local workers have exited")
+
+            if time.monotonic() - last >= cs.PROGRESS_INTERVAL:
+                last = time.monotonic()
+                print(coordinator.progress(), flush=True)
+    finally:
+        # give connected workers a moment to be sent home
+        time.sleep(0.1)
+        server.shutdown()
+        server.server_close()
+
+        if family != socket.AF_INET and os.path.exists(server.server_address):
+            os.remove(server.server_address)
+
+    if coordinator.error is not None:
+        raise ewr.EngineError(coordinator.error)
+
+    return coordinator.divide()
+
+
+def run_worker(engine, address):
+    """Runs jobs from a coordinator on an engine until it has none left,
+    returning the number of jobs run."""
+    family, addr = parse_address(address)
+    deadline = time.monotonic() + cs.DISTRIBUTED_CONNECT_TIMEOUT
+
+    while True:
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            sock.connect(addr)
+            break
+        except OSError:
+            sock.close()
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.5)
+
+    lock = threading.Lock()
+    n_jobs = 0
+
+    with sock, sock.makefile("r", encoding="UTF-8") as reader:
+        send_message(sock, lock, {"type": "hello", "name": engine.name})
+
+        while True:
+            try:
+                job = read_message(reader)
+            except EOFError:
+                break
+
+            if job["type"] != "job":
+                break
+
+            # keep the lease while the job runs
+            running = threading.Event()
+
+            def heartbeat():
+                while not running.wait(cs.DISTRIBUTED_HEARTBEAT):
+                    try:
+                        send_message(sock, lock, {"type": "alive"})
+                    except OSError:
+                        return
+
+            thread = threading.Thread(target=heartbeat, daemon=True)
+            thread.start()
+
+            try:
+                total = engine.perft(job["depth"], job["fen"], job["moves"])[1]
+                reply = {"type": "result", "id": job["id"], "total": total}
+            except ewr.EngineError as e:
+                reply = {"type": "error", "id": job["id"], "message": str(e)}
+            finally:
+                running.set()
+                thread.join()
+
+            send_message(sock, lock, reply)
+            n_jobs += 1
+
+    return n_jobs
+
+
+def serve(args):
+    """Runs the coordinator described by the command line arguments."""
+    if args.local and args.engine != "builtin" and not shutil.which(args.engine):
+        print("Error: Engine executable not found.")
+        return 1
+
+    try:
+        coordinator = Coordinator(
+            args.fen, args.moves or [], args.depth, max(args.split, 1), args.attempts
+        )
+        server = make_server(args.address, coordinator, args.lease)
+    except (ValueError, OSError) as e:
+        print(f"Error: {e}")
+        return 1
+
+    local_workers = []
+    if args.local:
+        address = format_address(server.address_family, server.server_address)
+        local_workers = start_local_workers(
+            args.engine, address, args.local, args.timeout
+        )
+
+    start = time.perf_counter()
+
+    try:
+        perft_results, total = run_coordinator(coordinator, server, local_workers)
+    except ewr.EngineError as e:
+        print(f"Error: {e}")
+        return 1
+    finally:
+        for proc in local_workers:
+            try:
+                proc.wait(cs.DISTRIBUTED_HEARTBEAT)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+    print()
+    for mstr, res in perft_results.items():
+        print(f"{mstr}: {res}")
+
+    print(f"\nNodes searched: {total}")
+    print(f"Time elapsed: {time.perf_counter() - start:.3f}s")
+
+    return 0
+
+
+def work(args):
+    """Runs the workers described by the command line arguments."""
+    if args.engine != "builtin" and not shutil.which(args.engine):
+        print("Error: Engine executable not found.")
+        return 1
+
+    try:
+        parse_address(args.address)
+    except ValueError as e:
+        print(f"Error: {e}")
+        return 1
+
+    cache = None if args.no_cache else pc.PerftCache(max_size=args.cache_size)
+
+    def run():
+        if args.engine == "builtin":
+            engine = mg.ReferenceEngine(args.hash)
+        else:
+            engine = ewr.EngineWrapper(
+                args.engine, persistent=True, timeout=args.timeout, cache=cache
+            )
+
+        with engine:
+            return run_worker(engine, args.address)
+
+    n_failed = 0
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max(args.jobs, 1)) as executor:
+            workers = [executor.submit(run) for _ in range(max(args.jobs, 1))]
+
+            for n, worker in enumerate(workers, 1):
+                try:
+                    print(f"Worker {n}: {worker.result()} jobs run")
+                except (OSError, ewr.EngineError) as e:
+                    print(f"Worker {n}: Error: {e}")
+                    n_failed += 1
+    finally:
+        if cache is not None:
+            cache.close()
+
+    return 1 if n_failed else 0
+
+
+def main():
+    """Runs a coordinator or workers, depending on the command given."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = commands.add_parser(
+        "serve", help="split a perft run into jobs and serve them to workers"
+    )
+    serve_parser.add_argument("depth", type=int, help="depth of the perft run")
+    serve_parser.add_argument(
+        "--fen", default=cs.START_POS, help="position to run perft on"
+    )
+    serve_parser.add_argument(
+        "--moves", nargs="+", metavar="MOVE", help="moves to make from the position"
+    )
+    serve_parser.add_argument(
+        "-a",
+        "--address",
+        default=cs.DISTRIBUTED_ADDRESS,
+        help="address to listen on, given as HOST:PORT or unix:PATH",
+    )
+    serve_parser.add_argument(
+        "--split",
+        type=int,
+        default=2,
+        help="number of plies below the position at which the tree is split into jobs",
+    )
+    serve_parser.add_argument(
+        "--lease",
+        type=float,
+        default=cs.DISTRIBUTED_LEASE,
+        help="seconds without a message from a worker after which its job is "
+        "given to another worker",
+    )
+    serve_parser.add_argument(
+        "--attempts",
+        type=int,
+        default=cs.DISTRIBUTED_MAX_ATTEMPTS,
+        help="number of times a job is tried before the run is abandoned",
+    )
+    serve_parser.add_argument(
+        "--local",
+        type=int,
+        default=0,
+        metavar="N",
+        help="also start N workers on this machine, running --engine",
+    )
+    serve_parser.add_argument(
+        "--engine",
+        default="builtin",
+        help="engine run by the workers started with --local",
+    )
+    serve_parser.add_argument(
+        "-t",
+        "--timeout",
+        type=float,
+        help="seconds allowed for each job run by the workers started with --local",
+    )
+
+    work_parser = commands.add_parser("work", help="run jobs served by a coordinator")
+    work_parser.add_argument(
+        "engine",
+        help="path to the engine executable, or builtin to use the built-in move "
+        "generator",
+    )
+    work_parser.add_argument(
+        "address",
+        nargs="?",
+        default=cs.DISTRIBUTED_ADDRESS,
+        help="address of the coordinator, given as HOST:PORT or unix:PATH",
+    )
+    work_parser.add_argument(
+        "-j", "--jobs", type=int, default=1, help="number of engine instances to run"
+    )
+    work_parser.add_argument(
+        "-t", "--timeout", type=float, help="seconds allowed for each job"
+    )
+    work_parser.add_argument(
+        "--hash",
+        type=int,
+        default=64,
+        help="size in MB of the built-in move generator's perft table",
+    )
+    work_parser.add_argument(
+        "--no-cache", action="store_true", help="don't use stored perft results"
+    )
+    work_parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=256,
+        help="maximum size of the perft result cache in MB",
+    )
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        return serve(args)
+
+    return work(args)
+
+
+if __name__ == "__main__":
+    try:
+        sys.exit(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,121 @@
+"""Module providing a record of the divide results found while walking the game tree."""
+
+import json
+
+import perft_cache as pc
+
+
+ENGINE = 0
+REFERENCE = 1
+
+
+class DivideTree:
+    """Class storing the divide results of both engines, keyed by the path of
+    moves from a root position.
+
+    The engine's results are stored for each path, so that a bug which only
+    appears after a particular move order isn't hidden by the result of
+    another path. The reference's results are stored for each position, so
+    they are shared between paths which transpose into each other."""
+
+    def __init__(self):
+        self.paths = {}
+        self.engine = {}
+        self.reference = {}
+
+    def position(self, fen, moves):
+        """Returns the path of moves from a root position, and the key of the
+        position it reaches."""
+        path = (fen, tuple(moves))
+        key = self.paths.get(path)
+
+        if key is None:
+            key = pc.position_key(fen, moves)
+
+        return path, key
+
+    def get(self, fen, moves, depth):
+        """Returns the stored outcomes of both engines for a path at a given
+        depth, with None for an engine that has no result."""
+        path, key = self.position(fen, moves)
+
+        return [
+            self.engine.get(path, {}).get(depth),
+            self.reference.get(key, {}).get(depth),
+        ]
+
+    def put(self, fen, moves, depth, side, outcome):
+        """Stores the outcome of a perft run by one of the engines."""
+        path, key = self.position(fen, moves)
+        self.paths[path] = key
+
+        if side == ENGINE:
+            self.engine.setdefault(path, {})[depth] = outcome
+        else:
+            self.reference.setdefault(key, {})[depth] = outcome
+
+    def child_totals(self, fen, moves, depth):
+        """Returns the totals of both engines for the last move in a path at a
+        given depth, taken from the divide results of its parent at depth + 1."""
+        if not moves:
+            return [None, None]
+
+        outcomes = self.get(fen, moves[:-1], depth + 1)
+
+        return [
+            None if outcome is None else outcome[0].get(moves[-1])
+            for outcome in outcomes
+        ]
+
+    def save(self, file_path, fen, moves, names):
+        """Writes every stored result to a JSON file, along with the current
+        path and the names of the engines."""
+        nodes = []
+
+        for (root, path), key in self.paths.items():
+            e_outcomes = self.engine.get((root, path), {})
+            ref_outcomes = self.reference.get(key, {})
+
+            for depth in sorted(e_outcomes.keys() | ref_outcomes.keys()):
+                entry = {"fen": root, "moves": list(path), "depth": depth}
+
+                if depth in e_outcomes:
+                    entry["engine"] = e_outcomes[depth][0]
+                if depth in ref_outcomes:
+                    entry["reference"] = ref_outcomes[depth][0]
+
+                nodes.append(entry)
+
+        with open(file_path, "w", encoding="UTF-8") as f:
+            json.dump(
+                {
+                    "fen": fen,
+                    "moves": list(moves),
+                    "engine": names[ENGINE],
+                    "reference": names[REFERENCE],
+                    "nodes": nodes,
+                },
+                f,
+                indent=1,
+            )
+
+    def load(self, file_path):
+        """Reads the reference's results from a JSON file written by save, and
+        returns the path that was current when it was saved.
+
+        The engine's results are not loaded, so that it is run again."""
+        with open(file_path, "r", encoding="UTF-8") as f:
+            data = json.load(f)
+
+        for entry in data["nodes"]:
+            if "reference" in entry:
+                results = entry["reference"]
+                self.put(
+                    entry["fen"],
+                    entry["moves"],
+                    entry["depth"],
+                    REFERENCE,
+                    (results, sum(results.values())),
+                )
+
+        return data["fen"], data["moves"]
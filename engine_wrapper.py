@@ -1,21 +1,502 @@
 """Module providing functions to communicate with a UCI engine."""
 
+import concurrent.futures
+import os
+import queue
 import re
 import subprocess
+import threading
 import time
 
 import constants as cs
+import perft_cache as pc
 
 
-class EngineWrapper:
-    """Class providing methods to control the engine process."""
+class EngineError(Exception):
+    """Raised when the engine process exits unexpectedly."""
+
+
+class EngineTimeoutError(EngineError):
+    """Raised when the engine does not respond in time."""
+
+
+class PerftStopped(EngineError):
+    """Raised when a run is stopped with a StopToken."""
+
+
+PERFT_LINE_PATTERN = re.compile(cs.PERFT_LINE_REGEX)
+PERFT_TOTAL_PATTERN = re.compile(cs.PERFT_TOTAL_REGEX)
+
+
+def parse_perft_output(lines):
+    """Parses perft output as it is read, yielding (move, result) for each move
+    and (None, total) for each total.
+
+    A total is a number on its own line, with any label before a colon, such
+    as "Nodes searched: 20" or "Perft 1: 20". Only the first total after a
+    list of moves is yielded, so an engine which prints its total twice, or
+    follows it with lines such as "Time: 5", gives one total per perft
+    command. A total of 0 with no moves before it is the total of a position
+    with no legal moves. Totals are then ignored until the next move or
+    "readyok" line, which can be used to separate the output of commands."""
+    n_moves = 0
+    has_total = False
+
+    for l in lines:
+        if l.startswith("readyok"):
+            n_moves = 0
+            has_total = False
+            continue
+
+        match = PERFT_LINE_PATTERN.match(l)
+
+        if match:
+            n_moves += 1
+            has_total = False
+            yield match.group(1), int(match.group(2))
+            continue
+
+        match = PERFT_TOTAL_PATTERN.fullmatch(l)
+
+        if match and not has_total and (n_moves or int(match.group(1)) == 0):
+            n_moves = 0
+            has_total = True
+            yield None, int(match.group(1))
+
+
+def position_command(fen, moves=None):
+    """Returns the UCI command which sets up a position."""
+    command = f"position fen {fen}"
+
+    if moves:
+        command += " moves " + " ".join(moves)
+
+    return command
+
+
+def span_name(command):
+    """Returns the last line of a command without "go", to name its span in a
+    profile, such as "perft 5"."""
+    return command.rsplit("\n", 1)[-1].removeprefix("go ")
+
+
+def parse_info_line(line):
+    """Extracts the search statistics from an info line."""
+    tokens = line.split()
+    info = {}
+    i = 1
+
+    while i < len(tokens):
+        tok = tokens[i]
+
+        if tok == "pv":
+            info["pv"] = tokens[i + 1 :]
+            break
+
+        if tok == "score":
+            info["score"] = " ".join(tokens[i + 1 : i + 3])
+            i += 3
+        elif tok in ("depth", "seldepth", "nodes", "nps", "time"):
+            value = tokens[i + 1] if i + 1 < len(tokens) else ""
+            if value.isdigit():
+                info[tok] = int(value)
+            i += 2
+        else:
+            i += 1
+
+    return info
+
+
+def peak_memory(pid):
+    """Returns the peak resident memory of a process in bytes, or None if it
+    can't be read. Only Linux is supported."""
+    try:
+        with open(f"/proc/{pid}/status", "r", encoding="UTF-8") as f:
+            for l in f:
+                if l.startswith("VmHWM:"):
+                    return int(l.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+
+    return None
+
+
+def cpu_time(pid):
+    """Returns the user and system CPU time used by a process in seconds, or
+    None if it can't be read. Only Linux is supported."""
+    try:
+        with open(f"/proc/{pid}/stat", "r", encoding="UTF-8") as f:
+            # the fields after the command name, which may contain spaces
+            fields = f.read().rpartition(")")[2].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def reset_peak_memory(pid):
+    """Resets the peak resident memory of a process to its current value."""
+    try:
+        with open(f"/proc/{pid}/clear_refs", "w", encoding="UTF-8") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+class Deadline:
+    """Class recording when a watched process should be killed."""
+
+    __slots__ = ("proc", "time", "expired")
+
+    def __init__(self, proc, timeout):
+        self.proc = proc
+        self.time = time.monotonic() + timeout
+        self.expired = False
+
+
+class Watchdog:
+    """Class running a thread which kills engine processes that are still busy
+    after their deadline.
+
+    This catches engines which stop reading their input as well as ones which
+    stop writing output, since the thread doesn't depend on the engine."""
+
+    def __init__(self):
+        self.deadlines = set()
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def watch(self, proc, timeout):
+        """Kills proc after timeout seconds unless the returned deadline is
+        cancelled first."""
+        deadline = Deadline(proc, timeout)
+
+        with self.cond:
+            self.deadlines.add(deadline)
+
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+            self.cond.notify()
+
+        return deadline
+
+    def cancel(self, deadline):
+        """Stops watching a process."""
+        with self.cond:
+            self.deadlines.discard(deadline)
+
+    def _run(self):
+        """Kills each process whose deadline has passed."""
+        with self.cond:
+            while True:
+                now = time.monotonic()
+
+                for deadline in [d for d in self.deadlines if d.time <= now]:
+                    deadline.expired = True
+                    deadline.proc.kill()
+                    self.deadlines.discard(deadline)
+
+                next_time = min((d.time for d in self.deadlines), default=None)
+                self.cond.wait(None if next_time is None else next_time - now)
+
+
+WATCHDOG = Watchdog()
+
+
+class StopToken:
+    """Class used to stop runs from another thread.
+
+    Engine processes running a command for the token are killed when it is
+    stopped, so that runs end straight away even if the engine ignores the
+    UCI stop command, as most do during perft. The run then restarts the
+    engine and raises PerftStopped."""
+
+    def __init__(self):
+        self.stopped = False
+        self.procs = set()
+        self.lock = threading.Lock()
+
+    def check(self):
+        """Raises PerftStopped if the token has been stopped."""
+        if self.stopped:
+            raise PerftStopped("the run was stopped")
+
+    def add(self, proc):
+        """Kills proc if the token is stopped while it is running a command."""
+        with self.lock:
+            self.procs.add(proc)
 
-    def __init__(self, engine_exec):
+            if self.stopped:
+                proc.kill()
+
+    def discard(self, proc):
+        """Stops watching a process."""
+        with self.lock:
+            self.procs.discard(proc)
+
+    def stop(self):
+        """Stops every run using the token."""
+        with self.lock:
+            self.stopped = True
+
+            for proc in self.procs:
+                proc.kill()
+
+
+class EngineSession:
+    """Class managing a long-lived engine process.
+
+    If a Profiler is given, the time taken to start the process and to
+    perform the UCI handshake is recorded in it."""
+
+    def __init__(
+        self, engine_exec, timeout=None, options=None, cpu=None, profiler=None
+    ):
         self.exec_name = engine_exec
-        self.name = self.get_name()
+        self.timeout = timeout
+        self.options = options or {}
+        self.cpu = cpu
+        self.profiler = profiler
+        self.name = ""
+        self.proc = None
+        self.lines = None
+        self.cpu_used = 0.0
+
+    def start(self):
+        """Launches the engine and performs the UCI handshake."""
+        start = time.perf_counter()
+        self.proc = subprocess.Popen(
+            [self.exec_name],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+            bufsize=1,
+        )
+        self.lines = queue.Queue()
+
+        if self.profiler is not None:
+            self.profiler.measure("spawn", start)
+
+        if self.cpu is not None and hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(self.proc.pid, {self.cpu})
+
+        threading.Thread(
+            target=EngineSession._read_output,
+            args=(self.proc.stdout, self.lines),
+            daemon=True,
+        ).start()
+
+        timeout = self.timeout or cs.ENGINE_START_TIMEOUT
+        start = time.perf_counter()
+
+        try:
+            self.send("uci")
+            for l in self.read_until("uciok", timeout):
+                if re.match(r"id name", l):
+                    self.name = " ".join(l.split(" ")[2:])
+
+            for name, value in self.options.items():
+                self.send(f"setoption name {name} value {value}")
+
+            self.sync(timeout)
+        except EngineError:
+            self.close()
+            raise
+
+        if self.profiler is not None:
+            self.profiler.measure("handshake", start)
+
+    @staticmethod
+    def _read_output(stream, lines):
+        """Forwards lines written by the engine to a queue."""
+        try:
+            for l in stream:
+                lines.put(l.rstrip("\r\n"))
+        except (OSError, ValueError):
+            pass
+
+        lines.put(None)
+
+    def is_alive(self):
+        """Returns whether the engine process is running."""
+        return self.proc is not None and self.proc.poll() is None
+
+    def send(self, command):
+        """Writes a command to the engine."""
+        if self.proc is None:
+            raise EngineError(f"{self.exec_name} is not running")
+
+        try:
+            self.proc.stdin.write(command + "\n")
+            self.proc.stdin.flush()
+        except (BrokenPipeError, OSError) as e:
+            raise EngineError(f"{self.exec_name} exited unexpectedly") from e
+
+    def iter_until(self, prefix, timeout=None, count=1):
+        """Yields lines of engine output as they are written, up to and including
+        the count-th line with a given prefix."""
+        if timeout is None:
+            timeout = self.timeout
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            remaining = None
+            if deadline is not None:
+                remaining = max(deadline - time.monotonic(), 0)
+
+            try:
+                l = self.lines.get(timeout=remaining)
+            except queue.Empty as e:
+                raise EngineTimeoutError(
+                    f"{self.exec_name} did not respond within {timeout}s"
+                ) from e
+
+            if l is None:
+                raise EngineError(f"{self.exec_name} exited unexpectedly")
+
+            yield l
+
+            if l.startswith(prefix):
+                count -= 1
+                if not count:
+                    return
+
+    def read_until(self, prefix, timeout=None):
+        """Returns the engine output up to and including a line with a given prefix."""
+        return list(self.iter_until(prefix, timeout))
+
+    def sync(self, timeout=None):
+        """Waits for the engine to finish processing, returning its output."""
+        self.send("isready")
+        return self.read_until("readyok", timeout)[:-1]
+
+    def cpu_time(self):
+        """Returns the CPU time used by every process the session has run, or
+        None if it can't be read."""
+        if self.proc is None:
+            return self.cpu_used
+
+        used = cpu_time(self.proc.pid)
+        return None if used is None else self.cpu_used + used
+
+    def restart(self):
+        """Kills the engine process and starts a new one."""
+        self.close()
+        self.start()
+
+    def close(self):
+        """Asks the engine to quit, killing it if it does not exit."""
+        if self.proc is None:
+            return
+
+        proc = self.proc
+        self.proc = None
+        self.cpu_used += cpu_time(proc.pid) or 0
+
+        try:
+            proc.stdin.write("quit\n")
+            proc.stdin.close()
+        except (BrokenPipeError, OSError):
+            pass
+
+        try:
+            proc.wait(timeout=1)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+        proc.stdout.close()
+
+
+class EngineWrapper:
+    """Class providing methods to control the engine process.
+
+    If a Profiler is given, the timings of every command sent to the engine
+    are recorded in it. If exact_keys is True, results are cached under the
+    FEN and moves exactly as given rather than under the position they reach,
+    which should be used for an engine under test."""
+
+    def __init__(
+        self,
+        engine_exec,
+        persistent=False,
+        timeout=None,
+        cache=None,
+        options=None,
+        cpu=None,
+        profiler=None,
+        exact_keys=False,
+    ):
+        self.exec_name = engine_exec
+        self.options = options
+        self.cpu = cpu
+        self.profiler = profiler
+        self.session = None
+
+        if persistent:
+            self.session = EngineSession(engine_exec, timeout, options, cpu, profiler)
+            self.session.start()
+            self.name = self.session.name
+        else:
+            self.name = self.get_name()
+
+        self.cache = cache
+        self.cache_id = None
+        self.exact_keys = exact_keys
+
+        if cache is not None:
+            self.cache_id = pc.engine_id(self.name, engine_exec)
+
+            # keep exact results apart from those shared between transpositions
+            if exact_keys:
+                self.cache_id += ":exact"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Shuts down the engine session, if there is one."""
+        if self.session is not None:
+            self.session.close()
+
+    def peak_memory(self):
+        """Returns the peak resident memory of the engine session in bytes, or
+        None if it is unknown."""
+        if self.session is None or self.session.proc is None:
+            return None
+
+        return peak_memory(self.session.proc.pid)
+
+    def cpu_time(self):
+        """Returns the CPU time used by the engine session in seconds, or None
+        if it is unknown."""
+        if self.session is None:
+            return None
+
+        return self.session.cpu_time()
+
+    def reset_peak_memory(self):
+        """Resets the peak resident memory of the engine session."""
+        if self.session is not None and self.session.proc is not None:
+            reset_peak_memory(self.session.proc.pid)
+
+    def cache_key(self, fen, moves=None):
+        """Returns the key of a position in the cache."""
+        if self.exact_keys:
+            return pc.exact_key(fen, moves)
+
+        return pc.position_key(fen, moves)
 
     def get_name(self):
         """Gets the name of the engine, if it is reported."""
+        if self.session is not None:
+            return self.session.name
+
         with subprocess.Popen(
             [self.exec_name], stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True
         ) as proc:
@@ -26,107 +507,513 @@ class EngineWrapper:
 
         return ""
 
-    def perft(self, depth, fen=cs.START_POS, moves=None):
-        """Runs the perft command and returns the result."""
-        if depth < 1:
-            return {}, 0
-
-        command = f"position fen {fen}"
+    def iter_output(self, command, timeout=None, stop=None, n_ready=1):
+        """Sends commands to the engine and yields the lines of output they
+        produce as they are read.
 
-        if moves:
-            command += " moves " + " ".join(moves)
+        If the command contains isready commands of its own, n_ready is one
+        more than their number, and the "readyok" lines they produce are
+        yielded so that the output of each part can be told apart.
 
-        command += f"\ngo perft {depth}\nquit"
+        In session mode, the engine is restarted if it crashes or hangs, so
+        that the session can still be used after the error is raised. The
+        output must be read to the end to keep the session in sync. If stop
+        is given, the run can be ended early with its StopToken."""
+        if stop is not None:
+            stop.check()
 
-        with subprocess.Popen(
-            [self.exec_name], stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True
-        ) as proc:
-            output = proc.communicate(command)[0]
-            lines = output.split("\n")
+        if self.session is None:
+            yield from self.iter_process_output(command, timeout, stop)
+            return
 
-            tokens = []
-            for l in lines:
-                tokens.extend(l.split())
+        deadline = None
+        proc = None
 
-            i = 0
-            while True:
-                tok = tokens[i]
-                if re.match(cs.MOVE_REGEX_LAN, tok):
-                    break
-                i += 1
+        try:
+            if not self.session.is_alive():
+                self.session.restart()
 
-            tokens = tokens[i:]
-            results = []
+            proc = self.session.proc
 
-            for tok in tokens:
-                if re.match(cs.MOVE_REGEX_LAN, tok):
-                    results.append(tok.replace(":", ""))
-                elif tok.isdigit():
-                    results.append(int(tok))
+            if stop is not None:
+                stop.add(proc)
 
-            total = results.pop()
-            perft_results = {}
+            if timeout is not None:
+                deadline = WATCHDOG.watch(proc, timeout)
 
-            i = 0
-            while i < len(results):
-                perft_results[results[i]] = results[i + 1]
-                i += 2
+            start = time.perf_counter()
+            self.session.send(command + "\nisready")
+            lines = self.session.iter_until("readyok", timeout, n_ready)
 
-            return perft_results, total
+            if self.profiler is not None:
+                lines = self.profiler.profile_lines(span_name(command), lines, start)
 
-    def get_perft_totals(self, depths, fen=cs.START_POS):
-        """Returns the perft results up to a given depth."""
-        if not depths:
-            return []
-
-        command = f"position fen {fen}\n"
-
-        for d in depths:
-            command += f"go perft {d}\n"
-
-        command += "quit"
+            for l in lines:
+                if not l.startswith("readyok"):
+                    yield l
+                elif n_ready > 1:
+                    n_ready -= 1
+                    yield l
+        except EngineError as e:
+            if self.session.proc is not None:
+                self.session.restart()
+
+            if stop is not None and stop.stopped:
+                raise PerftStopped(f"{self.exec_name} was stopped") from e
+
+            if deadline is not None and deadline.expired:
+                raise EngineTimeoutError(
+                    f"{self.exec_name} did not respond within {timeout}s"
+                ) from e
+            raise
+        finally:
+            if deadline is not None:
+                WATCHDOG.cancel(deadline)
+
+            if stop is not None and proc is not None:
+                stop.discard(proc)
+
+    def iter_process_output(self, command, timeout=None, stop=None):
+        """Runs commands on a new engine process and yields the lines of output
+        they produce as they are read."""
+        start = time.perf_counter()
 
         with subprocess.Popen(
             [self.exec_name], stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True
         ) as proc:
-            output = proc.communicate(command)[0]
-            lines = output.split("\n")
-            totals = {}
-            i = 0
+            if self.profiler is not None:
+                self.profiler.measure("spawn", start)
+
+            deadline = None
+            if timeout is not None:
+                deadline = WATCHDOG.watch(proc, timeout)
+
+            if stop is not None:
+                stop.add(proc)
+
+            try:
+                start = time.perf_counter()
+                proc.stdin.write(command + "\nquit\n")
+                proc.stdin.close()
+                lines = (l.rstrip("\r\n") for l in proc.stdout)
+
+                if self.profiler is not None:
+                    lines = self.profiler.profile_lines(
+                        span_name(command), lines, start
+                    )
+
+                for l in lines:
+                    yield l
+            except OSError as e:
+                raise EngineError(f"{self.exec_name} exited unexpectedly") from e
+            finally:
+                if deadline is not None:
+                    WATCHDOG.cancel(deadline)
+                if stop is not None:
+                    stop.discard(proc)
+                proc.kill()
+
+        if stop is not None and stop.stopped:
+            raise PerftStopped(f"{self.exec_name} was stopped")
+
+        if deadline is not None and deadline.expired:
+            raise EngineTimeoutError(
+                f"{self.exec_name} did not respond within {timeout}s"
+            )
+
+    def perft(
+        self,
+        depth,
+        fen=cs.START_POS,
+        moves=None,
+        timeout=None,
+        on_result=None,
+        stop=None,
+    ):
+        """Runs the perft command and returns the result.
+
+        If on_result is given, it is called with each move and its result as
+        soon as the engine reports them. Results are looked up in the cache
+        first, if there is one. If stop is given, the run can be ended early
+        with its StopToken."""
+        if depth < 1:
+            return {}, 0
 
-            for l in lines:
-                if re.match(cs.MOVE_REGEX_LAN, l):
-                    continue
+        if self.cache is None:
+            return self.run_perft(depth, fen, moves, timeout, on_result, stop)
+
+        key = self.cache_key(fen, moves)
+        cached = self.cache.get(self.cache_id, key, depth)
+
+        if cached is not None:
+            if on_result is not None:
+                for mstr, res in cached[0].items():
+                    on_result(mstr, res)
+            return cached
+
+        perft_results, total = self.run_perft(
+            depth, fen, moves, timeout, on_result, stop
+        )
+        self.cache.put(self.cache_id, key, depth, total, perft_results)
+
+        return perft_results, total
+
+    def run_perft(self, depth, fen, moves, timeout, on_result, stop=None):
+        """Runs the perft command on the engine and returns the result."""
+        command = position_command(fen, moves) + f"\ngo perft {depth}"
+        output = self.iter_output(command, timeout, stop)
+
+        perft_results = {}
+        total = None
+
+        for mstr, res in parse_perft_output(output):
+            if mstr is None:
+                if total is None:
+                    total = res
+                continue
+
+            perft_results[mstr] = res
+
+            if on_result is not None:
+                on_result(mstr, res)
+
+        if total is None:
+            raise EngineError(f"{self.exec_name} did not report a perft total")
+
+        return perft_results, total
+
+    def perft_batch(self, jobs, timeout=None):
+        """Runs perft on a list of (fen, moves, depth) jobs and returns the
+        result of each, in the same form as perft.
+
+        Jobs which aren't in the cache are sent to the engine together, so
+        that there is one round trip for many positions instead of one each.
+        The timeout applies to each write of up to PERFT_PIPELINE_SIZE jobs.
+        Each result is cached as soon as it is read, so if the engine fails
+        partway through, the jobs it finished aren't run again."""
+        outcomes = [None] * len(jobs)
+        pending = []
+
+        for i, (fen, moves, depth) in enumerate(jobs):
+            if depth < 1:
+                outcomes[i] = ({}, 0)
+                continue
+
+            if self.cache is not None:
+                key = self.cache_key(fen, moves)
+                outcomes[i] = self.cache.get(self.cache_id, key, depth)
+
+            if outcomes[i] is None:
+                pending.append(i)
+
+        # keep each write well within the pipe buffer, since the engine's
+        # output isn't read until the whole command has been written
+        for j in range(0, len(pending), cs.PERFT_PIPELINE_SIZE):
+            chunk = pending[j : j + cs.PERFT_PIPELINE_SIZE]
+            results = self.run_perft_batch([jobs[i] for i in chunk], timeout)
+
+            # results comes first so that it is read to the end, keeping the
+            # session in sync
+            for (perft_results, total), i in zip(results, chunk):
+                outcomes[i] = perft_results, total
+
+                if self.cache is not None:
+                    fen, moves, depth = jobs[i]
+                    key = self.cache_key(fen, moves)
+                    self.cache.put(self.cache_id, key, depth, total, perft_results)
+
+        return outcomes
+
+    def run_perft_batch(self, jobs, timeout=None):
+        """Sends the perft commands for a list of (fen, moves, depth) jobs in a
+        single write, and yields the result of each job as its total is read.
+
+        The jobs are separated with isready, so that a total printed twice for
+        a position with no legal moves isn't taken as the next job's total."""
+        command = "\nisready\n".join(
+            position_command(fen, moves) + f"\ngo perft {depth}"
+            for fen, moves, depth in jobs
+        )
+        output = self.iter_output(command, timeout, n_ready=len(jobs))
+
+        perft_results = {}
+        n_done = 0
+
+        for mstr, res in parse_perft_output(output):
+            if mstr is not None:
+                perft_results[mstr] = res
+            elif n_done < len(jobs):
+                yield perft_results, res
+                perft_results = {}
+                n_done += 1
+
+        if n_done < len(jobs):
+            raise EngineError(
+                f"{self.exec_name} reported {n_done} perft totals for {len(jobs)} jobs"
+            )
+
+    def get_perft_totals(self, depths, fen=cs.START_POS, timeout=None):
+        """Returns the perft results up to a given depth."""
+        if not depths:
+            return []
 
-                tokens = l.split(":")
+        if self.cache is None:
+            return self.run_perft_totals(depths, fen, timeout)
 
-                if tokens[-1].strip().isdigit():
-                    totals[depths[i]] = int(tokens[-1])
-                    i += 1
+        key = self.cache_key(fen)
+        totals = {}
 
-            return totals
+        for d in depths:
+            cached = self.cache.get(self.cache_id, key, d, divide=False)
+            if cached is not None:
+                totals[d] = cached[1]
 
-    def get_best_move(self, fen=cs.START_POS, t=10000):
-        """Returns the best move found by the engine for the current position."""
+        depths = [d for d in depths if d not in totals]
 
-        with subprocess.Popen(
-            [self.exec_name], stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True
-        ) as proc:
-            proc.stdin.write(f"position fen {fen}\ngo movetime {t}\n")
-            proc.stdin.flush()
-            time.sleep((t / 1000) + 1)
+        if depths:
+            for d, total in self.run_perft_totals(depths, fen, timeout).items():
+                self.cache.put(self.cache_id, key, d, total)
+                totals[d] = total
 
-            proc.stdin.write("isready\nquit\n")
-            proc.stdin.flush()
-            lines = []
+        return totals
 
-            while True:
-                text = proc.stdout.readline().strip()
+    def run_perft_totals(self, depths, fen, timeout=None):
+        """Runs the perft command at each depth on the engine and returns the totals."""
+        # separate the output of each depth, so that a position with no legal
+        # moves gives one total per depth
+        command = position_command(fen) + "\n" + "\nisready\n".join(
+            f"go perft {d}" for d in depths
+        )
+        output = self.iter_output(command, timeout, n_ready=len(depths))
+        totals = {}
 
-                if text == "readyok":
-                    break
+        for mstr, res in parse_perft_output(output):
+            if mstr is None and len(totals) < len(depths):
+                totals[depths[len(totals)]] = res
 
-                if text != "":
-                    lines.append(text)
+        if len(totals) < len(depths):
+            raise EngineError(f"{self.exec_name} did not report a perft total")
 
-            return lines[-1].split(" ")[1]
+        return totals
+
+    def get_best_move(self, fen=cs.START_POS, t=10000):
+        """Returns the best move found by the engine for the current position,
+        and the last info line reported during the search."""
+        if self.session is None:
+            session = EngineSession(
+                self.exec_name,
+                options=self.options,
+                cpu=self.cpu,
+                profiler=self.profiler,
+            )
+            session.start()
+
+            try:
+                return EngineWrapper.run_search(session, fen, t)
+            finally:
+                session.close()
+
+        try:
+            if not self.session.is_alive():
+                self.session.restart()
+
+            return EngineWrapper.run_search(self.session, fen, t)
+        except EngineError:
+            if self.session.proc is not None:
+                self.session.restart()
+            raise
+
+    @staticmethod
+    def run_search(session, fen, t):
+        """Searches a position for a given time, returning as soon as the engine
+        reports its best move.
+
+        If the engine overruns the time, it is sent the stop command, and an
+        EngineTimeoutError is raised if it still doesn't reply."""
+        start = time.perf_counter()
+        session.send(f"ucinewgame\nposition fen {fen}\ngo movetime {t}")
+
+        timeout = t / 1000 + cs.BESTMOVE_GRACE_PERIOD
+        stopped = False
+        info = {}
+
+        while True:
+            lines = session.iter_until("bestmove", timeout)
+
+            if session.profiler is not None:
+                lines = session.profiler.profile_lines("search", lines, start)
+
+            try:
+                for l in lines:
+                    if l.startswith("info") and " score " in l:
+                        info = parse_info_line(l)
+                    elif l.startswith("bestmove"):
+                        return l.split()[1], info
+            except EngineTimeoutError:
+                if stopped:
+                    raise
+
+                session.send("stop")
+                stopped = True
+                timeout = cs.BESTMOVE_GRACE_PERIOD
+
+
+class EnginePool:
+    """Class running commands on several instances of an engine at once."""
+
+    def __init__(
+        self,
+        engine_exec,
+        size,
+        timeout=None,
+        cache=None,
+        options=None,
+        pin=False,
+        profiler=None,
+        exact_keys=False,
+    ):
+        """Starts size instances of the engine, setting the given UCI options
+        on each. If pin is True, each instance is restricted to its own CPU,
+        and exact_keys is passed on to each EngineWrapper."""
+        self.exec_name = engine_exec
+        self.cache = cache
+        self.executor = concurrent.futures.ThreadPoolExecutor(size)
+        self.idle = queue.SimpleQueue()
+        self.wrappers = []
+
+        cpus = [None] * size
+        if pin and hasattr(os, "sched_getaffinity"):
+            available = sorted(os.sched_getaffinity(0))
+            cpus = [available[i % len(available)] for i in range(size)]
+
+        starting = [
+            self.executor.submit(
+                EngineWrapper,
+                engine_exec,
+                True,
+                timeout,
+                cache,
+                options,
+                cpu,
+                profiler,
+                exact_keys,
+            )
+            for cpu in cpus
+        ]
+        errors = []
+
+        for job in starting:
+            try:
+                self.wrappers.append(job.result())
+            except (EngineError, OSError) as e:
+                errors.append(e)
+
+        if errors:
+            self.close()
+            raise errors[0]
+
+        for e_wrapper in self.wrappers:
+            self.idle.put(e_wrapper)
+
+        self.name = self.wrappers[0].name
+        self.cache_id = self.wrappers[0].cache_id
+        self.cache_key = self.wrappers[0].cache_key
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def cpu_time(self):
+        """Returns the CPU time used by every engine in the pool in seconds, or
+        None if it is unknown."""
+        times = [e_wrapper.cpu_time() for e_wrapper in self.wrappers]
+        return None if None in times else sum(times)
+
+    def close(self):
+        """Cancels any pending jobs and shuts down every engine in the pool."""
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+        for e_wrapper in self.wrappers:
+            e_wrapper.close()
+
+    def _run_job(self, fn, args):
+        """Calls a function with an idle engine from the pool."""
+        e_wrapper = self.idle.get()
+        try:
+            return fn(e_wrapper, *args)
+        finally:
+            self.idle.put(e_wrapper)
+
+    def submit(self, fn, *args):
+        """Schedules fn(e_wrapper, *args) to run on the next idle engine."""
+        return self.executor.submit(self._run_job, fn, args)
+
+    def perft(
+        self,
+        depth,
+        fen=cs.START_POS,
+        moves=None,
+        timeout=None,
+        on_result=None,
+        stop=None,
+    ):
+        """Runs the perft command, searching the subtree of each root move on a
+        separate engine, and returns the result.
+
+        The timeout applies to the whole run rather than to each subtree, and
+        stopping the StopToken stops every subtree's run."""
+        if depth <= 1:
+            return self.submit(
+                EngineWrapper.perft, depth, fen, moves, timeout, on_result, stop
+            ).result()
+
+        moves = moves or []
+
+        if self.cache is not None:
+            key = self.cache_key(fen, moves)
+            cached = self.cache.get(self.cache_id, key, depth)
+
+            if cached is not None:
+                if on_result is not None:
+                    for mstr, res in cached[0].items():
+                        on_result(mstr, res)
+                return cached
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        def remaining():
+            if deadline is None:
+                return None
+            return max(deadline - time.monotonic(), 0)
+
+        def run_subtree(e_wrapper, m):
+            return e_wrapper.perft(
+                depth - 1, fen, moves + [m], remaining(), stop=stop
+            )[1]
+
+        root_moves = self.submit(
+            EngineWrapper.perft, 1, fen, moves, remaining(), None, stop
+        ).result()[0]
+
+        jobs = {self.submit(run_subtree, m): m for m in root_moves}
+        perft_results = {}
+
+        try:
+            for job in concurrent.futures.as_completed(jobs):
+                perft_results[jobs[job]] = job.result()
+                if on_result is not None:
+                    on_result(jobs[job], perft_results[jobs[job]])
+        except BaseException:
+            for job in jobs:
+                job.cancel()
+            raise
+
+        perft_results = {m: perft_results[m] for m in root_moves}
+        total = sum(perft_results.values())
+
+        if self.cache is not None:
+            self.cache.put(self.cache_id, key, depth, total, perft_results)
+
+        return perft_results, total
@@ -0,0 +1,174 @@
+"""Module providing readers which stream records from EPD files.
+
+Files written by normalise_epd.py, with one JSON record per line, are read in
+the same way as EPD files."""
+
+import collections
+import json
+import random
+import re
+
+import constants as cs
+
+
+FEN_PATTERN = re.compile(cs.FEN_REGEX)
+
+TestRecord = collections.namedtuple("TestRecord", ["fen", "best_moves", "test_id"])
+
+
+class PerftRecord:
+    """Class storing a position and its perft totals, which are indexed by depth."""
+
+    __slots__ = ("fen", "totals")
+
+    def __init__(self, fen, totals):
+        self.fen = fen
+        self.totals = totals
+
+    def __contains__(self, depth):
+        return 0 < depth <= len(self.totals) and self.totals[depth - 1] is not None
+
+    def __getitem__(self, depth):
+        if depth not in self:
+            raise KeyError(depth)
+        return self.totals[depth - 1]
+
+    def depths(self):
+        """Returns the depths with a stored total."""
+        return [d for d in range(1, len(self.totals) + 1) if d in self]
+
+
+def parse_shard(shard):
+    """Parses a shard given as "i/n", returning (i, n) with 1 <= i <= n."""
+    try:
+        i, n = (int(x) for x in shard.split("/"))
+    except ValueError as e:
+        raise ValueError(f"invalid shard {shard!r}, expected i/n") from e
+
+    if not 1 <= i <= n:
+        raise ValueError(f"invalid shard {shard!r}, expected 1 <= i <= n")
+
+    return i, n
+
+
+def select_lines(file_path, shard=None, sample=None, seed=0):
+    """Yields the non-empty lines of a file one at a time.
+
+    If shard is given as (i, n), only every nth line starting from the ith is
+    kept, so that n runs with different values of i share the file between
+    them. If sample is given, each kept line is then chosen with that
+    probability. The same seed always chooses the same lines."""
+    rng = random.Random(seed)
+    n = 0
+
+    with open(file_path, "r", encoding="UTF-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+
+            n += 1
+            if shard is not None and n % shard[1] != shard[0] % shard[1]:
+                continue
+
+            if sample is not None and rng.random() >= sample:
+                continue
+
+            yield line
+
+
+def parse_perft_line(line):
+    """Extracts a position and its perft totals from a line of the form
+    "FEN ;D1 20 ;D2 400", or from a line of a normalised JSONL file."""
+    if line.startswith("{"):
+        record = json.loads(line)
+        return PerftRecord(record["fen"], tuple(record.get("perft", ())))
+
+    fields = line.split(";")
+    totals = []
+
+    for field in fields[1:]:
+        if not field.strip():
+            continue
+
+        depth, result = field.split()
+        depth = int(depth[1:])
+
+        if depth > len(totals):
+            totals.extend([None] * (depth - len(totals)))
+        totals[depth - 1] = int(result)
+
+    return PerftRecord(fields[0].strip(), tuple(totals))
+
+
+def read_perft_records(file_path, shard=None, sample=None, seed=0):
+    """Yields a PerftRecord for each selected line of a perft EPD file."""
+    for line in select_lines(file_path, shard, sample, seed):
+        yield parse_perft_line(line)
+
+
+def parse_operations(line):
+    """Splits an EPD line into its position and its operations, or returns None
+    if the line doesn't start with a position.
+
+    Returns the fen and a dict mapping each opcode to its list of operands.
+    Move clocks are taken from the hmvc and fmvn opcodes, or from the two
+    numbers after the position, if either is present."""
+    if not FEN_PATTERN.match(line):
+        return None
+
+    fields = line.split(None, 4)
+    fen = " ".join(fields[:4])
+    rest = fields[4] if len(fields) > 4 else ""
+
+    hm_clk = 0
+    fm_num = 1
+    ops = {}
+
+    for i, op in enumerate(rest.split(";")):
+        tokens = op.split()
+
+        if i == 0 and tokens and tokens[0].isdigit():
+            hm_clk = int(tokens.pop(0))
+
+            if tokens and tokens[0].isdigit():
+                fm_num = int(tokens.pop(0))
+
+        if tokens:
+            ops[tokens[0]] = tokens[1:]
+
+    if (ops.get("hmvc") or [""])[0].isdigit():
+        hm_clk = int(ops["hmvc"][0])
+
+    if (ops.get("fmvn") or [""])[0].isdigit():
+        fm_num = int(ops["fmvn"][0])
+
+    return f"{fen} {hm_clk} {fm_num}", ops
+
+
+def parse_test_line(line):
+    """Extracts the fen, best move(s) and test id from a line, or returns None
+    if the line has no best move."""
+    if line.startswith("{"):
+        record = json.loads(line)
+        if not record.get("bm"):
+            return None
+        return TestRecord(record["fen"], record["bm"], record.get("id", ""))
+
+    parsed = parse_operations(line)
+    if parsed is None or not parsed[1].get("bm"):
+        return None
+
+    fen, ops = parsed
+    test_id = " ".join(ops.get("id", [])).replace('"', "")
+
+    return TestRecord(fen, ops["bm"], test_id)
+
+
+def read_tests(file_path, shard=None, sample=None, seed=0):
+    """Yields a TestRecord for each selected line of an EPD test file which has
+    a best move."""
+    for line in select_lines(file_path, shard, sample, seed):
+        test = parse_test_line(line)
+        if test is not None:
+            yield test
@@ -0,0 +1,622 @@
+"""Module providing a legal move generator used as a reference for perft results."""
+
+import array
+
+import board as bd
+import constants as cs
+
+
+PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING = range(6)
+
+FULL = (1 << 64) - 1
+FILE_A = 0x0101010101010101
+FILE_H = FILE_A << 7
+RANK_1 = 0xFF
+RANK_3 = RANK_1 << 16
+RANK_6 = RANK_1 << 40
+RANK_8 = RANK_1 << 56
+
+ROOK_DIRS = ((1, 0), (-1, 0), (0, 1), (0, -1))
+BISHOP_DIRS = ((1, 1), (1, -1), (-1, 1), (-1, -1))
+KNIGHT_STEPS = ((1, 2), (2, 1), (2, -1), (1, -2), (-1, -2), (-2, -1), (-2, 1), (-1, 2))
+KING_STEPS = ROOK_DIRS + BISHOP_DIRS
+
+
+def _ray_attacks(sq, occ, dirs):
+    """Calculates the squares attacked by a slider, stopping at blockers."""
+    attacks = 0
+
+    for df, dr in dirs:
+        f, r = sq % 8 + df, sq // 8 + dr
+
+        while 0 <= f < 8 and 0 <= r < 8:
+            attacks |= 1 << (r * 8 + f)
+            if occ >> (r * 8 + f) & 1:
+                break
+            f += df
+            r += dr
+
+    return attacks
+
+
+def _relevant_mask(sq, dirs):
+    """Returns the squares whose occupancy can block a slider on a square."""
+    mask = 0
+
+    for df, dr in dirs:
+        f, r = sq % 8 + df, sq // 8 + dr
+
+        while 0 <= f + df < 8 and 0 <= r + dr < 8:
+            mask |= 1 << (r * 8 + f)
+            f += df
+            r += dr
+
+    return mask
+
+
+def _step_attacks(sq, steps):
+    """Returns the squares reached from a square by a set of single steps."""
+    attacks = 0
+
+    for df, dr in steps:
+        f, r = sq % 8 + df, sq // 8 + dr
+        if 0 <= f < 8 and 0 <= r < 8:
+            attacks |= 1 << (r * 8 + f)
+
+    return attacks
+
+
+def _slider_table(dirs):
+    """Returns the masks and attack tables for a slider, indexed by the
+    occupancy of each square's relevant squares."""
+    masks = []
+    tables = []
+
+    for sq in range(64):
+        mask = _relevant_mask(sq, dirs)
+        table = {}
+        subset = 0
+
+        # enumerate every subset of the mask
+        while True:
+            table[subset] = _ray_attacks(sq, subset, dirs)
+            subset = (subset - mask) & mask
+            if not subset:
+                break
+
+        masks.append(mask)
+        tables.append(table)
+
+    return masks, tables
+
+
+KNIGHT_ATTACKS = [_step_attacks(sq, KNIGHT_STEPS) for sq in range(64)]
+KING_ATTACKS = [_step_attacks(sq, KING_STEPS) for sq in range(64)]
+PAWN_ATTACKS = (
+    [_step_attacks(sq, ((-1, 1), (1, 1))) for sq in range(64)],
+    [_step_attacks(sq, ((-1, -1), (1, -1))) for sq in range(64)],
+)
+
+ROOK_MASKS, ROOK_TABLES = _slider_table(ROOK_DIRS)
+BISHOP_MASKS, BISHOP_TABLES = _slider_table(BISHOP_DIRS)
+ROOK_RAYS = [_ray_attacks(sq, 0, ROOK_DIRS) for sq in range(64)]
+BISHOP_RAYS = [_ray_attacks(sq, 0, BISHOP_DIRS) for sq in range(64)]
+
+# squares strictly between two squares, and the whole line through them
+BETWEEN = [[0] * 64 for _ in range(64)]
+LINE = [[0] * 64 for _ in range(64)]
+
+for _a in range(64):
+    for _dirs, _rays in ((ROOK_DIRS, ROOK_RAYS), (BISHOP_DIRS, BISHOP_RAYS)):
+        for _b in range(64):
+            if _rays[_a] >> _b & 1:
+                BETWEEN[_a][_b] = _ray_attacks(_a, 1 << _b, _dirs) & _ray_attacks(
+                    _b, 1 << _a, _dirs
+                )
+                LINE[_a][_b] = (_rays[_a] & _rays[_b]) | (1 << _a) | (1 << _b)
+
+PIECE_INDEX = {p: i for i, p in enumerate("PNBRQKpnbrqk")}
+ZOBRIST_PIECES = [cs.ZOBRIST_PIECES[p] for p in PIECE_INDEX]
+PROMOTIONS = "nbrq"
+
+# castling rights kept when a piece moves to or from each square
+CASTLING_KEPT = [15 & ~cs.CASTLING_MASKS.get(sq, 0) for sq in range(64)]
+
+# castling right, king start, king destination, rook start, rook destination,
+# squares which must be empty and squares which must not be attacked
+CASTLES = (
+    (
+        (cs.WHITE_KINGSIDE, 4, 6, 7, 5, 0x60, (5, 6)),
+        (cs.WHITE_QUEENSIDE, 4, 2, 0, 3, 0x0E, (3, 2)),
+    ),
+    (
+        (cs.BLACK_KINGSIDE, 60, 62, 63, 61, 0x60 << 56, (61, 62)),
+        (cs.BLACK_QUEENSIDE, 60, 58, 56, 59, 0x0E << 56, (59, 58)),
+    ),
+)
+
+
+def rook_attacks(sq, occ):
+    """Returns the squares attacked by a rook."""
+    return ROOK_TABLES[sq][occ & ROOK_MASKS[sq]]
+
+
+def bishop_attacks(sq, occ):
+    """Returns the squares attacked by a bishop."""
+    return BISHOP_TABLES[sq][occ & BISHOP_MASKS[sq]]
+
+
+def move_to_str(move):
+    """Converts an encoded move to LAN."""
+    mstr = cs.SQUARES[move & 63] + cs.SQUARES[(move >> 6) & 63]
+
+    if move >> 12:
+        mstr += PROMOTIONS[(move >> 12) - 1]
+
+    return mstr
+
+
+class Position:
+    """A chess position stored as bitboards, used to generate legal moves."""
+
+    __slots__ = ("mailbox", "bbs", "occ", "side", "castling", "ep_square", "key")
+
+    def __init__(self, fen=cs.START_POS):
+        board = bd.Board()
+        board.update_board(fen)
+
+        self.mailbox = [PIECE_INDEX.get(p) for p in board.board.decode("ascii")]
+        self.bbs = [0] * 12
+        self.occ = [0, 0]
+
+        for sq, p in enumerate(self.mailbox):
+            if p is not None:
+                self.bbs[p] |= 1 << sq
+                self.occ[p // 6] |= 1 << sq
+
+        self.side = board.side
+        self.castling = board.castling
+        self.ep_square = board.ep_square
+        self.key = board.hash
+
+    def copy(self):
+        """Returns a copy of the position."""
+        pos = Position.__new__(Position)
+        pos.mailbox = self.mailbox[:]
+        pos.bbs = self.bbs[:]
+        pos.occ = self.occ[:]
+        pos.side = self.side
+        pos.castling = self.castling
+        pos.ep_square = self.ep_square
+        pos.key = self.key
+        return pos
+
+    def attackers(self, sq, side, occ):
+        """Returns the pieces of a side attacking a square."""
+        bbs = self.bbs
+        base = side * 6
+
+        return (
+            (KNIGHT_ATTACKS[sq] & bbs[base + KNIGHT])
+            | (KING_ATTACKS[sq] & bbs[base + KING])
+            | (PAWN_ATTACKS[side ^ 1][sq] & bbs[base + PAWN])
+            | (rook_attacks(sq, occ) & (bbs[base + ROOK] | bbs[base + QUEEN]))
+            | (bishop_attacks(sq, occ) & (bbs[base + BISHOP] | bbs[base + QUEEN]))
+        )
+
+    def make_move(self, move):
+        """Returns the position after making an encoded move."""
+        pos = self.copy()
+        mailbox, bbs, occ = pos.mailbox, pos.bbs, pos.occ
+        start, dest, promotion = move & 63, (move >> 6) & 63, move >> 12
+        us = self.side
+        start_bit, dest_bit = 1 << start, 1 << dest
+
+        piece = mailbox[start]
+        captured = mailbox[dest]
+        zobrist = ZOBRIST_PIECES
+        key = self.key ^ zobrist[piece][start] ^ zobrist[piece][dest]
+
+        if captured is not None:
+            bbs[captured] ^= dest_bit
+            occ[us ^ 1] ^= dest_bit
+            key ^= zobrist[captured][dest]
+
+        bbs[piece] ^= start_bit | dest_bit
+        occ[us] ^= start_bit | dest_bit
+        mailbox[start] = None
+        mailbox[dest] = piece
+        pos.ep_square = None
+
+        if piece % 6 == PAWN:
+            if dest == self.ep_square:
+                cap_sq = dest - 8 if us == cs.WHITE else dest + 8
+                bbs[(us ^ 1) * 6 + PAWN] ^= 1 << cap_sq
+                occ[us ^ 1] ^= 1 << cap_sq
+                mailbox[cap_sq] = None
+                key ^= zobrist[(us ^ 1) * 6 + PAWN][cap_sq]
+            elif promotion:
+                bbs[piece] ^= dest_bit
+                bbs[piece + promotion] ^= dest_bit
+                mailbox[dest] = piece + promotion
+                key ^= zobrist[piece][dest] ^ zobrist[piece + promotion][dest]
+            elif dest - start in (16, -16):
+                ep_square = (start + dest) // 2
+
+                # only kept if it can be used, so that transpositions match
+                if PAWN_ATTACKS[us][ep_square] & bbs[(us ^ 1) * 6 + PAWN]:
+                    pos.ep_square = ep_square
+                    key ^= cs.ZOBRIST_EP[ep_square % 8]
+
+        elif piece % 6 == KING and dest - start in (2, -2):
+            rook = piece - KING + ROOK
+
+            if dest > start:
+                rook_start, rook_dest = dest + 1, dest - 1
+            else:
+                rook_start, rook_dest = dest - 2, dest + 1
+            bbs[rook] ^= (1 << rook_start) | (1 << rook_dest)
+            occ[us] ^= (1 << rook_start) | (1 << rook_dest)
+            mailbox[rook_start] = None
+            mailbox[rook_dest] = rook
+            key ^= zobrist[rook][rook_start] ^ zobrist[rook][rook_dest]
+
+        if self.ep_square is not None:
+            key ^= cs.ZOBRIST_EP[self.ep_square % 8]
+
+        pos.castling &= CASTLING_KEPT[start] & CASTLING_KEPT[dest]
+        pos.side = us ^ 1
+        pos.key = (
+            key
+            ^ cs.ZOBRIST_CASTLING[self.castling]
+            ^ cs.ZOBRIST_CASTLING[pos.castling]
+            ^ cs.ZOBRIST_SIDE
+        )
+
+        return pos
+
+    def legal_moves(self):
+        """Returns a list of the legal moves in the position, encoded as
+        start | dest << 6 | promotion << 12."""
+        bbs, us = self.bbs, self.side
+        them = us ^ 1
+        base, their_base = us * 6, them * 6
+        own, enemy = self.occ[us], self.occ[them]
+        occ = own | enemy
+        moves = []
+
+        king_bit = bbs[base + KING]
+        king_sq = king_bit.bit_length() - 1
+        checkers = self.attackers(king_sq, them, occ)
+
+        # king moves, with the king removed so it can't hide behind itself
+        occ_without_king = occ ^ king_bit
+        targets = KING_ATTACKS[king_sq] & ~own
+
+        while targets:
+            bit = targets & -targets
+            targets ^= bit
+            sq = bit.bit_length() - 1
+            if not self.attackers(sq, them, occ_without_king):
+                moves.append(king_sq | sq << 6)
+
+        if checkers & (checkers - 1):
+            return moves
+
+        if checkers:
+            checker_sq = checkers.bit_length() - 1
+            target_mask = BETWEEN[king_sq][checker_sq] | checkers
+        else:
+            target_mask = FULL
+
+            for right, k_start, k_dest, _, _, empty, safe in CASTLES[us]:
+                if (
+                    self.castling & right
+                    and not occ & empty
+                    and not any(self.attackers(sq, them, occ) for sq in safe)
+                ):
+                    moves.append(k_start | k_dest << 6)
+
+        # pinned pieces may only move along the line to the king
+        pinned = 0
+        pin_lines = {}
+        snipers = (
+            ROOK_RAYS[king_sq]
+            & (bbs[their_base + ROOK] | bbs[their_base + QUEEN])
+        ) | (
+            BISHOP_RAYS[king_sq]
+            & (bbs[their_base + BISHOP] | bbs[their_base + QUEEN])
+        )
+
+        while snipers:
+            bit = snipers & -snipers
+            snipers ^= bit
+            sniper_sq = bit.bit_length() - 1
+            blockers = BETWEEN[king_sq][sniper_sq] & occ
+
+            if blockers and not blockers & (blockers - 1) and blockers & own:
+                pinned |= blockers
+                pin_lines[blockers] = LINE[king_sq][sniper_sq]
+
+        target_mask &= ~own
+        pieces = bbs[base + KNIGHT] & ~pinned
+
+        while pieces:
+            bit = pieces & -pieces
+            pieces ^= bit
+            sq = bit.bit_length() - 1
+            targets = KNIGHT_ATTACKS[sq] & target_mask
+
+            while targets:
+                dest_bit = targets & -targets
+                targets ^= dest_bit
+                moves.append(sq | (dest_bit.bit_length() - 1) << 6)
+
+        rooks = bbs[base + ROOK] | bbs[base + QUEEN]
+        bishops = bbs[base + BISHOP] | bbs[base + QUEEN]
+
+        for pieces, attacks in ((rooks, rook_attacks), (bishops, bishop_attacks)):
+            while pieces:
+                bit = pieces & -pieces
+                pieces ^= bit
+                sq = bit.bit_length() - 1
+                targets = attacks(sq, occ) & target_mask
+
+                if bit & pinned:
+                    targets &= pin_lines[bit]
+
+                while targets:
+                    dest_bit = targets & -targets
+                    targets ^= dest_bit
+                    moves.append(sq | (dest_bit.bit_length() - 1) << 6)
+
+        self._pawn_moves(moves, pinned, pin_lines, target_mask, occ, enemy)
+
+        if self.ep_square is not None:
+            self._ep_moves(moves, king_sq, checkers, occ)
+
+        return moves
+
+    def _pawn_moves(self, moves, pinned, pin_lines, target_mask, occ, enemy):
+        """Adds the pawn moves, other than en passant captures, to a list."""
+        us = self.side
+        pawns = self.bbs[us * 6 + PAWN]
+        empty = ~occ & FULL
+
+        if us == cs.WHITE:
+            single = (pawns << 8) & empty
+            double = ((single & RANK_3) << 8) & empty
+            left = ((pawns & ~FILE_A) << 7) & enemy
+            right = ((pawns & ~FILE_H) << 9) & enemy
+            steps = ((single, 8), (double, 16), (left, 7), (right, 9))
+        else:
+            single = (pawns >> 8) & empty
+            double = ((single & RANK_6) >> 8) & empty
+            left = ((pawns & ~FILE_A) >> 9) & enemy
+            right = ((pawns & ~FILE_H) >> 7) & enemy
+            steps = ((single, -8), (double, -16), (left, -9), (right, -7))
+
+        for targets, step in steps:
+            targets &= target_mask
+
+            while targets:
+                bit = targets & -targets
+                targets ^= bit
+                dest = bit.bit_length() - 1
+                start = dest - step
+
+                if pinned >> start & 1 and not pin_lines[1 << start] & bit:
+                    continue
+
+                if bit & (RANK_1 | RANK_8):
+                    for promotion in (KNIGHT, BISHOP, ROOK, QUEEN):
+                        moves.append(start | dest << 6 | promotion << 12)
+                else:
+                    moves.append(start | dest << 6)
+
+    def _ep_moves(self, moves, king_sq, checkers, occ):
+        """Adds the legal en passant captures to a list."""
+        bbs, us = self.bbs, self.side
+        them = us ^ 1
+        ep_sq = self.ep_square
+        cap_sq = ep_sq - 8 if us == cs.WHITE else ep_sq + 8
+        cap_bit = 1 << cap_sq
+
+        # a check by a knight or another pawn can't be escaped by en passant
+        if checkers & (bbs[them * 6 + KNIGHT] | bbs[them * 6 + PAWN]) & ~cap_bit:
+            return
+
+        sliders_rq = bbs[them * 6 + ROOK] | bbs[them * 6 + QUEEN]
+        sliders_bq = bbs[them * 6 + BISHOP] | bbs[them * 6 + QUEEN]
+        capturers = PAWN_ATTACKS[them][ep_sq] & bbs[us * 6 + PAWN]
+
+        while capturers:
+            bit = capturers & -capturers
+            capturers ^= bit
+            start = bit.bit_length() - 1
+            after = (occ ^ bit ^ cap_bit) | (1 << ep_sq)
+
+            if rook_attacks(king_sq, after) & sliders_rq:
+                continue
+            if bishop_attacks(king_sq, after) & sliders_bq:
+                continue
+
+            moves.append(start | ep_sq << 6)
+
+    def parse_move(self, mstr):
+        """Returns the encoded legal move matching a move in LAN."""
+        for m in self.legal_moves():
+            if move_to_str(m) == mstr:
+                return m
+
+        raise ValueError(f"Illegal move: {mstr}")
+
+    def perft(self, depth, table=None, stop=None):
+        """Returns the number of leaf nodes of the game tree at a given depth.
+
+        If a PerftTable is given, results are looked up in it and stored in
+        it, so that transpositions are only counted once. If a StopToken is
+        given, PerftStopped is raised soon after it is stopped."""
+        if stop is not None and depth > 2:
+            stop.check()
+
+        if table is None:
+            moves = self.legal_moves()
+
+            if depth == 1:
+                return len(moves)
+
+            return sum(self.make_move(m).perft(depth - 1, None, stop) for m in moves)
+
+        count = table.get(self.key, depth)
+
+        if count is None:
+            moves = self.legal_moves()
+
+            if depth == 1:
+                count = len(moves)
+            else:
+                count = sum(
+                    self.make_move(m).perft(depth - 1, table, stop) for m in moves
+                )
+
+            table.put(self.key, depth, count)
+
+        return count
+
+
+class PerftTable:
+    """Class storing perft results by Zobrist key and depth in fixed-size
+    arrays, so that its memory use doesn't grow beyond its budget.
+
+    The table is split into buckets of two entries. The first entry of a
+    bucket keeps the deepest result stored there, since it took the longest
+    to count, and the second is replaced by every new result which isn't
+    deeper. An empty entry has a depth of 0."""
+
+    ENTRY_SIZE = 17
+
+    def __init__(self, max_size=64):
+        n_buckets = 1
+
+        while 4 * n_buckets * self.ENTRY_SIZE <= max_size * 2**20:
+            n_buckets *= 2
+
+        self.mask = n_buckets - 1
+        self.keys = array.array("Q", bytes(16 * n_buckets))
+        self.counts = array.array("Q", bytes(16 * n_buckets))
+        self.depths = array.array("B", bytes(2 * n_buckets))
+        self.probes = 0
+        self.hits = 0
+
+    def get(self, key, depth):
+        """Returns the stored result for a position at a depth, or None."""
+        self.probes += 1
+        i = (key & self.mask) << 1
+
+        for j in (i, i + 1):
+            if self.keys[j] == key and self.depths[j] == depth:
+                self.hits += 1
+                return self.counts[j]
+
+        return None
+
+    def put(self, key, depth, count):
+        """Stores the result for a position at a depth."""
+        i = (key & self.mask) << 1
+        keys, counts, depths = self.keys, self.counts, self.depths
+
+        if depth >= depths[i]:
+            # move the entry it replaces into the second slot
+            keys[i + 1], counts[i + 1], depths[i + 1] = keys[i], counts[i], depths[i]
+            i_new = i
+        else:
+            i_new = i + 1
+
+        keys[i_new], counts[i_new], depths[i_new] = key, count, depth
+
+    def memory(self):
+        """Returns the number of bytes used by the table's arrays."""
+        return sum(a.itemsize * len(a) for a in (self.keys, self.counts, self.depths))
+
+    def summary(self):
+        """Returns a description of the table's size and hit rate."""
+        hit_rate = 100 * self.hits / self.probes if self.probes else 0
+        return (
+            f"Perft table: {self.memory() / 2**20:.1f} MB, {self.probes} probes, "
+            f"{hit_rate:.1f}% hits"
+        )
+
+
+def divide(
+    fen=cs.START_POS, moves=None, depth=1, on_result=None, table=None, stop=None
+):
+    """Returns the perft result after each legal move, and the total, in the
+    same form as EngineWrapper.perft.
+
+    If on_result is given, it is called with each move and its result as
+    soon as they are calculated. If table is given, it is used to look up
+    and store the results of transpositions. If stop is given, the run can
+    be ended early with its StopToken."""
+    if depth < 1:
+        return {}, 0
+
+    pos = Position(fen)
+
+    for mstr in moves or []:
+        pos = pos.make_move(pos.parse_move(mstr))
+
+    perft_results = {}
+
+    for m in pos.legal_moves():
+        if stop is not None:
+            stop.check()
+
+        mstr = move_to_str(m)
+        if depth > 1:
+            perft_results[mstr] = pos.make_move(m).perft(depth - 1, table, stop)
+        else:
+            perft_results[mstr] = 1
+
+        if on_result is not None:
+            on_result(mstr, perft_results[mstr])
+
+    return perft_results, sum(perft_results.values())
+
+
+class ReferenceEngine:
+    """Class providing the perft methods of EngineWrapper using the built-in
+    move generator, so that no engine process is needed.
+
+    If table_size is given, perft results are stored in a PerftTable of that
+    many MB, which is kept between runs."""
+
+    def __init__(self, table_size=None):
+        self.name = "Reference"
+        self.table = PerftTable(table_size) if table_size else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Does nothing, since there is no engine process to shut down."""
+
+    def perft(
+        self,
+        depth,
+        fen=cs.START_POS,
+        moves=None,
+        timeout=None,
+        on_result=None,
+        stop=None,
+    ):
+        """Runs perft and returns the result. The timeout is ignored."""
+        return divide(fen, moves, depth, on_result, self.table, stop)
+
+    def get_perft_totals(self, depths, fen=cs.START_POS, timeout=None):
+        """Returns the perft results up to a given depth. The timeout is ignored."""
+        pos = Position(fen)
+        return {d: pos.perft(d, self.table) if d > 0 else 1 for d in depths}
@@ -0,0 +1,134 @@
+"""Script used to convert an EPD file into a normalised JSONL file.
+
+Each line of the output holds the canonical FEN of a position, its best moves
+in LAN, its perft results and its ID, so that test_perft and test_engine can
+read it without converting moves again."""
+
+import argparse
+import json
+import os
+import re
+import sys
+
+import board as bd
+import constants as cs
+import epd as ep
+import movegen as mg
+
+
+def normalise_line(board, line):
+    """Converts an EPD line into a normalised record, raising ValueError if
+    the line can't be converted."""
+    parsed = ep.parse_operations(line)
+    if parsed is None:
+        raise ValueError("no position found")
+
+    fen, ops = parsed
+
+    try:
+        board.update_board(fen)
+    except (ValueError, IndexError) as e:
+        raise ValueError(f"invalid position {fen}") from e
+
+    record = {"fen": board.get_fen()}
+    legal_moves = None
+
+    if ops.get("bm"):
+        legal_moves = {
+            mg.move_to_str(m) for m in mg.Position(record["fen"]).legal_moves()
+        }
+        best_moves = []
+
+        for mstr in ops["bm"]:
+            # drop annotations such as "!" and "?"
+            mstr = mstr.rstrip("!?")
+
+            if re.fullmatch(cs.MOVE_REGEX_LAN, mstr) is None:
+                lan = board.san_to_lan(mstr)
+            else:
+                lan = mstr
+
+            if lan not in legal_moves:
+                raise ValueError(f"illegal best move {mstr}")
+
+            best_moves.append(lan)
+
+        record["bm"] = best_moves
+
+    totals = {}
+    for opcode, operands in ops.items():
+        if re.fullmatch(r"D[0-9]+", opcode) and operands and operands[0].isdigit():
+            totals[int(opcode[1:])] = int(operands[0])
+
+    if totals:
+        record["perft"] = [totals.get(d) for d in range(1, max(totals) + 1)]
+
+    if ops.get("id"):
+        record["id"] = " ".join(ops["id"]).replace('"', "")
+
+    return record
+
+
+def normalise_file(in_path, out_path):
+    """Converts every line of an EPD file, writing the records to out_path and
+    printing the lines which can't be converted. Returns the number of lines
+    converted and the number which failed."""
+    board = bd.Board()
+    n_converted = 0
+    n_failed = 0
+
+    with (
+        open(in_path, "r", encoding="UTF-8") as f_in,
+        open(out_path, "w", encoding="UTF-8") as f_out,
+    ):
+        for n, line in enumerate(f_in, 1):
+            line = line.strip()
+            if not line:
+                continue
+
+            try:
+                record = normalise_line(board, line)
+            except ValueError as e:
+                print(f"Line {n}: {e}: {line}")
+                n_failed += 1
+                continue
+
+            f_out.write(json.dumps(record, separators=(",", ":")) + "\n")
+            n_converted += 1
+
+    return n_converted, n_failed
+
+
+def main():
+    """Converts the EPD file given on the command line."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("epd_file", help="path to the EPD file to convert")
+    parser.add_argument(
+        "output",
+        nargs="?",
+        help="path to write the JSONL file to "
+        "(defaults to the EPD file's path with a .jsonl extension)",
+    )
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.epd_file):
+        print("Error: EPD file not found")
+        sys.exit(1)
+
+    out_path = args.output or os.path.splitext(args.epd_file)[0] + ".jsonl"
+
+    if os.path.abspath(out_path) == os.path.abspath(args.epd_file):
+        print("Error: Output file would overwrite the EPD file")
+        sys.exit(1)
+
+    n_converted, n_failed = normalise_file(args.epd_file, out_path)
+    print(f"Converted: {n_converted}, Failed: {n_failed}, Written to: {out_path}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    try:
+        sys.exit(main())
+    except KeyboardInterrupt:
+        pass
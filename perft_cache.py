@@ -0,0 +1,165 @@
+"""Module providing a persistent cache of perft results."""
+
+import functools
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+import board as bd
+
+
+DEFAULT_PATH = os.path.join(
+    os.path.expanduser("~"), ".cache", "perft-tools", "perft_cache.sqlite3"
+)
+
+
+@functools.lru_cache
+def file_hash(path, mtime):
+    """Returns the SHA-256 hash of a file's contents."""
+    h = hashlib.sha256()
+
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+def engine_id(name, engine_exec):
+    """Returns a string identifying an engine by its name and executable."""
+    path = shutil.which(engine_exec) or engine_exec
+
+    try:
+        return f"{name}:{file_hash(path, os.path.getmtime(path))}"
+    except OSError:
+        return f"{name}:{engine_exec}"
+
+
+def position_key(fen, moves=None):
+    """Returns a string identifying the position reached after a list of moves.
+
+    Positions reached by different move orders give the same key. The move
+    clocks are dropped, since they do not affect perft results."""
+    board = bd.Board()
+    board.update_board(fen)
+
+    for mstr in moves or []:
+        board.make_move(mstr)
+
+    return board.get_fen(clocks=False)
+
+
+def exact_key(fen, moves=None):
+    """Returns a string identifying a FEN and a list of moves exactly as given,
+    so that no two different inputs share a key."""
+    key = " ".join(fen.split())
+
+    if moves:
+        key += " moves " + " ".join(moves)
+
+    return key
+
+
+class PerftCache:
+    """Class storing perft results on disk, keyed by engine, position and depth."""
+
+    def __init__(self, path=DEFAULT_PATH, max_size=256):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.path = path
+        self.max_size = max_size * 1024 * 1024
+        self.lock = threading.Lock()
+        self.n_writes = 0
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS perft (
+                engine TEXT NOT NULL,
+                position TEXT NOT NULL,
+                depth INTEGER NOT NULL,
+                total INTEGER NOT NULL,
+                results TEXT,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (engine, position, depth)
+            )"""
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS perft_last_used ON perft (last_used)"
+        )
+        self.conn.commit()
+
+    def get(self, engine, position, depth, divide=True):
+        """Returns the stored (perft_results, total) for a position, or None.
+
+        If divide is False, only the total is needed and perft_results may be None."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT total, results FROM perft "
+                "WHERE engine = ? AND position = ? AND depth = ?",
+                (engine, position, depth),
+            ).fetchone()
+
+            if row is None or (divide and row[1] is None):
+                return None
+
+            self.conn.execute(
+                "UPDATE perft SET last_used = ? "
+                "WHERE engine = ? AND position = ? AND depth = ?",
+                (time.time(), engine, position, depth),
+            )
+            self.conn.commit()
+
+        total, results = row
+        return (json.loads(results) if results is not None else None), total
+
+    def put(self, engine, position, depth, total, perft_results=None):
+        """Stores the result of a perft run."""
+        results = json.dumps(perft_results) if perft_results is not None else None
+
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO perft VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (engine, position, depth) DO UPDATE SET "
+                "total = excluded.total, "
+                "results = COALESCE(excluded.results, results), "
+                "last_used = excluded.last_used",
+                (engine, position, depth, total, results, time.time()),
+            )
+            self.conn.commit()
+
+            self.n_writes += 1
+            if self.n_writes % 100 == 0:
+                self.evict()
+
+    def size(self):
+        """Returns the number of bytes used by stored results."""
+        page_size = self.conn.execute("PRAGMA page_size").fetchone()[0]
+        page_count = self.conn.execute("PRAGMA page_count").fetchone()[0]
+        free_pages = self.conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+        return (page_count - free_pages) * page_size
+
+    def evict(self):
+        """Removes the least recently used results until the cache fits in its
+        maximum size."""
+        while self.size() > self.max_size:
+            n_rows = self.conn.execute("SELECT COUNT(*) FROM perft").fetchone()[0]
+            if not n_rows:
+                break
+
+            self.conn.execute(
+                "DELETE FROM perft WHERE rowid IN "
+                "(SELECT rowid FROM perft ORDER BY last_used LIMIT ?)",
+                (max(n_rows // 10, 1),),
+            )
+            self.conn.commit()
+
+    def close(self):
+        """Closes the connection to the database."""
+        with self.lock:
+            self.conn.close()
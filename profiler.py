@@ -0,0 +1,212 @@
+"""Module recording where the time of engine runs goes.
+
+Timings are gathered for starting engines, the UCI handshake, waiting for the
+first line of output, the engine's computation and the time spent handling
+its output in Python, along with the number of bytes read. They can be shown
+as histograms or saved as JSON or in the Chrome trace format."""
+
+import json
+import math
+import os
+import statistics
+import threading
+import time
+
+import constants as cs
+
+
+# metrics measured in bytes rather than seconds
+BYTE_METRICS = ("bytes_read",)
+
+
+def percentile(values, p):
+    """Returns the pth percentile of a sorted list, using the nearest rank."""
+    return values[max(math.ceil(p / 100 * len(values)) - 1, 0)]
+
+
+def histogram(values):
+    """Counts values in buckets whose upper bounds are powers of two, returning
+    a list of (bound, count) for each bucket from the lowest to the highest."""
+    counts = {}
+
+    for v in values:
+        k = math.ceil(math.log2(v)) if v > 0 else None
+        counts[k] = counts.get(k, 0) + 1
+
+    zeros = counts.pop(None, 0)
+    buckets = [(0, zeros)] if zeros else []
+
+    if counts:
+        low, high = min(counts), max(counts)
+        buckets += [(2.0**k, counts.get(k, 0)) for k in range(low, high + 1)]
+
+    return buckets
+
+
+def format_value(name, value):
+    """Returns a value in ms, or in bytes for byte metrics."""
+    if name in BYTE_METRICS:
+        return f"{value:.0f}"
+    return f"{value * 1000:.3f}"
+
+
+class Profiler:
+    """Class collecting the timings of engine calls from any number of threads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.events = []
+        self.origin = time.perf_counter()
+
+    def add(self, name, value):
+        """Records a sample of a metric."""
+        with self.lock:
+            self.samples.setdefault(name, []).append(value)
+
+    def add_span(self, name, start, end, args=None):
+        """Records a span of time, given by perf_counter values, for the trace."""
+        event = {
+            "name": name,
+            "ph": "X",
+            "ts": (start - self.origin) * 1e6,
+            "dur": (end - start) * 1e6,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+        }
+
+        if args:
+            event["args"] = args
+
+        with self.lock:
+            self.events.append(event)
+
+    def measure(self, name, start):
+        """Records the time since start as a sample and a span."""
+        end = time.perf_counter()
+        self.add(name, end - start)
+        self.add_span(name, start, end)
+
+    def profile_lines(self, name, lines, start):
+        """Yields lines of engine output, recording the time until the first
+        line, the time spent by the caller handling the lines, the rest of the
+        time until the last line and the number of bytes read.
+
+        start is the perf_counter value when the command was sent."""
+        first_byte = None
+        parse = 0
+        n_bytes = 0
+
+        try:
+            for l in lines:
+                now = time.perf_counter()
+                if first_byte is None:
+                    first_byte = now - start
+
+                n_bytes += len(l) + 1
+                yield l
+                parse += time.perf_counter() - now
+        finally:
+            end = time.perf_counter()
+
+            if first_byte is not None:
+                self.add("first_byte", first_byte)
+
+            self.add("compute", end - start - parse)
+            self.add("parse", parse)
+            self.add("bytes_read", n_bytes)
+            self.add_span(name, start, end, {"bytes": n_bytes, "parse_s": parse})
+
+    def summary(self):
+        """Returns a table of statistics and a histogram for each metric."""
+        lines = [
+            cs.PROFILE_FSTRING.format(
+                "Metric", "Count", "Total", "Mean", "p50", "p90", "p99", "Max"
+            )
+        ]
+        histograms = []
+
+        with self.lock:
+            samples = {name: sorted(values) for name, values in self.samples.items()}
+
+        for name, values in samples.items():
+            unit = "B" if name in BYTE_METRICS else "ms"
+            stats = [
+                sum(values),
+                statistics.fmean(values),
+                percentile(values, 50),
+                percentile(values, 90),
+                percentile(values, 99),
+                values[-1],
+            ]
+            lines.append(
+                cs.PROFILE_FSTRING.format(
+                    f"{name} ({unit})",
+                    len(values),
+                    *(format_value(name, v) for v in stats),
+                )
+            )
+
+            buckets = histogram(values)
+            most = max(count for _, count in buckets)
+            histograms.append(f"\n{name} ({unit})")
+
+            for bound, count in buckets:
+                bar = "#" * math.ceil(cs.PROFILE_BAR_WIDTH * count / most)
+                histograms.append(
+                    cs.PROFILE_HISTOGRAM_FSTRING.format(
+                        f"<= {format_value(name, bound)}", count, bar
+                    ).rstrip()
+                )
+
+        return "\n".join(lines + histograms)
+
+    def to_dict(self):
+        """Returns the statistics and samples of each metric."""
+        metrics = {}
+
+        with self.lock:
+            samples = {name: sorted(values) for name, values in self.samples.items()}
+
+        for name, values in samples.items():
+            metrics[name] = {
+                "unit": "bytes" if name in BYTE_METRICS else "seconds",
+                "count": len(values),
+                "total": sum(values),
+                "mean": statistics.fmean(values),
+                "p50": percentile(values, 50),
+                "p90": percentile(values, 90),
+                "p99": percentile(values, 99),
+                "max": values[-1],
+                "histogram": histogram(values),
+                "samples": values,
+            }
+
+        return metrics
+
+    def save_json(self, file_path):
+        """Writes the statistics and samples of each metric to a JSON file."""
+        with open(file_path, "w", encoding="UTF-8") as f:
+            json.dump(self.to_dict(), f, indent=1)
+
+    def save_trace(self, file_path):
+        """Writes the recorded spans to a file which can be opened in a Chrome
+        trace viewer, such as chrome://tracing or Perfetto."""
+        with self.lock:
+            events = list(self.events)
+
+        with open(file_path, "w", encoding="UTF-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+def report(profiler, json_path=None, trace_path=None):
+    """Prints the profile and writes it to the files given, if any."""
+    print(f"\n{profiler.summary()}")
+
+    try:
+        if json_path:
+            profiler.save_json(json_path)
+        if trace_path:
+            profiler.save_trace(trace_path)
+    except OSError as e:
+        print(f"Error: {e}")
@@ -1,5 +1,8 @@
 """Script used to test an engine's search against results stored a file."""
 
+import argparse
+import collections
+import concurrent.futures
 import os
 import re
 import sys
@@ -9,170 +12,194 @@ import shutil
 import board as bd
 import constants as cs
 import engine_wrapper as ewr
+import epd as ep
+import profiler as pf
 
 
-def get_tokens(line):
-    """Tokenises a test line string."""
-    sections = re.split("(;)", line)
-    tokens = []
-
-    for s in sections:
-        tokens.extend(s.split(" "))
-
-    return [s.strip() for s in tokens if s and s]
-
-
-def parse_line(line):
-    """Extracts the fen, best move(s) and test id from a line."""
-    if not re.match(cs.FEN_REGEX, line):
-        return "", [], ""
-
-    tokens = get_tokens(line)
-
-    info = iter(tokens)
-
-    fen = " ".join(tokens[:4])
-
-    hm_clk = 0
-    fm_num = 1
-
+def get_test(board, test):
+    """Returns a test with its best moves converted to LAN."""
+    board.update_board(test.fen)
     best_moves = []
-    test_id_sections = []
-
-    for _ in range(4):
-        next(info)
-
-    try:
-        tok = next(info)
-
-        if tok.isdigit():
-            hm_clk = int(tok)
-            tok = next(info)
-
-            if tok.isdigit():
-                fm_num = int(tok)
-                tok = next(info)
-
-        while True:
-            if tok == "bm":
-                tok = next(info)
-                break
-            tok = next(info)
-
-        while True:
-            if re.match(cs.MOVE_REGEX_LAN, tok) or re.match(cs.MOVE_REGEX_SAN, tok):
-                best_moves.append(tok)
-            elif tok in ("id", ";"):
-                break
-            tok = next(info)
-
-        while tok != "id":
-            tok = next(info)
-        tok = next(info)
-
-        while tok != ";":
-            test_id_sections.append(tok)
-            tok = next(info)
-
-    except StopIteration:
-        pass
-
-    if not best_moves:
-        return "", [], ""
 
-    try:
-        hm_clk = int(tokens[tokens.index("hmvc") + 1])
-        fm_num = int(tokens[tokens.index("fmvn") + 1])
-    except (ValueError, IndexError):
-        pass
-
-    fen += f" {hm_clk} {fm_num}"
-
-    test_id = " ".join(test_id_sections)
-
-    return fen, best_moves, test_id
-
-
-def test_line(e_wrapper, board, line, time):
-    """Runs a test from a line in a test file and prints the result."""
-    fen, stored_moves, test_id = parse_line(line)
-
-    if not stored_moves:
-        return -1
-
-    board.update_board(fen)
-    best_moves = []
-
-    for mstr in stored_moves:
-        if re.match(cs.MOVE_REGEX_LAN, mstr) is None:
+    for mstr in test.best_moves:
+        if re.fullmatch(cs.MOVE_REGEX_LAN, mstr) is None:
             best_moves.append(board.san_to_lan(mstr))
         else:
             best_moves.append(mstr)
 
-    best_move = e_wrapper.get_best_move(fen=fen, t=time)
+    return test._replace(best_moves=best_moves, test_id=test.test_id[:35])
+
+
+def print_result(test, best_move, info, error=None):
+    """Prints the result of a test, returning 1 if it passed and 0 otherwise.
 
-    if best_move in best_moves:
+    If error is given, such as TIMEOUT, the test is shown as failed with it."""
+    fen, best_moves, test_id = test
+
+    if error is not None:
+        res_str = error
+        result = 0
+    elif best_move in best_moves:
         res_str = "PASS"
         result = 1
     else:
         res_str = "FAIL"
         result = 0
 
-    test_id = test_id[:35].replace('"', "")
-
     print(
         cs.BESTMOVE_FSTRING.format(
-            test_id, fen, " ".join(best_moves), best_move, res_str
-        )
+            test_id,
+            fen,
+            " ".join(best_moves),
+            best_move,
+            info.get("depth", "-"),
+            info.get("score", "-"),
+            res_str,
+        ),
+        flush=True,
     )
 
     return result
 
 
-def test_file(e_wrapper, file_path, time=10000):
-    """Runs tests from an EPD file and prints a table of results."""
+def test_file(e_pool, tests, time=10000, max_pending=None):
+    """Runs tests from an iterable of TestRecords, sharing them out between the
+    engines in e_pool, and prints a table of results in order.
+
+    Tests are read from the iterable as earlier ones finish, so that at most
+    max_pending are waiting for a result at a time."""
     print(
         cs.BESTMOVE_FSTRING.format(
-            "ID", "FEN", "Best Move", "Engine's Best Move", "Result"
+            "ID", "FEN", "Best Move", "Engine's Best Move", "Depth", "Score", "Result"
         )
     )
 
-    total = 0
-    passed = 0
+    results = []
+    pending = collections.deque()
+    max_pending = max_pending or 1
 
     board = bd.Board()
 
-    with open(file_path, "r", encoding="UTF-8") as f:
-        lines = f.readlines()
-        for line in lines:
-            inc = test_line(e_wrapper, board, line, time)
-            if inc != -1:
-                passed += inc
-                total += 1
-
+    def report(job, test):
+        """Prints the result of a finished test."""
+        try:
+            best_move, info = job.result()
+        except ValueError as e:
+            print(f"Skipping {test.test_id}: {e}", flush=True)
+            return
+        except ewr.EngineError as e:
+            error = "TIMEOUT" if isinstance(e, ewr.EngineTimeoutError) else "CRASH"
+            results.append(print_result(test, "-", {}, error))
+            print(f"Error in {test.test_id}: {e}", flush=True)
+            return
+
+        results.append(print_result(test, best_move, info))
+
+    for test in tests:
+        try:
+            test = get_test(board, test)
+            job = e_pool.submit(ewr.EngineWrapper.get_best_move, test.fen, time)
+        except ValueError as e:
+            # keep the error in order with the results
+            job = concurrent.futures.Future()
+            job.set_exception(e)
+
+        pending.append((job, test))
+
+        while len(pending) >= max_pending or (pending and pending[0][0].done()):
+            report(*pending.popleft())
+
+    for job, test in pending:
+        report(job, test)
+
+    total, passed = len(results), sum(results)
     print(f"\nTotal: {total}, Passed: {passed}, Failed: {total - passed}")
 
 
 def main():
     """Starts the engine and runs the engine tests."""
-    if len(sys.argv) < 3:
-        print("Error: Missing arguments")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("engine", help="path to the engine executable")
+    parser.add_argument("epd_file", help="path to the EPD file of tests")
+    parser.add_argument(
+        "movetime", nargs="?", type=int, default=10000, help="search time in ms"
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1, help="number of engine instances to run"
+    )
+    parser.add_argument(
+        "--pin", action="store_true", help="restrict each engine instance to one CPU"
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        help="value of the engine's Threads option (1 by default when --jobs > 1)",
+    )
+    parser.add_argument("--hash", type=int, help="value of the engine's Hash option")
+    parser.add_argument(
+        "--shard", help="run only the ith of n equal parts of the file, given as i/n"
+    )
+    parser.add_argument(
+        "--sample",
+        type=float,
+        help="run each test with this probability (between 0 and 1)",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="random seed used by --sample"
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="print where the time of the engine runs went when finished",
+    )
+    parser.add_argument(
+        "--profile-json", metavar="FILE", help="also write the profile to a JSON file"
+    )
+    parser.add_argument(
+        "--profile-trace",
+        metavar="FILE",
+        help="also write the engine calls to a Chrome trace file",
+    )
+    args = parser.parse_args()
 
-    if shutil.which(sys.argv[1]) is None:
+    if shutil.which(args.engine) is None:
         print("Error: Engine executable not found.")
         sys.exit(1)
 
-    e_wrapper = ewr.EngineWrapper(sys.argv[1])
-
-    if not os.path.isfile(sys.argv[2]):
+    if not os.path.isfile(args.epd_file):
         print("Error: EPD file not found")
         return
 
-    if len(sys.argv) >= 4 and sys.argv[3].isdigit():
-        test_file(e_wrapper, sys.argv[2], time=int(sys.argv[3]))
-    else:
-        test_file(e_wrapper, sys.argv[2])
+    try:
+        shard = ep.parse_shard(args.shard) if args.shard else None
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+    jobs = max(args.jobs, 1)
+    options = {}
+
+    if args.threads is not None:
+        options["Threads"] = args.threads
+    elif jobs > 1:
+        options["Threads"] = 1
+
+    if args.hash is not None:
+        options["Hash"] = args.hash
+
+    profiler = None
+    if args.profile or args.profile_json or args.profile_trace:
+        profiler = pf.Profiler()
+
+    try:
+        with ewr.EnginePool(
+            args.engine, jobs, options=options, pin=args.pin, profiler=profiler
+        ) as e_pool:
+            tests = ep.read_tests(args.epd_file, shard, args.sample, args.seed)
+            test_file(e_pool, tests, time=args.movetime, max_pending=2 * jobs)
+    finally:
+        if profiler is not None:
+            pf.report(profiler, args.profile_json, args.profile_trace)
 
 
 if __name__ == "__main__":
@@ -1,101 +1,526 @@
 """Script used to test engine against perft results stored in a file."""
 
+import argparse
+import concurrent.futures
 import datetime
+import itertools
+import json
+import os
 import shutil
 import sys
+import threading
 import time
 
+import constants as cs
 import engine_wrapper as ewr
+import epd as ep
+import perft_cache as pc
+import profiler as pf
 
 
-def parse_results_file(file_path):
-    """Extracts perft results from file."""
-    stored_results = {}
+def scan_results_file(records):
+    """Returns the number of records and the greatest depth with a stored
+    result, without keeping the records in memory."""
+    n_records = 0
     max_depth = 0
 
-    with open(file_path, "r", encoding="UTF-8") as f:
-        lines = f.readlines()
+    for record in records:
+        n_records += 1
+        max_depth = max(max_depth, len(record.totals))
 
-        for line in lines:
-            if line == "/n":
-                break
+    return n_records, max_depth
 
-            info = line.split(";")
-            fen = info[0].strip()
-            stored_results[fen] = {}
 
-            for i in range(1, len(info)):
-                result_set = list(filter(None, info[i].split(" ")))
-                depth = int(result_set[0].strip()[1:])
-                result = int(result_set[1])
-                stored_results[fen][depth] = result
+class Checkpoint:
+    """Class recording completed perft totals in a file, so that an interrupted
+    run can be resumed.
 
-                max_depth = max(depth, max_depth)
+    Each line of the file holds one total as JSON. Totals are only reused for
+    the engine that produced them, identified by its name and binary hash."""
 
-    return stored_results, max_depth
+    def __init__(self, path, engine, resume=False):
+        self.path = path
+        self.engine = engine
+        self.totals = {}
+        self.lock = threading.Lock()
 
+        if resume and os.path.exists(path):
+            self.load()
 
-def run_tests(e_wrapper, stored_results, depth):
-    """Runs the stored perft tests and prints the results."""
-    n_tests = len(stored_results)
+        self.file = open(path, "a" if resume else "w", encoding="UTF-8")
 
-    print(f"{"":12}{"FEN":72}", end="", flush=True)
-    for i in range(1, depth + 1):
-        print(f"{i:8}", end="", flush=True)
-    print(f"{"Time Elapsed":>19}")
+    def load(self):
+        """Reads the totals stored for the engine."""
+        with open(self.path, "r", encoding="UTF-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # the last line is cut short if the run was killed
+                    continue
+
+                if entry.get("engine") == self.engine:
+                    self.totals[(entry["fen"], entry["depth"])] = entry["total"]
+
+    def get(self, fen, depth):
+        """Returns the stored total for a position at a given depth, or None."""
+        return self.totals.get((fen, depth))
+
+    def put(self, fen, depth, total):
+        """Records a completed total."""
+        entry = {"engine": self.engine, "fen": fen, "depth": depth, "total": total}
+
+        with self.lock:
+            self.totals[(fen, depth)] = total
+            self.file.write(json.dumps(entry) + "\n")
+            self.file.flush()
+
+    def close(self):
+        """Closes the checkpoint file."""
+        self.file.close()
+
+
+def run_depth(e_wrapper, fen, depth, checkpoint=None, timeout=None):
+    """Runs perft on a position at a single depth, and returns the total, the
+    time taken, the error which stopped the run, if any, and the engine's peak
+    memory use during the run.
+
+    The engine is killed and restarted if the run takes longer than timeout
+    seconds. The total is written to the checkpoint, if there is one."""
+    e_wrapper.reset_peak_memory()
+    start = time.time()
+
+    try:
+        total = e_wrapper.get_perft_totals([depth], fen, timeout)[depth]
+    except ewr.EngineError as e:
+        return None, time.time() - start, e, None
+
+    if checkpoint is not None:
+        checkpoint.put(fen, depth, total)
+
+    return total, time.time() - start, None, e_wrapper.peak_memory()
 
+
+def run_batch(e_wrapper, fens, depth, checkpoint=None, timeout=None):
+    """Runs perft on several positions at the same depth with one round trip
+    to the engine, and returns the totals in the same form as run_depth."""
+    e_wrapper.reset_peak_memory()
     start = time.time()
-    n = 1
 
-    for fen, results in stored_results.items():
-        print(f"{f"({n}/{n_tests})":12}{fen:72}", end="", flush=True)
+    try:
+        outcomes = e_wrapper.perft_batch([(fen, None, depth) for fen in fens], timeout)
+    except ewr.EngineError as e:
+        return None, time.time() - start, e, None
+
+    totals = [total for _, total in outcomes]
+
+    if checkpoint is not None:
+        for fen, total in zip(fens, totals):
+            checkpoint.put(fen, depth, total)
+
+    return totals, time.time() - start, None, e_wrapper.peak_memory()
 
-        depths = list(filter(lambda x: x <= depth, results.keys()))
-        totals = e_wrapper.get_perft_totals(depths, fen)
 
-        for i in range(1, depth + 1):
-            if i not in results:
-                print(f"{'-':>8}", end="", flush=True)
-                continue
+def print_result(
+    n, n_tests, fen, results, totals, depth, elapsed, runtime=None, peak_rss=None
+):
+    """Prints the differences between the engine's results and the stored results.
 
+    A total may be given as a string, such as TIMEOUT, to show why it is missing."""
+    print(f"{f"({n}/{n_tests})":12}{fen:72}", end="")
+
+    for i in range(1, depth + 1):
+        if i not in results or i not in totals:
+            print(f"{'-':>8}", end="")
+            continue
+
+        if isinstance(totals[i], str):
+            res = totals[i]
+        else:
             res = str(totals[i] - results[i])
-            print(f"{res:>8}", end="", flush=True)
+        print(f"{res:>8}", end="")
+
+    runtime = "-" if runtime is None else f"{runtime:.3f}"
+    peak_rss = "-" if peak_rss is None else f"{peak_rss / (1 << 20):.1f}"
+    elapsed = datetime.timedelta(seconds=elapsed)
+    print(f"{runtime:>14}{peak_rss:>14}{str(elapsed):>19}", flush=True)
+
+
+def run_tests(
+    e_pool,
+    records,
+    n_tests,
+    depth,
+    ordered=True,
+    checkpoint=None,
+    fail_fast=False,
+    timeout=cs.PERFT_TIMEOUT,
+    min_nps=cs.PERFT_MIN_NPS,
+):
+    """Runs the perft tests in an iterable of PerftRecords and prints the
+    results, returning the number of positions which failed.
+
+    Records are read in batches. Every position in a batch is run at depth 1,
+    then every position at depth 2, and so on, so that most bugs are found by
+    the cheap shallow runs. A position is dropped as soon as one of its totals
+    is wrong, and if fail_fast is True, the whole run is abandoned. Failures
+    are reported as soon as they are found.
+
+    Runs are shared out between the engines in e_pool. Rows are printed in file
+    order unless ordered is False, in which case each row is printed as soon as
+    its position is finished. Totals found in the checkpoint are not run again.
+
+    Positions expected to have at most PERFT_PIPELINE_NODES nodes are sent to
+    an engine PERFT_PIPELINE_SIZE at a time, so that shallow runs aren't slowed
+    down by a round trip each, and their runtimes are shared equally. If a
+    batch fails, its positions are run again one at a time to find the one
+    which failed.
+
+    Each run is given timeout seconds plus the time needed to search the
+    expected number of nodes at min_nps. An engine which takes longer, or
+    which crashes, is restarted, and the total is marked TIMEOUT or CRASH."""
+    print(f"{"":12}{"FEN":72}", end="")
+    for i in range(1, depth + 1):
+        print(f"{i:8}", end="")
+    print(f"{"Runtime (s)":>14}{"Peak RSS (MB)":>14}{"Time Elapsed":>19}", flush=True)
+
+    start = time.time()
+    engine_time = 0
+    n_done = 0
+    n_failed = 0
+    records = iter(records)
+
+    batch = []
+    totals = []
+    runtimes = []
+    peak_rss = []
+    remaining = []
+    finished = set()
+    next_row = 0
+
+    def print_row(i):
+        """Prints the row of a position in the current batch."""
+        print_result(
+            n_done + i + 1,
+            n_tests,
+            batch[i].fen,
+            batch[i],
+            totals[i],
+            depth,
+            time.time() - start,
+            runtimes[i],
+            peak_rss[i],
+        )
+
+    def finish(i):
+        """Marks a position as finished and prints any rows which are due."""
+        nonlocal next_row
+        finished.add(i)
+
+        if not ordered:
+            print_row(i)
+            return
+
+        while next_row in finished:
+            print_row(next_row)
+            next_row += 1
+
+    def check(i, d, total, error):
+        """Records a total, and drops the position if it is wrong."""
+        nonlocal n_failed
+        n = n_done + i + 1
 
-        elapsed = datetime.timedelta(seconds=time.time() - start)
-        print(f"{str(elapsed):>19}")
+        if error is None and total == batch[i][d]:
+            totals[i][d] = total
+            remaining[i] -= 1
 
-        n += 1
+            if not remaining[i]:
+                finish(i)
+            return True
+
+        if error is not None:
+            if isinstance(error, ewr.EngineTimeoutError):
+                totals[i][d] = "TIMEOUT"
+            else:
+                totals[i][d] = "CRASH"
+            print(f"Error at depth {d} in ({n}/{n_tests}): {error}", flush=True)
+        else:
+            totals[i][d] = total
+            print(
+                f"Mismatch at depth {d} in ({n}/{n_tests}): "
+                f"expected {batch[i][d]}, got {total}",
+                flush=True,
+            )
+
+        remaining[i] = 0
+        n_failed += 1
+        finish(i)
+        return False
+
+    def submit(jobs, indices, d):
+        """Submits a perft run at depth d of the positions with the given indices,
+        adding it to jobs."""
+        run_timeouts = [None] * len(indices)
+        if timeout:
+            run_timeouts = [round(timeout + batch[i][d] / min_nps, 1) for i in indices]
+
+        if len(indices) == 1:
+            fen = batch[indices[0]].fen
+            job = e_pool.submit(run_depth, fen, d, checkpoint, run_timeouts[0])
+        else:
+            job = e_pool.submit(
+                run_batch,
+                [batch[i].fen for i in indices],
+                d,
+                checkpoint,
+                sum(run_timeouts) if timeout else None,
+            )
+
+        jobs[job] = indices
+
+    while batch := list(itertools.islice(records, cs.PERFT_BATCH_SIZE)):
+        totals = [{} for _ in batch]
+        runtimes = [None] * len(batch)
+        peak_rss = [None] * len(batch)
+        remaining = [len([d for d in r.depths() if d <= depth]) for r in batch]
+        finished = set()
+        next_row = 0
+
+        for i in range(len(batch)):
+            if not remaining[i]:
+                finish(i)
+
+        for d in range(1, depth + 1):
+            jobs = {}
+            pipelined = []
+
+            for i, record in enumerate(batch):
+                if not remaining[i] or d not in record:
+                    continue
+
+                total = None
+                if checkpoint is not None:
+                    total = checkpoint.get(record.fen, d)
+
+                if total is not None:
+                    check(i, d, total, None)
+                elif record[d] <= cs.PERFT_PIPELINE_NODES:
+                    pipelined.append(i)
+                else:
+                    submit(jobs, [i], d)
+
+            for j in range(0, len(pipelined), cs.PERFT_PIPELINE_SIZE):
+                submit(jobs, pipelined[j : j + cs.PERFT_PIPELINE_SIZE], d)
+
+            while jobs and not (n_failed and fail_fast):
+                done, _ = concurrent.futures.wait(
+                    jobs, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+
+                for job in done:
+                    indices = jobs.pop(job)
+                    totals_found, t, error, rss = job.result()
+                    engine_time += t
+
+                    if len(indices) > 1:
+                        if error is not None:
+                            for i in indices:
+                                submit(jobs, [i], d)
+                            continue
+                    else:
+                        totals_found = [totals_found]
+
+                    for i, total in zip(indices, totals_found):
+                        runtimes[i] = (runtimes[i] or 0) + t / len(indices)
+
+                        if rss is not None:
+                            peak_rss[i] = max(peak_rss[i] or 0, rss)
+
+                        if not check(i, d, total, error) and fail_fast:
+                            break
+
+                    if n_failed and fail_fast:
+                        for pending in jobs:
+                            pending.cancel()
+                        break
+
+            if n_failed and fail_fast:
+                break
+
+        for i in range(len(batch)):
+            if i not in finished:
+                finish(i)
+
+        n_done += len(batch)
+
+        if n_failed and fail_fast:
+            break
 
     end = time.time()
     print(f"\nTime elapsed: {datetime.timedelta(seconds=end - start)}")
+    print(f"Total engine wall time: {datetime.timedelta(seconds=engine_time)}")
+
+    cpu_time = e_pool.cpu_time()
+    if cpu_time is not None:
+        print(f"Total engine CPU time: {datetime.timedelta(seconds=cpu_time)}")
+
+    if n_failed:
+        print(f"Failed: {n_failed}/{n_tests}")
+        if fail_fast:
+            print("Run abandoned after the first failure")
+
+    return n_failed
 
 
 def main():
     """Runs the comparison function."""
-    if len(sys.argv) < 2:
-        print("Error: Missing arguments")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("engine", help="path to the engine executable")
+    parser.add_argument("epd_file", help="path to the EPD file of perft results")
+    parser.add_argument("max_depth", nargs="?", type=int, default=0)
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1, help="number of engine instances to run"
+    )
+    parser.add_argument(
+        "--unordered",
+        action="store_true",
+        help="print results as they finish instead of in file order",
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true", help="don't use stored perft results"
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=256,
+        help="maximum size of the perft result cache in MB",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        help="file to record completed results in "
+        "(the EPD file name with .checkpoint appended if only --resume is given)",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="record completed results in a checkpoint file, and reuse the "
+        "results already in it from an earlier run",
+    )
+    parser.add_argument(
+        "--fail-fast",
+        action="store_true",
+        help="stop the whole run at the first wrong result",
+    )
+    parser.add_argument(
+        "-t",
+        "--timeout",
+        type=float,
+        default=cs.PERFT_TIMEOUT,
+        help="seconds allowed for each run on top of the time needed to search "
+        "its nodes at --min-nps (0 for no timeout)",
+    )
+    parser.add_argument(
+        "--min-nps",
+        type=int,
+        default=cs.PERFT_MIN_NPS,
+        help="slowest speed in nodes per second expected of the engine",
+    )
+    parser.add_argument(
+        "--shard", help="run only the ith of n equal parts of the file, given as i/n"
+    )
+    parser.add_argument(
+        "--sample",
+        type=float,
+        help="run each position with this probability (between 0 and 1)",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="random seed used by --sample"
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="print where the time of the engine runs went when finished",
+    )
+    parser.add_argument(
+        "--profile-json", metavar="FILE", help="also write the profile to a JSON file"
+    )
+    parser.add_argument(
+        "--profile-trace",
+        metavar="FILE",
+        help="also write the engine calls to a Chrome trace file",
+    )
+    args = parser.parse_args()
 
-    if shutil.which(sys.argv[1]) is None:
+    if shutil.which(args.engine) is None:
         print("Error: Engine executable not found.")
         sys.exit(1)
 
-    e_wrapper = ewr.EngineWrapper(sys.argv[1])
+    try:
+        shard = ep.parse_shard(args.shard) if args.shard else None
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+    def read_records():
+        return ep.read_perft_records(args.epd_file, shard, args.sample, args.seed)
 
     try:
-        stored_results, depth = parse_results_file(sys.argv[2])
-    except ValueError:
+        n_tests, depth = scan_results_file(read_records())
+    except (OSError, ValueError):
         print("Error: Parse of results file failed.")
         sys.exit(1)
 
+    if args.max_depth > 0:
+        depth = args.max_depth
+
+    cache = None if args.no_cache else pc.PerftCache(max_size=args.cache_size)
+    checkpoint = None
+
+    profiler = None
+    if args.profile or args.profile_json or args.profile_trace:
+        profiler = pf.Profiler()
+
     try:
-        depth_arg = int(sys.argv[3])
-        if depth_arg > 0:
-            depth = depth_arg
-    except (IndexError, ValueError):
-        pass
+        with ewr.EnginePool(
+            args.engine,
+            max(args.jobs, 1),
+            cache=cache,
+            profiler=profiler,
+            exact_keys=True,
+        ) as e_pool:
+            if args.checkpoint or args.resume:
+                try:
+                    checkpoint = Checkpoint(
+                        args.checkpoint or args.epd_file + ".checkpoint",
+                        pc.engine_id(e_pool.name, args.engine),
+                        resume=args.resume,
+                    )
+                except OSError as e:
+                    print(f"Error: Can't open checkpoint file: {e}")
+                    return 1
+
+            n_failed = run_tests(
+                e_pool,
+                read_records(),
+                n_tests,
+                depth,
+                ordered=not args.unordered,
+                checkpoint=checkpoint,
+                fail_fast=args.fail_fast,
+                timeout=args.timeout,
+                min_nps=max(args.min_nps, 1),
+            )
+    finally:
+        if checkpoint is not None:
+            checkpoint.close()
+
+        if cache is not None:
+            cache.close()
+
+        if profiler is not None:
+            pf.report(profiler, args.profile_json, args.profile_trace)
 
-    run_tests(e_wrapper, stored_results, depth)
+    return 1 if n_failed else 0
 
 
 if __name__ == "__main__":
@@ -0,0 +1,131 @@
+"""Tests for board."""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import board as bd
+import constants as cs
+
+KIWIPETE = "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1"
+
+
+def board_after(fen, moves):
+    """Returns a board with a list of moves made from a position."""
+    board = bd.Board()
+    board.update_board(fen)
+
+    for mstr in moves:
+        board.make_move(mstr)
+
+    return board
+
+
+class PositionTest(unittest.TestCase):
+    def assert_hash_matches(self, board):
+        self.assertEqual(board.hash, board.compute_hash())
+
+    def test_hash_after_moves(self):
+        board = bd.Board()
+        board.update_board(KIWIPETE)
+
+        # castling, captures, a rook move losing a right and a promotion
+        for mstr in ("e1g1", "e8c8", "e5f7", "h8f8", "f7d8", "h3g2", "f3f6", "g2f1q"):
+            board.make_move(mstr)
+            self.assert_hash_matches(board)
+
+    def test_hash_after_en_passant(self):
+        board = board_after(cs.START_POS, ["e2e4", "a7a6", "e4e5", "d7d5"])
+        self.assertEqual(board.ep_square, cs.SQUARE_INDEX["d6"])
+        self.assert_hash_matches(board)
+
+        board.make_move("e5d6")
+        self.assertEqual(board.piece_at(cs.SQUARE_INDEX["d5"]), "-")
+        self.assert_hash_matches(board)
+
+    def test_fen_round_trip(self):
+        for fen in (
+            cs.START_POS,
+            KIWIPETE,
+            "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1",
+            "rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8",
+            "rnbqkbnr/ppp1p1pp/8/3pPp2/8/8/PPPP1PPP/RNBQKBNR w KQkq f6 0 3",
+        ):
+            board = bd.Board()
+            board.update_board(fen)
+            self.assertEqual(board.get_fen(), fen)
+            self.assertEqual(board.get_fen(clocks=False), fen.rsplit(" ", 2)[0])
+            self.assert_hash_matches(board)
+
+    def test_transpositions_give_same_fen(self):
+        board1 = board_after(cs.START_POS, ["g1f3", "g8f6", "b1c3", "b8c6"])
+        board2 = board_after(cs.START_POS, ["b1c3", "b8c6", "g1f3", "g8f6"])
+
+        self.assertEqual(board1.get_fen(), board2.get_fen())
+        self.assertEqual(board1.hash, board2.hash)
+
+    def test_unusable_en_passant_dropped(self):
+        # no black pawn can capture on e3
+        board = board_after(cs.START_POS, ["e2e4"])
+        self.assertEqual(board.get_fen(clocks=False).split()[3], "-")
+
+        fen = "rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq e3 0 1"
+        board.update_board(fen)
+        self.assertIsNone(board.ep_square)
+        self.assertEqual(board.get_fen(), fen.replace("e3", "-"))
+        self.assertEqual(board.hash, board_after(cs.START_POS, ["e2e4"]).hash)
+
+    def test_lost_castling_right(self):
+        # the rook returns to h1, but the right to castle kingside is gone
+        board1 = board_after(cs.START_POS, ["g1f3", "g8f6", "h1g1", "f6g8", "g1h1"])
+        board2 = board_after(cs.START_POS, ["g1f3", "g8f6", "f3g1", "f6g8", "b1c3"])
+
+        self.assertEqual(board1.get_fen().split()[2], "Qkq")
+        self.assertEqual(board2.get_fen().split()[2], "KQkq")
+        self.assertNotEqual(board1.hash, board2.hash)
+        self.assert_hash_matches(board1)
+
+    def test_unusable_castling_right_dropped(self):
+        # there is no rook on h1 to castle with
+        board = bd.Board()
+        board.update_board("r3k2r/8/8/8/8/8/8/R3K3 w KQkq - 0 1")
+
+        self.assertEqual(board.get_fen(), "r3k2r/8/8/8/8/8/8/R3K3 w Qkq - 0 1")
+
+
+class SanToLanTest(unittest.TestCase):
+    def setUp(self):
+        self.board = bd.Board()
+
+    def test_converts_moves(self):
+        self.assertEqual(self.board.san_to_lan("e4"), "e2e4")
+        self.assertEqual(self.board.san_to_lan("Nf3+"), "g1f3")
+
+    def test_empty_move_raises(self):
+        # a "!!" operand is empty once its annotations are dropped
+        for mstr in ("", "+", "#"):
+            with self.assertRaises(ValueError):
+                self.board.san_to_lan(mstr)
+
+    def test_malformed_move_raises(self):
+        self.board.update_board(cs.START_POS.replace(" w ", " b "))
+
+        for mstr in ("e", "Q", "=Q", "Nz9", "fxd8B", "e9"):
+            with self.assertRaises(ValueError):
+                self.board.san_to_lan(mstr)
+
+    def test_illegal_move_raises(self):
+        # the only knight which can reach d4 is pinned to its king
+        self.board.update_board("4k3/4r3/8/8/8/8/4N3/4K3 w - - 0 1")
+
+        for mstr in ("Nd4", "e4", "O-O"):
+            with self.assertRaises(ValueError):
+                self.board.san_to_lan(mstr)
+
+        self.assertEqual(self.board.san_to_lan("Kd1"), "e1d1")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,130 @@
+"""Tests for distributed_perft."""
+
+import contextlib
+import io
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import constants as cs
+import distributed_perft as dp
+
+
+class CoordinatorTest(unittest.TestCase):
+    def test_jobs(self):
+        coordinator = dp.Coordinator(cs.START_POS, [], 3, split=2)
+
+        self.assertEqual(len(coordinator.paths), 400)
+        self.assertEqual(coordinator.job(0)["depth"], 1)
+        self.assertEqual(len(coordinator.job(0)["moves"]), 2)
+
+    def test_released_job_handed_out_again(self):
+        coordinator = dp.Coordinator(cs.START_POS, [], 2, split=1)
+        job_id = coordinator.next_job("worker 1")
+
+        coordinator.release("worker 1", "worker 1 stopped responding")
+
+        self.assertIsNone(coordinator.error)
+        self.assertEqual(coordinator.next_job("worker 2"), job_id)
+        self.assertEqual(coordinator.leases, {job_id: "worker 2"})
+
+    def test_failing_job_ends_run(self):
+        coordinator = dp.Coordinator(cs.START_POS, [], 2, split=1, max_attempts=3)
+
+        for _ in range(3):
+            job_id = coordinator.next_job("worker")
+            self.assertEqual(job_id, 0)
+            coordinator.fail(job_id, "engine crashed")
+
+        self.assertIn("failed 3 times: engine crashed", coordinator.error)
+        self.assertIsNone(coordinator.next_job("worker"))
+
+    def test_results_added_up(self):
+        coordinator = dp.Coordinator(cs.START_POS, [], 2, split=1)
+
+        while not coordinator.finished:
+            coordinator.finish(coordinator.next_job("worker"), 20)
+
+        perft_results, total = coordinator.divide()
+        self.assertEqual(total, 400)
+        self.assertEqual(perft_results["e2e4"], 20)
+
+
+class ServerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.address = f"unix:{os.path.join(self.tmp.name, "perft.sock")}"
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def connect(self):
+        """Connects a worker to the server, returning its socket and reader."""
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.address[5:])
+        dp.send_message(sock, threading.Lock(), {"type": "hello", "name": "test"})
+        return sock, sock.makefile("r", encoding="UTF-8")
+
+    def test_expired_lease_handed_out_again(self):
+        coordinator = dp.Coordinator(cs.START_POS, [], 2, split=1)
+        server = dp.make_server(self.address, coordinator, lease=0.2)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            sock1, reader1 = self.connect()
+            job = dp.read_message(reader1)
+
+            # the first worker never replies, so its lease expires and the job
+            # is given to the second worker once it has run the others
+            sock2, reader2 = self.connect()
+            lock = threading.Lock()
+            ids = []
+
+            while (message := dp.read_message(reader2))["type"] == "job":
+                ids.append(message["id"])
+                reply = {"type": "result", "id": message["id"], "total": 20}
+                dp.send_message(sock2, lock, reply)
+
+            for f in (reader1, sock1, reader2, sock2):
+                f.close()
+
+        self.assertEqual(message["type"], "done")
+        self.assertIn(job["id"], ids)
+        self.assertEqual(sorted(ids), list(range(len(coordinator.paths))))
+        self.assertEqual(coordinator.divide()[1], 400)
+
+    def test_local_workers(self):
+        env = dict(os.environ, HOME=self.tmp.name)
+        proc = subprocess.run(
+            [
+                sys.executable,
+                os.path.join(REPO_DIR, "distributed_perft.py"),
+                "serve",
+                "4",
+                "--local",
+                "2",
+                "--address",
+                self.address,
+            ],
+            capture_output=True,
+            text=True,
+            timeout=120,
+            env=env,
+        )
+
+        self.assertEqual(proc.returncode, 0, proc.stdout + proc.stderr)
+        self.assertIn("Nodes searched: 197281", proc.stdout)
+        self.assertIn("e2e4: 13160", proc.stdout)
+
+
+if __name__ == "__main__":
+    unittest.main()
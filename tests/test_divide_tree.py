@@ -0,0 +1,73 @@
+"""Tests for divide_tree."""
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import constants as cs
+import divide_tree as dt
+
+PATH1 = ["g1f3", "g8f6", "b1c3"]
+PATH2 = ["b1c3", "g8f6", "g1f3"]
+
+
+class DivideTreeTest(unittest.TestCase):
+    def setUp(self):
+        self.tree = dt.DivideTree()
+
+    def test_missing_results(self):
+        self.assertEqual(self.tree.get(cs.START_POS, PATH1, 1), [None, None])
+
+    def test_engine_results_kept_per_path(self):
+        self.tree.put(cs.START_POS, PATH1, 1, dt.ENGINE, ({"e7e5": 1}, 1))
+        self.tree.put(cs.START_POS, PATH2, 1, dt.ENGINE, ({"e7e6": 1}, 1))
+
+        self.assertEqual(self.tree.get(cs.START_POS, PATH1, 1)[0], ({"e7e5": 1}, 1))
+        self.assertEqual(self.tree.get(cs.START_POS, PATH2, 1)[0], ({"e7e6": 1}, 1))
+
+    def test_reference_results_shared(self):
+        self.tree.put(cs.START_POS, PATH1, 2, dt.ENGINE, ({"e7e5": 20}, 20))
+        self.tree.put(cs.START_POS, PATH1, 2, dt.REFERENCE, ({"e7e5": 21}, 21))
+
+        self.assertEqual(
+            self.tree.get(cs.START_POS, PATH2, 2), [None, ({"e7e5": 21}, 21)]
+        )
+        self.assertEqual(self.tree.get(cs.START_POS, PATH2, 1), [None, None])
+
+    def test_child_totals(self):
+        self.tree.put(cs.START_POS, [], 2, dt.ENGINE, ({"e2e4": 20, "d2d4": 20}, 40))
+        self.tree.put(cs.START_POS, [], 2, dt.REFERENCE, ({"e2e4": 21}, 21))
+
+        self.assertEqual(self.tree.child_totals(cs.START_POS, ["e2e4"], 1), [20, 21])
+        self.assertEqual(self.tree.child_totals(cs.START_POS, ["d2d4"], 1), [20, None])
+
+        for moves, depth in ((["e2e4"], 2), ([], 1)):
+            self.assertEqual(
+                self.tree.child_totals(cs.START_POS, moves, depth), [None, None]
+            )
+
+    def test_save_and_load(self):
+        self.tree.put(cs.START_POS, PATH1, 1, dt.ENGINE, ({"e7e5": 1}, 1))
+        self.tree.put(cs.START_POS, PATH1, 1, dt.REFERENCE, ({"e7e5": 1, "e7e6": 1}, 2))
+        self.tree.put(cs.START_POS, [], 2, dt.ENGINE, ({"e2e4": 20}, 20))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "tree.json")
+            self.tree.save(path, cs.START_POS, PATH1[:2], ("Engine", "Reference"))
+
+            tree = dt.DivideTree()
+            self.assertEqual(tree.load(path), (cs.START_POS, PATH1[:2]))
+
+        # only the reference's results are loaded, and they are still shared
+        self.assertEqual(
+            tree.get(cs.START_POS, PATH2, 1), [None, ({"e7e5": 1, "e7e6": 1}, 2)]
+        )
+        self.assertEqual(tree.get(cs.START_POS, PATH1, 1)[0], None)
+        self.assertEqual(tree.get(cs.START_POS, [], 2), [None, None])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,187 @@
+"""Tests for engine_wrapper."""
+
+import os
+import sys
+import tempfile
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import constants as cs
+import engine_wrapper as ewr
+
+# a UCI engine which prints the result of each move but never a total
+NO_TOTAL_ENGINE = """\
+import sys
+
+for line in sys.stdin:
+    command = line.strip()
+
+    if command == "uci":
+        print("id name NoTotal")
+        print("uciok")
+    elif command == "isready":
+        print("readyok")
+    elif command.startswith("go perft"):
+        print("e2e4 1")
+    elif command == "quit":
+        break
+
+    sys.stdout.flush()
+"""
+
+# a UCI engine using the built-in move generator, which prints its total twice
+# followed by the time taken, like many engines do
+VERBOSE_ENGINE = """\
+import sys
+
+sys.path.insert(0, {repo_dir!r})
+import movegen as mg
+
+fen, moves = None, []
+
+for line in sys.stdin:
+    command = line.split()
+
+    if command == ["uci"]:
+        print("id name Verbose")
+        print("uciok")
+    elif command == ["isready"]:
+        print("readyok")
+    elif command[:2] == ["position", "fen"]:
+        fen = " ".join(command[2:8])
+        moves = command[9:]
+    elif command[:2] == ["go", "perft"]:
+        depth = int(command[2])
+        perft_results, total = mg.divide(fen, moves, depth)
+
+        for mstr, res in perft_results.items():
+            print(f"{{mstr}}: {{res}}")
+
+        print()
+        print(f"Perft {{depth}}: {{total}}")
+        print(f"Nodes searched: {{total}}")
+        print("Time: 0")
+        print("NPS: 0")
+    elif command == ["quit"]:
+        break
+
+    sys.stdout.flush()
+"""
+
+MATED_FEN = "rnb1kbnr/pppp1ppp/8/4p3/6Pq/5P2/PPPPP2P/RNBQKBNR w KQkq - 1 3"
+
+
+def write_engine(source):
+    """Writes an engine script to a temporary file, returning its path."""
+    fd, path = tempfile.mkstemp(suffix=".py")
+
+    with os.fdopen(fd, "w") as f:
+        f.write(f"#!{sys.executable}\n" + source)
+
+    os.chmod(path, 0o755)
+    return path
+
+
+class ParsePerftOutputTest(unittest.TestCase):
+    def parse(self, output):
+        return list(ewr.parse_perft_output(output.split("\n")))
+
+    def test_move_lines(self):
+        self.assertEqual(
+            self.parse("e2e4 20\ng1f3: 21\na7a8q  3\n\n64"),
+            [("e2e4", 20), ("g1f3", 21), ("a7a8q", 3), (None, 64)],
+        )
+
+    def test_labelled_totals(self):
+        for total in ("44", "Nodes searched: 44", "Total: 44", "Perft 3: 44"):
+            with self.subTest(total=total):
+                self.assertEqual(
+                    self.parse(f"e2e4 44\n\n{total}"), [("e2e4", 44), (None, 44)]
+                )
+
+    def test_total_printed_twice(self):
+        self.assertEqual(
+            self.parse("e2e4 1\nd2d4 1\n\n2\nNodes searched: 2\nTime: 5\nNPS: 400"),
+            [("e2e4", 1), ("d2d4", 1), (None, 2)],
+        )
+
+    def test_other_lines_ignored(self):
+        self.assertEqual(
+            self.parse("info string perft 2\nDepth: 1\ne2e4 1\n\n1"),
+            [("e2e4", 1), (None, 1)],
+        )
+
+    def test_no_legal_moves(self):
+        self.assertEqual(
+            self.parse("\nNodes searched: 0\nTime: 0\nNPS: 0"), [(None, 0)]
+        )
+
+    def test_jobs_separated_by_readyok(self):
+        output = "e2e4 1\n\n1\nTime: 0\nreadyok\n0\nNodes searched: 0\nreadyok\n0"
+        self.assertEqual(
+            self.parse(output), [("e2e4", 1), (None, 1), (None, 0), (None, 0)]
+        )
+
+
+class RunPerftTotalsTest(unittest.TestCase):
+    def setUp(self):
+        self.engine = write_engine(NO_TOTAL_ENGINE)
+
+    def tearDown(self):
+        os.remove(self.engine)
+
+    def test_missing_total_raises(self):
+        for persistent in (False, True):
+            with ewr.EngineWrapper(self.engine, persistent=persistent, timeout=5) as e:
+                with self.assertRaisesRegex(ewr.EngineError, "perft total"):
+                    e.get_perft_totals([1, 2])
+
+
+class VerboseEngineTest(unittest.TestCase):
+    def setUp(self):
+        self.engine = write_engine(VERBOSE_ENGINE.format(repo_dir=REPO_DIR))
+
+    def tearDown(self):
+        os.remove(self.engine)
+
+    def test_perft(self):
+        for persistent in (False, True):
+            with ewr.EngineWrapper(self.engine, persistent=persistent, timeout=5) as e:
+                perft_results, total = e.perft(2)
+
+                self.assertEqual(total, 400)
+                self.assertEqual(perft_results["e2e4"], 20)
+
+    def test_perft_totals(self):
+        for persistent in (False, True):
+            with ewr.EngineWrapper(self.engine, persistent=persistent, timeout=5) as e:
+                self.assertEqual(
+                    e.get_perft_totals([1, 2, 3]), {1: 20, 2: 400, 3: 8902}
+                )
+                self.assertEqual(e.get_perft_totals([1, 2], MATED_FEN), {1: 0, 2: 0})
+
+    def test_perft_batch(self):
+        jobs = [
+            (cs.START_POS, None, 2),
+            (MATED_FEN, None, 1),
+            (MATED_FEN, None, 2),
+            (cs.START_POS, ["e2e4"], 1),
+            (cs.START_POS, None, 0),
+            (cs.START_POS, None, 1),
+        ]
+
+        for persistent in (False, True):
+            with ewr.EngineWrapper(self.engine, persistent=persistent, timeout=5) as e:
+                outcomes = e.perft_batch(jobs)
+
+                self.assertEqual(
+                    [total for _, total in outcomes], [400, 0, 0, 20, 0, 20]
+                )
+                self.assertEqual(outcomes[1][0], {})
+                self.assertEqual(outcomes[3][0]["e7e5"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,130 @@
+"""Tests for epd."""
+
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import board as bd
+import constants as cs
+import epd as ep
+import normalise_epd as ne
+
+KIWIPETE = "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq -"
+
+
+class ParsePerftLineTest(unittest.TestCase):
+    def test_spaced_operations(self):
+        record = ep.parse_perft_line(f"{cs.START_POS} ;D1 20 ;D2 400 ;D3 8902")
+
+        self.assertEqual(record.fen, cs.START_POS)
+        self.assertEqual(record.depths(), [1, 2, 3])
+        self.assertEqual(record[3], 8902)
+
+    def test_unspaced_operations(self):
+        record = ep.parse_perft_line(f"{cs.START_POS};D1 20;D2 400;")
+
+        self.assertEqual(record.fen, cs.START_POS)
+        self.assertEqual(record[2], 400)
+        self.assertNotIn(3, record)
+
+    def test_missing_depths(self):
+        record = ep.parse_perft_line(f"{cs.START_POS} ;D2 400 ;D4 197281")
+
+        self.assertEqual(record.depths(), [2, 4])
+        self.assertNotIn(1, record)
+        with self.assertRaises(KeyError):
+            record[1]
+
+    def test_normalised_line(self):
+        board = bd.Board()
+        record = ne.normalise_line(board, f"{KIWIPETE} 0 1 ;D1 48 ;D2 2039")
+        line = json.dumps(record, separators=(",", ":"))
+
+        perft_record = ep.parse_perft_line(line)
+        self.assertEqual(perft_record.fen, f"{KIWIPETE} 0 1")
+        self.assertEqual(perft_record.depths(), [1, 2])
+        self.assertEqual(perft_record[2], 2039)
+
+
+class ParseOperationsTest(unittest.TestCase):
+    def test_operations(self):
+        fen, ops = ep.parse_operations(f'{KIWIPETE} bm Qxf6; id "test 1"; hmvc 3;')
+
+        self.assertEqual(fen, f"{KIWIPETE} 3 1")
+        self.assertEqual(ops["bm"], ["Qxf6"])
+        self.assertEqual(ops["id"], ['"test', '1"'])
+
+    def test_move_clocks_after_position(self):
+        fen, ops = ep.parse_operations(f"{KIWIPETE} 5 20 ;D1 48")
+
+        self.assertEqual(fen, f"{KIWIPETE} 5 20")
+        self.assertEqual(ops, {"D1": ["48"]})
+
+    def test_no_position(self):
+        self.assertIsNone(ep.parse_operations("not an epd line"))
+
+    def test_quoted_id(self):
+        test = ep.parse_test_line(f'{KIWIPETE} bm Qxf6 Nxf7; id "WAC 001";')
+
+        self.assertEqual(test.fen, f"{KIWIPETE} 0 1")
+        self.assertEqual(test.best_moves, ["Qxf6", "Nxf7"])
+        self.assertEqual(test.test_id, "WAC 001")
+
+    def test_normalised_test_line(self):
+        board = bd.Board()
+        record = ne.normalise_line(board, f'{KIWIPETE} bm Qxf6; id "WAC 001";')
+        test = ep.parse_test_line(json.dumps(record))
+
+        self.assertEqual(test.best_moves, ["f3f6"])
+        self.assertEqual(test.test_id, "WAC 001")
+
+
+class SelectLinesTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".epd")
+
+        with os.fdopen(fd, "w") as f:
+            for n in range(1, 101):
+                f.write(f"line {n}\n")
+                if n % 10 == 0:
+                    f.write("\n")
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_all_lines(self):
+        lines = list(ep.select_lines(self.path))
+        self.assertEqual(lines, [f"line {n}" for n in range(1, 101)])
+
+    def test_shards_cover_file(self):
+        shards = [
+            list(ep.select_lines(self.path, ep.parse_shard(f"{i}/3")))
+            for i in range(1, 4)
+        ]
+        lines = [l for shard in shards for l in shard]
+
+        self.assertEqual(sorted(lines), sorted(ep.select_lines(self.path)))
+        self.assertEqual(len(lines), len(set(lines)))
+        self.assertEqual(shards[0][:2], ["line 1", "line 4"])
+
+    def test_invalid_shards(self):
+        for shard in ("0/3", "4/3", "1", "a/b"):
+            with self.assertRaises(ValueError):
+                ep.parse_shard(shard)
+
+    def test_sample_is_reproducible(self):
+        sample1 = list(ep.select_lines(self.path, sample=0.3, seed=7))
+        sample2 = list(ep.select_lines(self.path, sample=0.3, seed=7))
+        other = list(ep.select_lines(self.path, sample=0.3, seed=8))
+
+        self.assertEqual(sample1, sample2)
+        self.assertNotEqual(sample1, other)
+        self.assertTrue(0 < len(sample1) < 100)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,208 @@
+"""Tests for movegen."""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import board as bd
+import constants as cs
+import movegen as mg
+
+KIWIPETE = "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1"
+
+# published perft counts from the Chess Programming Wiki
+PERFT_COUNTS = [
+    (cs.START_POS, [20, 400, 8902, 197281]),
+    (KIWIPETE, [48, 2039, 97862]),
+    ("8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1", [14, 191, 2812]),
+    (
+        "r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1",
+        [6, 264, 9467],
+    ),
+    ("rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8", [44, 1486, 62379]),
+    (
+        "r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10",
+        [46, 2079, 89890],
+    ),
+]
+
+
+def legal_moves(fen):
+    """Returns the legal moves in a position as strings."""
+    return {mg.move_to_str(m) for m in mg.Position(fen).legal_moves()}
+
+
+class PerftTest(unittest.TestCase):
+    def test_perft_counts(self):
+        for fen, counts in PERFT_COUNTS:
+            pos = mg.Position(fen)
+
+            for depth, count in enumerate(counts, 1):
+                with self.subTest(fen=fen, depth=depth):
+                    self.assertEqual(pos.perft(depth), count)
+
+    def test_divide_matches_perft(self):
+        for fen, counts in PERFT_COUNTS:
+            with self.subTest(fen=fen):
+                perft_results, total = mg.divide(fen, depth=2)
+
+                self.assertEqual(total, counts[1])
+                self.assertEqual(len(perft_results), counts[0])
+                self.assertEqual(sum(perft_results.values()), total)
+
+    def test_divide_after_moves(self):
+        perft_results, total = mg.divide(cs.START_POS, ["e2e4", "e7e5"], 1)
+
+        self.assertEqual(total, 29)
+        self.assertIn("g1f3", perft_results)
+
+    def test_divide_rejects_illegal_moves(self):
+        with self.assertRaises(ValueError):
+            mg.divide(cs.START_POS, ["e2e5"], 1)
+
+    def test_reference_engine(self):
+        engine = mg.ReferenceEngine()
+
+        self.assertEqual(engine.get_perft_totals([1, 2, 3]), {1: 20, 2: 400, 3: 8902})
+        self.assertEqual(engine.perft(2, KIWIPETE)[1], 2039)
+
+
+class LegalMovesTest(unittest.TestCase):
+    def test_en_passant_discovered_check(self):
+        # exd3 would leave the black king on a4 in check from the queen on h4
+        moves = legal_moves("8/8/8/8/k2Pp2Q/8/8/3K4 b - d3 0 1")
+
+        self.assertNotIn("e4d3", moves)
+        self.assertIn("e4e3", moves)
+
+    def test_en_passant_allowed(self):
+        moves = legal_moves("8/8/8/8/k2Pp3/8/8/3K4 b - d3 0 1")
+
+        self.assertIn("e4d3", moves)
+
+    def test_castling_through_check(self):
+        # the rook on f2 attacks f1, which the king would cross
+        moves = legal_moves("4k3/8/8/8/8/8/5r2/R3K2R w KQ - 0 1")
+
+        self.assertNotIn("e1g1", moves)
+        self.assertIn("e1c1", moves)
+
+    def test_castling_out_of_check(self):
+        moves = legal_moves("4k3/8/8/8/8/8/4r3/R3K2R w KQ - 0 1")
+
+        self.assertNotIn("e1g1", moves)
+        self.assertNotIn("e1c1", moves)
+
+    def test_castling_into_check(self):
+        # b1 may be attacked when castling queenside, but c1 may not
+        self.assertIn("e1c1", legal_moves("1r2k3/8/8/8/8/8/8/R3K3 w Q - 0 1"))
+        self.assertNotIn("e1c1", legal_moves("2r1k3/8/8/8/8/8/8/R3K3 w Q - 0 1"))
+
+
+class PerftTableTest(unittest.TestCase):
+    def test_table_gives_same_counts(self):
+        table = mg.PerftTable(1)
+
+        # the second pass is answered from the table
+        for _ in range(2):
+            for fen, counts in PERFT_COUNTS:
+                pos = mg.Position(fen)
+
+                for depth, count in enumerate(counts, 1):
+                    with self.subTest(fen=fen, depth=depth):
+                        self.assertEqual(pos.perft(depth, table), count)
+
+        self.assertGreater(table.hits, 0)
+
+    def test_small_table_gives_same_counts(self):
+        # a table of one bucket has an entry replaced on nearly every store
+        table = mg.PerftTable(0)
+        self.assertEqual(table.mask, 0)
+        self.assertEqual(mg.Position(KIWIPETE).perft(3, table), 97862)
+
+    def test_table_fits_budget(self):
+        for max_size in (1, 3, 64):
+            table = mg.PerftTable(max_size)
+
+            self.assertLessEqual(table.memory(), max_size * 2**20)
+            # doubling the number of buckets would exceed the budget
+            self.assertGreater(2 * table.memory(), max_size * 2**20)
+
+    def test_replacement_keeps_deepest(self):
+        table = mg.PerftTable(0)
+        table.put(1, 5, 100)
+        table.put(2, 1, 10)
+        table.put(3, 2, 20)
+
+        self.assertEqual(table.get(1, 5), 100)
+        self.assertIsNone(table.get(2, 1))
+        self.assertEqual(table.get(3, 2), 20)
+        self.assertIsNone(table.get(1, 4))
+
+
+class KeyTest(unittest.TestCase):
+    def assert_keys_match(self, fen, moves):
+        """Checks the incremental key against a key computed from scratch after
+        each move."""
+        pos = mg.Position(fen)
+        board = bd.Board()
+        board.update_board(fen)
+
+        for mstr in moves:
+            pos = pos.make_move(pos.parse_move(mstr))
+            board.make_move(mstr)
+            self.assertEqual(pos.key, mg.Position(board.get_fen()).key, mstr)
+
+    def test_keys_after_moves(self):
+        self.assert_keys_match(cs.START_POS, ["e2e4", "d7d5", "e4d5", "g8f6"])
+
+    def test_keys_after_en_passant(self):
+        self.assert_keys_match(
+            cs.START_POS, ["e2e4", "a7a6", "e4e5", "d7d5", "e5d6", "c7d6"]
+        )
+
+    def test_keys_after_castling(self):
+        self.assert_keys_match(KIWIPETE, ["e1g1", "e8c8", "a1b1", "h8g8"])
+        self.assert_keys_match(KIWIPETE, ["e1c1", "a6e2", "c3e2", "e8g8"])
+
+    def test_keys_after_promotion(self):
+        self.assert_keys_match(
+            PERFT_COUNTS[3][0], ["c4c5", "b2a1q", "d1a1", "a8b8", "a7b8n"]
+        )
+
+    def test_keys_through_tree(self):
+        # every position two moves deep in kiwipete, which covers captures,
+        # castling and rights lost by rook moves and captures
+        root = mg.Position(KIWIPETE)
+
+        for m1 in root.legal_moves():
+            pos = root.make_move(m1)
+
+            for m2 in pos.legal_moves():
+                moves = [mg.move_to_str(m1), mg.move_to_str(m2)]
+                board = bd.Board()
+                board.update_board(KIWIPETE)
+
+                for mstr in moves:
+                    board.make_move(mstr)
+
+                self.assertEqual(
+                    pos.make_move(m2).key, mg.Position(board.get_fen()).key, moves
+                )
+
+    def test_transpositions_share_key(self):
+        pos1 = mg.Position(cs.START_POS)
+        pos2 = mg.Position(cs.START_POS)
+
+        for mstr in ("g1f3", "g8f6", "b1c3"):
+            pos1 = pos1.make_move(pos1.parse_move(mstr))
+        for mstr in ("b1c3", "g8f6", "g1f3"):
+            pos2 = pos2.make_move(pos2.parse_move(mstr))
+
+        self.assertEqual(pos1.key, pos2.key)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+"""Tests for perft_cache."""
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import perft_cache as pc
+
+# the en passant square can't be used, since no black pawn can capture on it
+EP_FEN = "rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq e3 0 1"
+NO_EP_FEN = "rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq - 0 1"
+
+
+class KeyTest(unittest.TestCase):
+    def test_position_key_is_canonical(self):
+        self.assertEqual(pc.position_key(EP_FEN), pc.position_key(NO_EP_FEN))
+        self.assertEqual(
+            pc.position_key(NO_EP_FEN), pc.position_key(NO_EP_FEN[:-3] + "5 9")
+        )
+
+    def test_exact_key_keeps_every_field(self):
+        self.assertNotEqual(pc.exact_key(EP_FEN), pc.exact_key(NO_EP_FEN))
+        self.assertNotEqual(
+            pc.exact_key(NO_EP_FEN), pc.exact_key(NO_EP_FEN[:-3] + "5 9")
+        )
+        self.assertEqual(
+            pc.exact_key(NO_EP_FEN, ["e7e5"]), NO_EP_FEN + " moves e7e5"
+        )
+
+
+class PerftCacheTest(unittest.TestCase):
+    def test_put_and_get(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = pc.PerftCache(os.path.join(tmp, "cache.sqlite3"))
+
+            try:
+                cache.put("engine", "key", 2, 400, {"e2e4": 20})
+                self.assertEqual(cache.get("engine", "key", 2), ({"e2e4": 20}, 400))
+                self.assertIsNone(cache.get("other", "key", 2))
+                self.assertIsNone(cache.get("engine", "key", 3))
+
+                cache.put("engine", "key", 3, 8902)
+                self.assertIsNone(cache.get("engine", "key", 3))
+                self.assertEqual(cache.get("engine", "key", 3, divide=False)[1], 8902)
+            finally:
+                cache.close()
+
+
+if __name__ == "__main__":
+    unittest.main()